@@ -7,15 +7,17 @@ __version__ = "0.3"
 
 """
 TODOs:
-pull retweeted message as well as original
 Command Line interface
 better geolocation?
 
 """
 
-import datetime, time
+import datetime, time, math
+import _strptime # time.strptime() isn't thread safe the first time it's called
 import os, sys
-import json, re
+import json, re, hashlib, copy
+import threading, tempfile
+from itertools import islice
 
 import MySQLdb
 from TwitterAPI import TwitterAPI
@@ -24,11 +26,78 @@ from requests.exceptions import ChunkedEncodingError
 import xml.etree.ElementTree as ET
 from HTMLParser import HTMLParser
 
+from .pipeline import TweetQueue
+from .batching import FlushPolicy, rowSize
+from .connectionPool import ConnectionPool, MYSQL_ERR_CONNECTION_LOST
+from . import archive
+from .geoCache import CachedGeoLocator
+from .credentials import CredentialPool, readKeysFile, KEY_NAMES
+from .spool import Spool
+from .metrics import Metrics, NullMetrics
+from .dedup import RecentIdFilter
+
 
 MAX_MYSQL_ATTEMPTS = 5
 MAX_TWITTER_ATTEMPTS = 5
-TWEET_LIMIT_BEFORE_INSERT = 100 #edited by selah
-TWT_REST_WAIT = 15*60
+TWEET_LIMIT_BEFORE_INSERT = 100 #edited by selah, default maxRows of the FlushPolicy
+MAX_BUFFER_BYTES = 64 * 2**20 # high-water mark of the rows held in memory (see the bufferBytes option)
+TWT_REST_WAIT = 15*60 # when Twitter doesn't say when the rate limit resets
+TIMELINE_THREADS = 4
+SEARCH_DAYS = 7 # how far back the Search API goes
+SEARCH_WINDOW = 3600 # seconds of tweets per window of a sliced search
+LOOKUP_BATCH = 100 # IDs per statuses/lookup request
+HYDRATE_ROUND = 10000 # IDs checked against MySQL (and progress saved) at a time
+MYSQL_POOL_SIZE = 4
+TWITTER_TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+TWITTER_EPOCH_MS = 1288834974657 # snowflake IDs count milliseconds from here
+SNOWFLAKE_MIN_ID = 29700859247 # older tweet IDs don't have a timestamp in them
+MYSQL_ERR_NO_SUCH_TABLE = 1146
+MYSQL_ERR_LOCAL_INFILE_DISABLED = (1148, 3948)
+BULK_INSERT_CHUNK = 1000 # rows per multi-row INSERT when LOAD DATA isn't allowed
+STOP_READER_WAIT = 5 # seconds the pipelined writers give the reader to finish its tweet after stop()
+# Newest tweet ID seen per endpoint and query, for incremental syncs
+CHECKPOINT_COL_DESC = ["endpoint varchar(64)", "query varchar(255)", "since_id bigint(20)",
+                       "updated_time datetime", "primary key (endpoint, query)"]
+# Newest IDs of a table the dedup filter starts with
+DEDUP_SEED = 100000
+# Columns of a tweet that change over time, updated when it comes again with dedup
+DEDUP_UPDATE_COLUMNS = ("followers_count", "friend_count")
+# Monthly partitions created ahead of the current month (see the partitioned option)
+PARTITIONS_AHEAD = 2
+PARTITION_NAME = re.compile(r"^p(\d{4})(\d{2})$")
+# Entries of a SQLfieldsExp that are plain secondary indices (see the deferIndexes
+# option), unique keys aren't deferred: they keep duplicates out of the backfill
+SECONDARY_INDEX = re.compile(r"^\s*(?:index|key)\b\s*(\w+)?\s*\(", re.I)
+# Statuses a tweet can have in it (see the embedded option)
+EMBEDDED_STATUS_KEYS = ("retweeted_status", "quoted_status")
+# Columns with few distinct values, whose strings are shared by the rows held in memory
+INTERNED_COLUMNS = ("source", "lang", "time_zone")
+# Request parameters that don't change what a query is
+PAGING_PARAMS = frozenset(("count", "max_id", "since_id"))
+
+# Options understood by the *ToMySQL methods, with their defaults
+INSERT_OPTIONS = {"replace": False,
+                  "monthlyTables": False,
+                  # Reading the stream in a separate thread from the MySQL writes
+                  "pipelined": False,
+                  "queueSize": 10000,
+                  "overflow": "spill",
+                  # Bytes of rows held in memory before spilling (pipelined) or flushing
+                  "bufferBytes": MAX_BUFFER_BYTES,
+                  "writers": 1,
+                  # LOAD DATA LOCAL INFILE instead of INSERT
+                  "bulk": False,
+                  # When to write the buffered tweets (see batching.FlushPolicy)
+                  "flushPolicy": None,
+                  # Number of monthly tables written to in parallel
+                  "parallelTables": 1,
+                  # Write-ahead spool directory (or Spool), see spool.Spool
+                  "spool": None,
+                  # Recent tweet ID filter instead of REPLACE, see dedup.RecentIdFilter
+                  "dedup": False,
+                  "updateColumns": DEDUP_UPDATE_COLUMNS,
+                  # Secondary indices built once everything is in, see buildIndexes
+                  "deferIndexes": False}
 
 DEFAULT_MYSQL_COL_DESC = ["user_id bigint(20)", "message_id bigint(20) primary key",
                           "message text", "created_time datetime",
@@ -55,9 +124,177 @@ DEFAULT_TWEET_JSON_SQL_CORR = {'id': "['id_str']",
                                'lang': "['lang']",
                                'source': "['source']",
                                }
-    
 
-class TwitterMySQL:
+JTWEET_PATH_KEY = re.compile(r"""\[\s*(['"])(.*?)\1\s*\]|\[\s*(-?\d+)\s*\]""")
+
+
+class EmbeddedRow(tuple):
+    """Row of a status that came in another one (a retweeted or quoted status)"""
+
+
+class QueryFailed(Exception):
+    """
+    A query failed MAX_MYSQL_ATTEMPTS times. Only raised when spooling
+    (see _flushSpooled), otherwise the query is given up on
+    """
+
+
+# Exceptions of the MySQL drivers in use (cooperative.py adds PyMySQL's)
+MYSQL_ERRORS = [MySQLdb.Error]
+MYSQL_OPERATIONAL_ERRORS = [MySQLdb.OperationalError]
+
+
+def _mysqlErrorCode(e):
+    """MySQL error number of a MySQLdb exception (None for other exceptions)"""
+    if isinstance(e, tuple(MYSQL_ERRORS)) and e.args and isinstance(e.args[0], int):
+        return e.args[0]
+    return None
+
+
+TSV_ESCAPES = [("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r"), ("\0", "\\0")]
+
+
+def _tsvField(value):
+    """Formats a value for LOAD DATA INFILE (default FIELDS/LINES options)"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif not isinstance(value, str):
+        return str(value)
+    for char, escaped in TSV_ESCAPES:
+        if char in value:
+            value = value.replace(char, escaped)
+    return value
+
+
+MONTHS = dict((m, "%02d" % (i+1)) for i, m in enumerate(("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                                                          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")))
+WEEKDAYS = frozenset(("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"))
+MYSQL_TIME = re.compile(r"\d{4}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01]) ([01]\d|2[0-3]):[0-5]\d:[0-5]\d$")
+
+
+def _parseTweetTime(timestr):
+    """
+    Fast version of time.strptime(timestr, TWITTER_TIME_FORMAT) for Twitter's
+    fixed layout (Mon Jan 25 05:02:27 +0000 2010).
+    Returns (MySQL datetime, YYYY_MM), or None if timestr doesn't look
+    exactly like that (let strptime deal with it then)
+    """
+    if (len(timestr) != 30 or timestr[19:26] != " +0000 " or timestr[:3] not in WEEKDAYS
+        or timestr[3] != " " or timestr[7] != " " or timestr[10] != " "
+        or timestr[13] != ":" or timestr[16] != ":"):
+        return None
+    month = MONTHS.get(timestr[4:7])
+    day, hms, year = (timestr[8:10], timestr[11:19], timestr[26:30])
+    if not (month and day.isdigit() and year.isdigit() and hms[:2].isdigit()
+            and hms[3:5].isdigit() and hms[6:].isdigit()):
+        return None
+    if not ("01" <= day <= "31" and hms[:2] <= "23" and hms[3:5] <= "59" and hms[6:] <= "59"):
+        return None
+    if day > "28":
+        try:
+            datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            return None
+    return ("%s-%s-%s %s" % (year, month, day, hms), "%s_%s" % (year, month))
+
+
+def checkpointQuery(params):
+    """
+    The query part of a checkpoint key: the request parameters that say
+    which tweets are wanted (screen_name, q, ...), paging ones left out
+    """
+    query = "&".join("%s=%s" % (k, v) for k, v in sorted(params.iteritems()) if k not in PAGING_PARAMS)
+    if len(query) > 255:
+        digest = hashlib.md5(query.encode("utf-8") if isinstance(query, unicode) else query).hexdigest()
+        query = query[:222] + "#" + digest
+    return query
+
+
+def snowflakeToMysql(tweetId):
+    """MySQL datetime of the (snowflake) tweet ID, None for older tweets"""
+    tweetId = long(tweetId)
+    if tweetId < SNOWFLAKE_MIN_ID:
+        return None
+    seconds = ((tweetId >> 22) + TWITTER_EPOCH_MS) // 1000
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds))
+
+
+def timeToSnowflake(timestamp):
+    """Smallest (snowflake) tweet ID of the tweets sent at timestamp (epoch seconds)"""
+    return max(0, (long(timestamp * 1000) - TWITTER_EPOCH_MS) << 22)
+
+
+def _addMonths(yearMonth, n):
+    """'YYYY_MM' n months later (or earlier)"""
+    months = int(yearMonth[:4]) * 12 + int(yearMonth[5:7]) - 1 + n
+    return "%04d_%02d" % (months // 12, months % 12 + 1)
+
+
+def _monthRange(first, last):
+    """'YYYY_MM' months from first to last, both included"""
+    months = []
+    while first <= last:
+        months.append(first)
+        first = _addMonths(first, 1)
+    return months
+
+
+def _partitionDefinition(yearMonth):
+    return "PARTITION p%s VALUES LESS THAN (TO_DAYS('%s-01'))" % (
+        yearMonth.replace("_", ""), _addMonths(yearMonth, 1).replace("_", "-"))
+
+
+def _compileJTweetPath(path):
+    """
+    Turns a jTweetToRow path like "['user']['id_str']" into
+    a function that pulls that value out of a JSON tweet.
+    Missing keys (and None parents) return None instead of raising.
+    """
+    keys = []
+    end = 0
+    for m in JTWEET_PATH_KEY.finditer(path):
+        if m.start() != end and path[end:m.start()].strip():
+            break
+        keys.append(m.group(2) if m.group(3) is None else int(m.group(3)))
+        end = m.end()
+    if not keys or path[end:].strip():
+        # Not a plain chain of subscripts, keep the old (slow) behaviour
+        code = compile("jTweet%s" % path, "<jTweetToRow>", "eval")
+        def extract(jTweet):
+            try:
+                return eval(code, {}, {"jTweet": jTweet})
+            except (KeyError, IndexError, TypeError):
+                return None
+        return extract
+
+    if len(keys) == 1:
+        key = keys[0]
+        def extract(jTweet):
+            try:
+                return jTweet[key]
+            except (KeyError, IndexError, TypeError):
+                return None
+    elif len(keys) == 2:
+        key1, key2 = keys
+        def extract(jTweet):
+            try:
+                return jTweet[key1][key2]
+            except (KeyError, IndexError, TypeError):
+                return None
+    else:
+        def extract(jTweet):
+            try:
+                for key in keys:
+                    jTweet = jTweet[key]
+                return jTweet
+            except (KeyError, IndexError, TypeError):
+                return None
+    return extract
+
+
+class TwitterMySQL(object):
     """Wrapper for the integration of Twitter APIs into MySQL
     Turns JSON tweets into row format
     Failsafe connection to MySQL servers
@@ -66,8 +303,17 @@ class TwitterMySQL:
     """
 
     def _warn(self, *objs):
-        errorStream = open(self.errorFile, "a+") if self.errorFile else sys.stderr
-        print >> errorStream, "\rWARNING: ", " ".join(str(o) for o in objs)
+        if self._errorStream is None:
+            # Opened once, warnings can come at stream rates
+            self._errorStream = open(self.errorFile, "a+") if self.errorFile else sys.stderr
+        print >> self._errorStream, "\rWARNING: ", " ".join(str(o) for o in objs)
+        self._errorStream.flush()
+        self.metrics.inc("warnings")
+
+    def _log(self, *objs):
+        """Progress messages, on stdout unless quiet"""
+        if not self.quiet:
+            print " ".join(str(o) for o in objs)
 
     def __init__(self, **kwargs):
         """
@@ -78,16 +324,42 @@ class TwitterMySQL:
           - API_SECRET      Twitter API Secret
           - ACCESS_TOKEN    Twitter App Access token
           - ACCESS_SECRET   Twitter App Access token secret
+            (or api, a TwitterAPI object, or several sets of keys, see
+             apis, credentials and keysFile below)
 
         Optional parameters:
+          - apis            list of TwitterAPI objects, REST requests go to
+                            whichever has rate limit quota left
+          - credentials     list of {API_KEY: .., API_SECRET: ..,
+                            ACCESS_TOKEN: .., ACCESS_SECRET: ..} dictionaries,
+                            used like apis
+          - keysFile        file with one or more sets of keys (see
+                            credentials.readKeysFile), used like apis
           - noWarnings      disable MySQL warnings [Default: False]
           - dropIfExists    set to True to delete the existing table
           - geoLocate       a function that converts coordinates to state
                             and/or address.
                             Format:
                             (state, address) = your_method(lat, long)
+          - geoCache        cache the geoLocate results: True, a dictionary
+                            of CachedGeoLocator options (precision, maxSize,
+                            gridSize, cacheFile) or a CachedGeoLocator.
+                            The grid (gridSize) only knows states, it's
+                            only used without a coordinates_address column
+                            [Default: None]
           - errorFile       error logging file - warnings will be written to it
                             [Default: stderr]
+          - quiet           no console output per tweet, query or batch
+                            (it costs time at stream rates) [Default: False]
+          - metrics         Metrics collecting counters and histograms on
+                            what's going on (tweets received, parse,
+                            geolocation and insert times, retries, rate
+                            limit waits, ...), False to turn them off
+                            [Default: a new Metrics]
+          - reporters       reporters started with the metrics (see
+                            metrics.JSONLinesReporter,
+                            PrometheusTextfileReporter and
+                            PrometheusHTTPReporter) [Default: None]
           - jTweetToRow     JSON tweet to MySQL row tweet correspondence
                             (see help file for more info)
                             [Default: DEFAULT_TWEET_JSON_SQL_CORR]
@@ -95,6 +367,42 @@ class TwitterMySQL:
                             [Default: DEFAULT_MYSQL_COL_DESC]
           - host            host where the MySQL database is on
                             [Default: localhost]
+          - poolSize        maximum number of MySQL connections (used by
+                            pipelined writers and parallel table writes)
+                            [Default: MYSQL_POOL_SIZE]
+          - connectFunction function returning a DB-API connection, called
+                            with the MySQL arguments (i.e. to benchmark
+                            with a fake database) [Default: MySQLdb.connect]
+          - checkpointTable table keeping the newest tweet ID per timeline
+                            or search, for checkpoint = True syncs
+                            [Default: table + "_checkpoints"]
+          - sinks           list of sinks the inserted tweets go to as well,
+                            i.e. day partitioned Parquet files (see
+                            sinks.ParquetSink and sinks.TSVSink)
+                            [Default: None]
+          - mysql           set to False to only write to the sinks, MySQL
+                            is then only connected to if it's needed
+                            (checkpoints, ...) [Default: True]
+          - lazyConnect     connect to MySQL on the first query instead of
+                            here, i.e. to start spooling (see the spool
+                            option of tweetsToMySQL) while MySQL is down
+                            [Default: False]
+          - embedded        also insert the retweeted and quoted statuses
+                            that come in tweets, as rows of their own
+                            (no statuses/lookup needed for them later).
+                            Tweets that are in the table already are then
+                            ignored instead of failing inserts
+                            [Default: False]
+          - embeddedTable   table (or monthly tables prefix) the embedded
+                            statuses go to [Default: the table]
+          - partitioned     create tables partitioned by month on
+                            created_time (PARTITION BY RANGE) instead of
+                            using monthly tables: everything goes into the
+                            one table, monthlyTables is ignored, and
+                            partitions are added ahead of time (see
+                            dropPartitions for old ones) [Default: False]
+          - partitionsAhead number of monthly partitions kept ready after
+                            the current month [Default: PARTITIONS_AHEAD]
           - any other MySQL.connect argument
         """
         
@@ -104,7 +412,19 @@ class TwitterMySQL:
         else:
             raise ValueError("Table name missing")
 
-        if "db" not in kwargs:
+        if "mysql" in kwargs:
+            self.mysql = kwargs["mysql"]
+            del kwargs["mysql"]
+        else:
+            self.mysql = True
+
+        if "lazyConnect" in kwargs:
+            lazyConnect = kwargs["lazyConnect"]
+            del kwargs["lazyConnect"]
+        else:
+            lazyConnect = False
+
+        if "db" not in kwargs and self.mysql:
             raise ValueError("You need a MySQL database to connect to")
         
         if "dropIfExists" in kwargs:
@@ -119,6 +439,14 @@ class TwitterMySQL:
         else:
             self.geoLocate = None
 
+        if "geoCache" in kwargs:
+            geoCache = kwargs["geoCache"]
+            del kwargs["geoCache"]
+            if isinstance(geoCache, CachedGeoLocator):
+                self.geoLocate = geoCache
+            elif geoCache and self.geoLocate:
+                self.geoLocate = CachedGeoLocator(self.geoLocate, **(geoCache if isinstance(geoCache, dict) else {}))
+
         if "noWarnings" in kwargs and kwargs["noWarnings"]:
             del kwargs["noWarnings"]
             from warnings import filterwarnings
@@ -129,6 +457,44 @@ class TwitterMySQL:
             del kwargs["errorFile"]
         else:
             self.errorFile = None
+        self._errorStream = None
+
+        if "quiet" in kwargs:
+            self.quiet = kwargs["quiet"]
+            del kwargs["quiet"]
+        else:
+            self.quiet = False
+
+        if "metrics" in kwargs:
+            self.metrics = kwargs["metrics"] if kwargs["metrics"] is not False else NullMetrics()
+            del kwargs["metrics"]
+        else:
+            self.metrics = None
+        self.metrics = self.metrics or Metrics()
+
+        if "reporters" in kwargs:
+            reporters = kwargs["reporters"] or []
+            del kwargs["reporters"]
+        else:
+            reporters = []
+
+        if "poolSize" in kwargs:
+            self.poolSize = kwargs["poolSize"]
+            del kwargs["poolSize"]
+        else:
+            self.poolSize = MYSQL_POOL_SIZE
+
+        if "connectFunction" in kwargs:
+            self._connectFunction = kwargs["connectFunction"]
+            del kwargs["connectFunction"]
+        else:
+            self._connectFunction = MySQLdb.connect
+
+        if "checkpointTable" in kwargs:
+            self.checkpointTable = kwargs["checkpointTable"]
+            del kwargs["checkpointTable"]
+        else:
+            self.checkpointTable = self.table + "_checkpoints"
 
         if "jTweetToRow" in kwargs:
             self.jTweetToRow = kwargs["jTweetToRow"]
@@ -160,7 +526,64 @@ class TwitterMySQL:
                             for f in self.columns_description
                             if f.split(' ')[0][:5] != "index"]
 
-        if "api" in kwargs:
+        self._compileRowMapping()
+
+        if (isinstance(self.geoLocate, CachedGeoLocator) and self.geoLocate.gridSize
+            and "coordinates_address" in self._coordinatesIndices):
+            self._warn("The gridSize of the geolocation cache is of no use with a coordinates_address column,"
+                       + " the grid only knows states")
+
+        if "embedded" in kwargs:
+            self.embedded = kwargs["embedded"]
+            del kwargs["embedded"]
+        else:
+            self.embedded = False
+
+        if "embeddedTable" in kwargs:
+            self.embeddedTable = kwargs["embeddedTable"]
+            del kwargs["embeddedTable"]
+        else:
+            self.embeddedTable = None
+
+        if "partitioned" in kwargs:
+            self.partitioned = kwargs["partitioned"]
+            del kwargs["partitioned"]
+        else:
+            self.partitioned = False
+
+        if "partitionsAhead" in kwargs:
+            self.partitionsAhead = kwargs["partitionsAhead"]
+            del kwargs["partitionsAhead"]
+        else:
+            self.partitionsAhead = PARTITIONS_AHEAD
+
+        if self.partitioned and "created_time" not in self.columns:
+            raise ValueError("Partitioned tables need a created_time column to be partitioned on")
+
+        if self.embedded and "message_id" not in self.columns:
+            raise ValueError("Embedded statuses need a message_id column, to tell them apart from the tweets")
+
+        if "sinks" in kwargs:
+            self.sinks = kwargs["sinks"] or []
+            del kwargs["sinks"]
+        else:
+            self.sinks = []
+        for sink in self.sinks:
+            sink.bind(self.columns, self.columns_description)
+
+        if "keysFile" in kwargs:
+            kwargs["credentials"] = readKeysFile(kwargs["keysFile"])
+            del kwargs["keysFile"]
+        if "credentials" in kwargs:
+            kwargs["apis"] = [TwitterAPI(*[keys[k] for k in KEY_NAMES]) for keys in kwargs["credentials"]]
+            del kwargs["credentials"]
+
+        apis = None
+        if "apis" in kwargs:
+            apis = kwargs["apis"]
+            self._api = apis[0]
+            del kwargs["apis"]
+        elif "api" in kwargs:
             self._api = kwargs["api"]
             del kwargs["api"]
         elif ("API_KEY" in kwargs and
@@ -171,28 +594,111 @@ class TwitterMySQL:
             del kwargs["API_KEY"], kwargs["API_SECRET"], kwargs["ACCESS_TOKEN"], kwargs["ACCESS_SECRET"]
         else:
             raise ValueError("TwitterAPI object or API_KEY, API_SECRET, ACCESS_TOKEN, ACCESS_SECRET needed to connect to Twitter. Please see dev.twitter.com for the keys.")
+        # Each set of keys has its own rate limits
+        self._credentials = CredentialPool(apis or [self._api], self._waitForRateLimit, TWT_REST_WAIT)
 
         if not "charset" in kwargs:
             kwargs["charset"] = 'utf8'
 
-        try:
-            self._connect(kwargs)
-        except TypeError as e:
-            print "You're probably using the wrong keywords, here's a list:\n"+self.__init__.__doc__
-            raise TypeError(e)
+        # Each thread gets its own MySQL connection (see cur)
+        self._local = threading.local()
+        self._ddlLock = threading.RLock()
+        # Tables known to exist, so that inserts don't need a SHOW TABLES
+        self._knownTables = set()
+        # Months of the partitions of partitioned tables, {table: set(["YYYY_MM", ...])}
+        self._partitions = {}
+        # While deferring indices, the tables written to (see _withDeferredIndexes)
+        self._deferIndexes = False
+        self._deferredTables = set()
+        # Set by stop(), shared with the copies made by forTable
+        self._stopped = threading.Event()
+
+        if self.mysql and not lazyConnect:
+            try:
+                self._connect(kwargs)
+            except TypeError as e:
+                print "You're probably using the wrong keywords, here's a list:\n"+self.__init__.__doc__
+                raise TypeError(e)
+        else:
+            # Files only (or lazyConnect), the connection is made if ever it's needed (see cur)
+            self._SQLconnectKwargs = kwargs
+            self._pool = ConnectionPool(self._connectFunction, kwargs, self.poolSize)
+
+        # Counters kept elsewhere
+        self.metrics.gauge("mysql_connects", lambda: self._pool.nbConnects)
+        self.metrics.gauge("mysql_reconnects", lambda: self._pool.nbReconnects)
+        self.metrics.gauge("rate_limit_waits", lambda: self._credentials.nbWaits)
+        self.metrics.gauge("rate_limit_wait_seconds", lambda: self._credentials.waited)
+        for reporter in reporters:
+            reporter.start(self.metrics)
 
     def _connect(self, kwargs = None):
-        """Connecting to MySQL sometimes has to be redone"""
+        """
+        Connecting to MySQL sometimes has to be redone.
+        Connections come from a pool, one per thread; calling this again
+        from a thread that has one replaces it with a fresh connection.
+        """
         if kwargs:
             self._SQLconnectKwargs = kwargs
-        elif not kwargs and self._SQLconnectKwargs:
-            kwargs = self._SQLconnectKwargs
+            self._pool = ConnectionPool(self._connectFunction, kwargs, self.poolSize)
+
+        connection = getattr(self._local, "connection", None)
+        # Nothing to give back to the pool if connecting fails
+        self._local.connection, self._local.cur = (None, None)
+        if connection:
+            connection = self._pool.replace(connection)
+        else:
+            connection = self._pool.acquire()
+        self._local.connection = connection
+        self._local.cur = connection.cursor()
 
-        self._connection = MySQLdb.connect(**kwargs)
-        self.cur = self._connection.cursor()
+    def _disconnect(self):
+        """Gives the current thread's connection back to the pool"""
+        if getattr(self._local, "connection", None):
+            self._pool.release(self._local.connection)
+        self._local.connection, self._local.cur = (None, None)
+
+    def _reconnectIfLost(self, e):
+        """
+        Health check after a failed query: replaces the current connection
+        if MySQL says it's gone or if it doesn't answer a ping.
+        If MySQL can't be reached, the thread is left without a connection,
+        the query's next attempt connects again.
+        """
+        connection = getattr(self._local, "connection", None)
+        if _mysqlErrorCode(e) in MYSQL_ERR_CONNECTION_LOST or not connection or not self._pool.isAlive(connection):
+            try:
+                self._connect()
+            except tuple(MYSQL_ERRORS) as connectError:
+                self._warn("Couldn't reconnect to MySQL [%s]" % str(connectError))
+                return False
+            return True
+        return False
+
+    @property
+    def _connection(self):
+        if not getattr(self._local, "connection", None):
+            self._connect()
+        return self._local.connection
+
+    @property
+    def cur(self):
+        """MySQL cursor of the current thread, connects if needed"""
+        if not getattr(self._local, "cur", None):
+            self._connect()
+        return self._local.cur
+
+    def _failFast(self, e):
+        """
+        When spooling (see _flushSpooled), MySQL being unavailable isn't
+        retried: the rows are safe in the spool, the stream goes on
+        """
+        return (getattr(self._local, "raiseErrors", False) and isinstance(e, tuple(MYSQL_OPERATIONAL_ERRORS))
+                and _mysqlErrorCode(e) != MYSQL_ERR_NO_SUCH_TABLE)
 
     def _wait(self, t, verbose = True):
         """Wait function, offers a nice countdown"""
+        verbose = verbose and not self.quiet
         for i in xrange(t):
             if verbose:
                 print "\rDone waiting in: %s" % datetime.timedelta(seconds=(t-i)),
@@ -201,43 +707,63 @@ class TwitterMySQL:
         if verbose:
             print "\rDone waiting!           "
         
-    def _execute(self, query, nbAttempts = 0, verbose = True):
+    def _waitForRateLimit(self, t):
+        """Only the main thread gets a countdown, the harvesting threads would garble it"""
+        self._wait(int(math.ceil(t)), threading.current_thread().name == "MainThread")
+
+    def _execute(self, query, nbAttempts = 0, verbose = True, args = None):
         if nbAttempts >= MAX_MYSQL_ATTEMPTS:
+            if getattr(self._local, "raiseErrors", False):
+                raise QueryFailed("Too many attempts to execute the query [%s]" % query[:300])
             self._warn("Too many attempts to execute the query, moving on from this [%s]" % query[:300])
             return 0
         
-        if verbose: print "SQL:\t%s" % query[:200]
+        if verbose and not self.quiet: print "SQL:\t%s" % query[:200]
 
         try:
-            ret = self.cur.execute(query)
+            ret = self.cur.execute(query, args)
         except Exception as e:
-            if "MySQL server has gone away" in str(e):
-                self._connect()
+            self._reconnectIfLost(e)
+            if self._failFast(e):
+                raise
             nbAttempts += 1
-            if not verbose: print "SQL:\t%s" % query[:200]
+            self.metrics.inc("mysql_retries")
+            if not verbose and not self.quiet: print "SQL:\t%s" % query[:200]
             self._warn("%s [Attempt: %d]" % (str(e), nbAttempts))
             self._wait(nbAttempts * 2)
-            ret = self._execute(query, nbAttempts, False)
+            ret = self._execute(query, nbAttempts, False, args)
         
         return ret
 
-    def _executemany(self, query, values, nbAttempts = 0, verbose = True):
+    def _executemany(self, query, values, nbAttempts = 0, verbose = True, table = None):
+        """
+        If table is given and turns out not to exist anymore,
+        it is recreated before trying again.
+        """
         if nbAttempts >= MAX_MYSQL_ATTEMPTS:
+            if getattr(self._local, "raiseErrors", False):
+                raise QueryFailed("Too many attempts to execute the query [%s]" % query[:300])
             self._warn("Too many attempts to execute the query, moving on from this [%s]" % query[:300])
             return 0
 
-        if verbose: print "SQL:\t%s" % query[:200]
+        if verbose and not self.quiet: print "SQL:\t%s" % query[:200]
         ret = None
         try:
             ret = self.cur.executemany(query, values)
         except Exception as e:
-            if "MySQL server has gone away" in str(e):
-                self._connect()
+            self._reconnectIfLost(e)
+            if self._failFast(e):
+                raise
             nbAttempts += 1
-            if not verbose: print "SQL:\t%s" % query[:200]
+            self.metrics.inc("mysql_retries")
+            if not verbose and not self.quiet: print "SQL:\t%s" % query[:200]
             self._warn("%s [Attempt: %d]" % (str(e), nbAttempts))
-            self._wait(nbAttempts * 2)
-            ret = self._executemany(query, values, nbAttempts, False)
+            if table and _mysqlErrorCode(e) == MYSQL_ERR_NO_SUCH_TABLE:
+                self._knownTables.discard(table)
+                self._ensureTable(table)
+            else:
+                self._wait(nbAttempts * 2)
+            ret = self._executemany(query, values, nbAttempts, False, table)
 
         return ret
     
@@ -255,10 +781,11 @@ class TwitterMySQL:
         # Checking if table exists
         SQL = """show tables like '%s'""" % table
         self._execute(SQL)
-        SQL = """create table %s (%s)""" % (table, ', '.join(self.columns_description))
+        SQL = self._createTableSQL(table)
         if not self.cur.fetchall():
             # Table doesn't exist
             self._execute(SQL)
+            self._knownTables.add(table)
         else:
             # table does exist
             if not self.dropIfExists:
@@ -273,7 +800,307 @@ class TwitterMySQL:
             SQL_DROP = """drop table %s""" % table
             self._execute(SQL_DROP)
             self._execute(SQL)
-            
+            self._knownTables.add(table)
+        if self._deferIndexes:
+            # Created without its secondary indices (i.e. next month's,
+            # see _precreateNextMonth), buildIndexes has to get to it too
+            self._deferredTables.add(table)
+        if self.partitioned:
+            self._partitions[table] = set(self._initialPartitions())
+
+    def _createTableSQL(self, table):
+        """
+        CREATE TABLE statement of table. Partitioned tables have a p0
+        partition for anything older than their months and a pmax one for
+        anything newer, both kept empty by adding months as needed (see
+        _ensurePartitions). MySQL wants created_time in the primary key then.
+        """
+        columnsDescription = self.columns_description
+        if self._deferIndexes:
+            # Added by buildIndexes once the table is loaded
+            columnsDescription = [d for d in columnsDescription if not SECONDARY_INDEX.match(d)]
+        if not self.partitioned:
+            return """create table %s (%s)""" % (table, ', '.join(columnsDescription))
+        description = []
+        keys = []
+        for d in columnsDescription:
+            if d.lower().startswith("primary key"):
+                keys.extend(c.strip() for c in d[d.index("(")+1:d.rindex(")")].split(","))
+            elif re.search(r"\sprimary key\b", d, re.I):
+                description.append(re.sub(r"\s+primary key\b", "", d, flags = re.I))
+                keys.append(d.split()[0])
+            else:
+                description.append(d)
+        if keys:
+            if "created_time" not in keys:
+                keys.append("created_time")
+            description.append("primary key (%s)" % ", ".join(keys))
+        months = self._initialPartitions()
+        partitions = (["PARTITION p0 VALUES LESS THAN (TO_DAYS('%s-01'))" % months[0].replace("_", "-")]
+                      + [_partitionDefinition(month) for month in months]
+                      + ["PARTITION pmax VALUES LESS THAN MAXVALUE"])
+        return """create table %s (%s) partition by range (to_days(created_time)) (%s)""" % (
+            table, ', '.join(description), ', '.join(partitions))
+
+    def _initialPartitions(self):
+        now = datetime.datetime.utcnow().strftime("%Y_%m")
+        return _monthRange(now, _addMonths(now, self.partitionsAhead))
+
+    def _partitionMonths(self, table):
+        """
+        Months of the partitions of table, None if it isn't partitioned
+        the way createTable does (i.e. it was there before), asked to
+        MySQL only the first time
+        """
+        if table not in self._partitions:
+            SQL = """select partition_name from information_schema.partitions
+                     where table_schema = database() and table_name = %s"""
+            self._execute(SQL, verbose = False, args = [table])
+            names = [row[0] for row in self.cur.fetchall() if row[0]]
+            if "p0" in names and "pmax" in names:
+                self._partitions[table] = set("%s_%s" % PARTITION_NAME.match(name).groups()
+                                              for name in names if PARTITION_NAME.match(name))
+            else:
+                self._warn("Table %s isn't partitioned by month, its partitions won't be managed" % table)
+                self._partitions[table] = None
+        return self._partitions[table]
+
+    def _ensurePartitions(self, table, months):
+        """
+        Adds the partitions of months (and of the next partitionsAhead
+        months) that table doesn't have yet, by splitting pmax (or p0, for
+        backfills). Those are empty, so no rows are moved around.
+        """
+        known = self._partitionMonths(table)
+        if known is None:
+            return
+        now = datetime.datetime.utcnow().strftime("%Y_%m")
+        months = set(months)
+        months.add(_addMonths(now, self.partitionsAhead))
+        if months <= known:
+            return
+        with self._ddlLock:
+            first, last = (min(known), max(known))
+            if max(months) > last:
+                newer = _monthRange(_addMonths(last, 1), max(months))
+                SQL = "ALTER TABLE %s REORGANIZE PARTITION pmax INTO (%s)" % (
+                    table, ", ".join([_partitionDefinition(month) for month in newer]
+                                     + ["PARTITION pmax VALUES LESS THAN MAXVALUE"]))
+                self._execute(SQL, verbose = False)
+                known.update(newer)
+            if min(months) < first:
+                older = _monthRange(min(months), _addMonths(first, -1))
+                SQL = "ALTER TABLE %s REORGANIZE PARTITION p0 INTO (%s)" % (
+                    table, ", ".join(["PARTITION p0 VALUES LESS THAN (TO_DAYS('%s-01'))" % older[0].replace("_", "-")]
+                                     + [_partitionDefinition(month) for month in older]))
+                self._execute(SQL, verbose = False)
+                known.update(older)
+
+    def _withDeferredIndexes(self, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs) creating tables without their
+        secondary indices, then builds the indices of the tables it wrote
+        to. If it fails, they're built by the next run (or buildIndexes).
+        """
+        if self._deferIndexes:
+            return function(*args, **kwargs)
+        self._deferIndexes = True
+        self._deferredTables.clear()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            self._deferIndexes = False
+        self.buildIndexes(sorted(self._deferredTables))
+        return result
+
+    def buildIndexes(self, tables = None, monthlyTables = False):
+        """
+        Adds the secondary indices of the column description (i.e. index
+        useriddex (user_id)) that tables don't have (see SHOW INDEX), all of
+        a table's in a single ALTER TABLE so that it's only read once.
+        Tables default to the table, or with monthlyTables, all of its
+        monthly tables. Running it again resumes an interrupted build.
+        Returns the number of indices added.
+        """
+        if tables is None:
+            tables = [self.table]
+            if monthlyTables:
+                self._execute("SHOW TABLES LIKE '%s\\_%%'" % self.table, verbose = False)
+                monthly = re.compile(r"^%s_\d{4}_\d{2}$" % re.escape(self.table))
+                tables = sorted(row[0] for row in self.cur.fetchall() if monthly.match(row[0]))
+        indexes = [d for d in self.columns_description if SECONDARY_INDEX.match(d)]
+        nbAdded = 0
+        for table in tables:
+            if not indexes or not self._tableExists(table):
+                continue
+            self._execute("SHOW INDEX FROM %s" % table, verbose = False)
+            existing = set(row[2].lower() for row in self.cur.fetchall())
+            # Unnamed indices are named after their first column
+            missing = [d for d in indexes
+                       if (SECONDARY_INDEX.match(d).group(1) or d[d.index("(")+1:].split(",")[0].split("(")[0].strip(" )`")).lower()
+                       not in existing]
+            if not missing:
+                continue
+            start = time.time()
+            self._log("Building %d indices on %s" % (len(missing), table))
+            self._execute("ALTER TABLE %s %s" % (table, ", ".join("ADD " + d for d in missing)))
+            nbAdded += len(missing)
+            self._log("Built the indices of %s in %.1fs" % (table, time.time() - start))
+        return nbAdded
+
+    def dropPartitions(self, before, table = None, archive = False):
+        """
+        Gets rid of the monthly partitions of table older than before
+        ('YYYY_MM'), which is instantaneous unlike a DELETE. The newest
+        partition is always kept.
+        With archive = True, each of them is first swapped (EXCHANGE
+        PARTITION, nothing is copied) into a table of its own, named like
+        monthlyTables would (table_YYYY_MM).
+        Returns the months that were dropped.
+        """
+        table = self.table if not table else table
+        known = self._partitionMonths(table)
+        if not known:
+            return []
+        months = sorted(month for month in known if month < before)[:len(known) - 1]
+        if not months:
+            return []
+        if archive:
+            existing = [table+"_"+month for month in months if self._tableExists(table+"_"+month)]
+            if existing:
+                raise ValueError("Can't archive partitions into tables that exist already: %s" % ", ".join(existing))
+        with self._ddlLock:
+            names = ["p" + month.replace("_", "") for month in months]
+            if archive:
+                for month, name in zip(months, names):
+                    archiveTable = table+"_"+month
+                    self._execute("CREATE TABLE %s LIKE %s" % (archiveTable, table))
+                    self._execute("ALTER TABLE %s REMOVE PARTITIONING" % archiveTable)
+                    self._execute("ALTER TABLE %s EXCHANGE PARTITION %s WITH TABLE %s" % (table, name, archiveTable))
+                    self._knownTables.add(archiveTable)
+            self._execute("ALTER TABLE %s TRUNCATE PARTITION %s" % (table, ", ".join(names)))
+            # p0 takes over their (empty) range, so that backfills still work
+            SQL = "ALTER TABLE %s REORGANIZE PARTITION %s INTO (PARTITION p0 VALUES LESS THAN (TO_DAYS('%s-01')))" % (
+                table, ", ".join(["p0"] + names), _addMonths(months[-1], 1).replace("_", "-"))
+            self._execute(SQL)
+            known.difference_update(months)
+        return months
+
+    def _ensureTable(self, table):
+        """
+        Creates table if it doesn't exist yet. Tables that were seen before
+        are remembered, so this only hits MySQL once per table
+        (or when an insert finds out the table is gone).
+        """
+        if table in self._knownTables:
+            return
+        with self._ddlLock:
+            if not self._tableExists(table):
+                self.createTable(table)
+
+    def _tableExists(self, table):
+        if table in self._knownTables:
+            return True
+        EXISTS = "SHOW TABLES LIKE '%s'" % table
+        if self._execute(EXISTS, verbose = False):
+            self._knownTables.add(table)
+            return True
+        return False
+
+    def existingIds(self, ids, monthlyTables = False):
+        """
+        Returns the set of the tweet IDs of ids that are in the table
+        already (checked in bulk). With monthlyTables, each ID is looked
+        for in the monthly table of its (snowflake) timestamp.
+        """
+        if "message_id" not in self.columns:
+            return set()
+        byTable = {}
+        for tweetId in ids:
+            if monthlyTables:
+                created = snowflakeToMysql(tweetId)
+                if not created:
+                    continue
+                table = self.table+"_"+self._yearMonth(created)
+            else:
+                table = self.table
+            byTable.setdefault(table, []).append(long(tweetId))
+
+        existing = set()
+        for table, tableIds in byTable.iteritems():
+            if not self._tableExists(table):
+                continue
+            for i in xrange(0, len(tableIds), BULK_INSERT_CHUNK):
+                SQL = "SELECT message_id FROM %s WHERE message_id IN (%s)" % (
+                    table, ", ".join(str(tweetId) for tweetId in tableIds[i:i+BULK_INSERT_CHUNK]))
+                self._execute(SQL, verbose = False)
+                existing.update(long(row[0]) for row in self.cur.fetchall())
+        return existing
+
+    def seedIdFilter(self, idFilter, monthlyTables = False, limit = DEDUP_SEED):
+        """
+        Gives idFilter (see dedup.RecentIdFilter) the newest limit tweet IDs
+        of the table (with monthlyTables, of this month's and last month's
+        tables), so that the tweets written before a restart are known
+        duplicates. Reads the primary key only, newest first.
+        """
+        tables = [self.table]
+        if monthlyTables:
+            now = datetime.datetime.utcnow()
+            lastMonth = now.replace(day = 1) - datetime.timedelta(days = 1)
+            tables = [self.table+"_"+lastMonth.strftime("%Y_%m"), self.table+"_"+now.strftime("%Y_%m")]
+        ids = []
+        if self.mysql and "message_id" in self.columns:
+            for table in tables:
+                if not self._tableExists(table):
+                    continue
+                SQL = "SELECT message_id FROM %s ORDER BY message_id DESC LIMIT %d" % (table, limit)
+                self._execute(SQL, verbose = False)
+                # Oldest first, so that they're forgotten first
+                ids.extend(reversed([row[0] for row in self.cur.fetchall()]))
+        idFilter.seed(ids)
+        self._log("Dedup filter seeded with %d tweet IDs" % len(ids))
+        return len(ids)
+
+    def _ensureCheckpointTable(self):
+        """The checkpoint table is never dropped, it's what makes syncs incremental"""
+        if self.checkpointTable in self._knownTables:
+            return
+        with self._ddlLock:
+            SQL = """create table if not exists %s (%s)""" % (self.checkpointTable, ', '.join(CHECKPOINT_COL_DESC))
+            self._execute(SQL, verbose = False)
+            self._knownTables.add(self.checkpointTable)
+
+    def loadCheckpoints(self, endpoint, queries = None):
+        """
+        Returns {query: since_id} for the checkpoints of endpoint
+        (i.e. 'statuses/user_timeline'), all of them or only queries
+        (see checkpointQuery)
+        """
+        self._ensureCheckpointTable()
+        SQL = """select query, since_id from %s where endpoint = %%s""" % self.checkpointTable
+        args = [endpoint]
+        if queries is not None:
+            queries = list(queries)
+            if not queries:
+                return {}
+            SQL += " and query in (%s)" % ", ".join(["%s"] * len(queries))
+            args.extend(queries)
+        self._execute(SQL, verbose = False, args = args)
+        return dict((query, long(sinceId)) for query, sinceId in self.cur.fetchall())
+
+    def saveCheckpoints(self, endpoint, checkpoints):
+        """
+        Stores {query: newest tweet ID} for endpoint, checkpoints
+        only ever move forward
+        """
+        if not checkpoints:
+            return 0
+        self._ensureCheckpointTable()
+        SQL = """insert into %s (endpoint, query, since_id, updated_time) values (%%s, %%s, %%s, utc_timestamp())
+                 on duplicate key update since_id = greatest(since_id, values(since_id)), updated_time = values(updated_time)""" % self.checkpointTable
+        return self._executemany(SQL, [(endpoint, query, sinceId) for query, sinceId in checkpoints.iteritems()], verbose = False)
+
     def insertRow(self, row, table = None, columns = None, verbose = True):
         """Inserts a row into the table specified using an INSERT SQL statement"""
         return self.insertRows([row], table, columns, verbose)
@@ -287,88 +1114,235 @@ class TwitterMySQL:
         table = self.table if not table else table
         columns = self.columns if not columns else columns
 
-        EXISTS = "SHOW TABLES LIKE '%s'" % table
-        if not self._execute(EXISTS, verbose = False): self.createTable(table)
+        self._ensureTable(table)
 
         SQL = "INSERT INTO %s (%s) VALUES (%s)" % (table,
                                                    ', '.join(columns),
                                                    ', '.join("%s" for r in rows[0]))
-        return self._executemany(SQL, rows, verbose = verbose)
+        return self._executemany(SQL, rows, verbose = verbose, table = table)
 
     def replaceRows(self, rows, table = None, columns = None, verbose = True):
         """Inserts multiple rows into the table specified using a REPLACE SQL statement"""
         table = self.table if not table else table
         columns = self.columns if not columns else columns
         
-        EXISTS = "SHOW TABLES LIKE '%s'" % table
-        if not self._execute(EXISTS, verbose = False): self.createTable(table)
+        self._ensureTable(table)
 
         SQL = "REPLACE INTO %s (%s) VALUES (%s)" % (table,
                                                     ', '.join(columns),
                                                     ', '.join("%s" for r in rows[0]))
-        return self._executemany(SQL, rows, verbose = verbose)
+        return self._executemany(SQL, rows, verbose = verbose, table = table)
+
+    def upsertRows(self, rows, table = None, columns = None, updateColumns = (), verbose = True):
+        """
+        Inserts multiple rows into the table specified, rows that are there
+        already only get their updateColumns updated (INSERT ... ON
+        DUPLICATE KEY UPDATE), or are left alone if there are none (INSERT
+        IGNORE). Unlike REPLACE, rows that are there aren't deleted and
+        inserted again with all their indices.
+        """
+        table = self.table if not table else table
+        columns = self.columns if not columns else columns
+        self._ensureTable(table)
+
+        SQL = "%s INTO %s (%s) VALUES (%s)" % ("INSERT" if updateColumns else "INSERT IGNORE",
+                                               table,
+                                               ', '.join(columns),
+                                               ', '.join("%s" for c in columns))
+        if updateColumns:
+            SQL += " ON DUPLICATE KEY UPDATE %s" % ", ".join("%s = VALUES(%s)" % (c, c) for c in updateColumns)
+        # MySQLdb's executemany turns this into multi-row statements
+        return sum(self._executemany(SQL, rows[i:i+BULK_INSERT_CHUNK], verbose = verbose, table = table) or 0
+                   for i in xrange(0, len(rows), BULK_INSERT_CHUNK))
+
+    def bulkLoadRows(self, rows, table = None, columns = None, replace = False, verbose = True):
+        """
+        Inserts multiple rows into the table specified by writing them to a
+        temporary TSV file and running LOAD DATA LOCAL INFILE, which is a lot
+        faster than INSERT for large amounts of rows.
+        Duplicate keys are replaced if replace = True, ignored otherwise.
+        LOCAL INFILE has to be allowed by the client, connect with
+        local_infile = 1 (see __init__), otherwise, or if the server
+        doesn't allow it on the current connection, falls back to
+        multi-row INSERT/REPLACE statements of BULK_INSERT_CHUNK rows.
+        replace can also be the columns to update on duplicate keys (see
+        upsertRows), which LOAD DATA can't do, so multi-row statements are
+        used then.
+        """
+        table = self.table if not table else table
+        columns = self.columns if not columns else columns
+        if isinstance(replace, tuple) and replace:
+            return self.upsertRows(rows, table, columns, replace, verbose)
+        self._ensureTable(table)
+
+        refused = getattr(self._local, "localInfileRefused", None)
+        if self._SQLconnectKwargs.get("local_infile") and (refused is None or refused is not getattr(self._local, "connection", None)):
+            with tempfile.NamedTemporaryFile(prefix = "TwitterMySQL_%s_" % table, suffix = ".tsv") as tsv:
+                for row in rows:
+                    tsv.write("\t".join(_tsvField(v) for v in row))
+                    tsv.write("\n")
+                tsv.flush()
+
+                SQL = """LOAD DATA LOCAL INFILE '%s' %s INTO TABLE %s CHARACTER SET utf8 (%s)""" % (
+                    tsv.name.replace("\\", "\\\\").replace("'", "\\'"),
+                    "REPLACE" if replace else "IGNORE",
+                    table, ', '.join(columns))
+                if verbose and not self.quiet: print "SQL:\t%s" % SQL[:200]
+                try:
+                    return self.cur.execute(SQL)
+                except Exception as e:
+                    if _mysqlErrorCode(e) not in MYSQL_ERR_LOCAL_INFILE_DISABLED:
+                        self._warn("%s [Attempt: 1]" % str(e))
+                        if _mysqlErrorCode(e) == MYSQL_ERR_NO_SUCH_TABLE:
+                            self._knownTables.discard(table)
+                            self._ensureTable(table)
+                        return self._execute(SQL, 1, False)
+                    self._warn("LOAD DATA LOCAL INFILE isn't allowed, using multi-row inserts on this connection instead [%s]" % str(e))
+                    # Other connections (and the next one of this thread) still try
+                    self._local.localInfileRefused = self._local.connection
+
+        SQL = "%s INTO %s (%s) VALUES (%s)" % ("REPLACE" if replace else "INSERT IGNORE",
+                                               table,
+                                               ', '.join(columns),
+                                               ', '.join("%s" for c in columns))
+        # MySQLdb's executemany turns this into a single multi-row statement
+        return sum(self._executemany(SQL, rows[i:i+BULK_INSERT_CHUNK], verbose = verbose, table = table) or 0
+                   for i in xrange(0, len(rows), BULK_INSERT_CHUNK))
 
     # modify this as necessaary if I get a time in a format different than what is expected
-    def _tweetTimeToMysql(self, timestr, parseFormat = '%a %b %d %H:%M:%S +0000 %Y'):
+    def _tweetTimeToMysql(self, timestr, parseFormat = TWITTER_TIME_FORMAT):
         # Mon Jan 25 05:02:27 +0000 2010
+        if parseFormat == TWITTER_TIME_FORMAT:
+            parsed = _parseTweetTime(timestr)
+            if parsed:
+                return parsed[0]
         return str(time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(timestr, parseFormat)))
 
     def _yearMonth(self, mysqlTime):
+        # Times made by _tweetTimeToMysql just need slicing,
+        # anything else goes through strptime (and its errors)
+        if MYSQL_TIME.match(mysqlTime) and mysqlTime[8:10] <= "28":
+            return mysqlTime[:4] + "_" + mysqlTime[5:7]
         return time.strftime("%Y_%m",time.strptime(mysqlTime,"%Y-%m-%d %H:%M:%S"))
 
-    # TODO - what is JTweet?  What type of object, one tweet or all the tweets?
-    def _prepTweet(self, jTweet):
-        
-        tweet = {}
+    def _sourceToText(self, source):
+        try:
+            return ET.fromstring(re.sub("&", "&amp;", source)).text
+        except Exception as e:
+            raise NotImplementedError("OOPS", type(e), e, [source])
 
-        for SQLcol in self.columns:
-            try:
-                if SQLcol in self.jTweetToRow:
-                    try:
-                        tweet[SQLcol] = eval("jTweet%s" % self.jTweetToRow[SQLcol])
-                    except TypeError:
-                        _warn("Column %s not found in JSON object" % SQLcol)
-                        tweet[SQLcol]
-                    if isinstance(tweet[SQLcol], str) or isinstance(tweet[SQLcol], unicode):
-                        tweet[SQLcol] = HTMLParser().unescape(tweet[SQLcol]).encode("utf-8")
-                    if SQLcol == "created_time":
-                        tweet[SQLcol] = self._tweetTimeToMysql(tweet[SQLcol])
-                    if SQLcol == "source":
-                        try:
-                            tweet[SQLcol] = ET.fromstring(re.sub("&", "&amp;", tweet[SQLcol])).text
-                        except Exception as e:
-                            raise NotImplementedError("OOPS", type(e), e, [tweet[SQLcol]])
-                else:
-                    tweet[SQLcol] = None
-            except KeyError:
-                tweet[SQLcol] = None
+    def _compileRowMapping(self):
+        """
+        Parses the jTweetToRow correspondence once, so that _prepTweet
+        doesn't have to eval() every column of every tweet.
+        self._rowMapping holds one (extract, postProcess) pair per column,
+        in the order of self.columns (extract is None if the column isn't
+        in jTweetToRow).
+        """
+        postProcessors = {"created_time": self._tweetTimeToMysql,
+                          "source": self._sourceToText}
+        self._unescape = HTMLParser().unescape
+        for SQLcol in INTERNED_COLUMNS:
+            postProcessors[SQLcol] = self._interner(postProcessors.get(SQLcol))
+        self._rowMapping = [(_compileJTweetPath(self.jTweetToRow[SQLcol]) if SQLcol in self.jTweetToRow else None,
+                             postProcessors.get(SQLcol))
+                            for SQLcol in self.columns]
+        self._createdTimeIndex = self.columns.index("created_time") if "created_time" in self.columns else None
+        self._coordinatesIndices = dict((SQLcol, self.columns.index(SQLcol))
+                                        for SQLcol in ("coordinates", "coordinates_state", "coordinates_address")
+                                        if SQLcol in self.columns)
+
+    def _interner(self, postProcess = None):
+        """postProcess, whose result is interned (one string shared by all rows)"""
+        def process(value):
+            if postProcess:
+                value = postProcess(value)
+            return intern(value) if type(value) is str else value
+        return process
 
-        if not any(tweet.values()):
+    def _prepTweet(self, jTweet):
+        """Turns a JSON tweet (dictionary) into a row tuple, ordered like self.columns"""
+        start = time.time()
+        unescape = self._unescape
+        tweet = []
+        for extract, postProcess in self._rowMapping:
+            value = extract(jTweet) if extract else None
+            if value is not None:
+                if isinstance(value, basestring):
+                    value = unescape(value).encode("utf-8")
+                if postProcess:
+                    value = postProcess(value)
+            tweet.append(value)
+
+        if not any(tweet):
             raise NotImplementedError("OOPS", jTweet, tweet)
 
+        if self._createdTimeIndex is not None and tweet[self._createdTimeIndex] is None and jTweet.get("id_str"):
+            # No created_at, the tweet ID has the time in it too
+            tweet[self._createdTimeIndex] = snowflakeToMysql(jTweet["id_str"])
+
         # Coordinates state and address
-        if "coordinates" in jTweet and jTweet["coordinates"]:
+        if self._coordinatesIndices and jTweet.get("coordinates"):
             lon, lat = map(lambda x: float(x), jTweet["coordinates"]["coordinates"])
             if self.geoLocate:
-                (state, address) = self.geoLocate(lat, lon)
+                geoStart = time.time()
+                if "coordinates_address" in self._coordinatesIndices or not isinstance(self.geoLocate, CachedGeoLocator):
+                    (state, address) = self.geoLocate(lat, lon)
+                else:
+                    # Only the state goes in the table, the grid index can answer that
+                    (state, address) = (self.geoLocate.state(lat, lon), None)
+                self.metrics.observe("geolocate_seconds", time.time() - geoStart)
             else:
                 (state, address) = (None, None)
-            tweet["coordinates"] = str(jTweet["coordinates"]["coordinates"])
-            tweet["coordinates_state"] = str(state) if state else None
-            tweet["coordinates_address"] = str(address) if address else str({"lon": lon, "lat": lat})
-        
-        # Tweet is dictionary of depth one, now has to be linearized
-        tweet = [tweet[SQLcol] for SQLcol in self.columns]
-        
-        return tweet
-    
-    def _apiRequest(self, twitterMethod, params):
+            coordinates = {"coordinates": str(jTweet["coordinates"]["coordinates"]),
+                           "coordinates_state": str(state) if state else None,
+                           "coordinates_address": str(address) if address else str({"lon": lon, "lat": lat})}
+            for SQLcol, i in self._coordinatesIndices.iteritems():
+                tweet[i] = coordinates[SQLcol]
+
+        self.metrics.observe("prep_seconds", time.time() - start)
+        return tuple(tweet)
+
+    def _prepEmbedded(self, jTweet):
+        """
+        Rows of the statuses that came in jTweet (see EMBEDDED_STATUS_KEYS,
+        i.e. the status quoted by a retweeted status too), as EmbeddedRows
+        """
+        rows = []
+        seen = set()
+        statuses = [jTweet]
+        while statuses:
+            status = statuses.pop()
+            for key in EMBEDDED_STATUS_KEYS:
+                embedded = status.get(key)
+                if isinstance(embedded, dict) and embedded.get("id_str") and embedded["id_str"] not in seen:
+                    seen.add(embedded["id_str"])
+                    statuses.append(embedded)
+                    if not embedded.get("created_at") or not embedded.get("user"):
+                        # Truncated (i.e. just its ID), its row would be mostly NULL
+                        self.metrics.inc("embedded_truncated")
+                        continue
+                    rows.append(EmbeddedRow(self._prepTweet(embedded)))
+        if rows:
+            self.metrics.inc("embedded_rows", len(rows))
+        return rows
+
+    def _apiRequest(self, twitterMethod, params, ticks = False):
+        """
+        Yields the rows of the tweets of a request (see apiRequest).
+        With ticks, None is yielded for the messages that aren't tweets
+        (i.e. deletes) and on reconnects, for the maxAge of the flush
+        policy to be checked on quiet streams (see _tweetsToMySQL)
+        """
         done = False
         nbAttempts = 0
         
-        while not done and nbAttempts < MAX_TWITTER_ATTEMPTS:
+        while not done and nbAttempts < MAX_TWITTER_ATTEMPTS and not self._stopped.is_set():
+            # Picks the credential with the most quota left, waits for a
+            # rate limit window to reset if they're all used up
+            api, rateLimits = self._credentials.acquire(twitterMethod)
             try:
-                r = self._api.request(twitterMethod, params)
+                r = api.request(twitterMethod, params)
             except Exception as e:
             # If the request doesn't work
                 if "timed out" in str(e).lower():
@@ -378,30 +1352,52 @@ class TwitterMySQL:
                     self._warn("Unknown error encountered: [%s]" % str(e))
                     self._wait(10)
                 nbAttempts += 1
+                self.metrics.inc("twitter_retries")
+                if ticks:
+                    yield None
                 continue
 
             # Request was successful in terms of http connection
+            rateLimits.update(twitterMethod, getattr(r, "headers", None) or {})
+            rateLimited = False
             try:
                 for i, response in enumerate(r.get_iterator()):
                     # Checking for error messages
                     if isinstance(response, int) or "delete" in response:
+                        self.metrics.inc("deletes_skipped")
+                        if ticks:
+                            yield None
                         continue
                     if i == 0 and "message" in response and "code" in response:
                         if response['code'] == 88: # Rate limit exceeded
-                            self._warn("Rate limit exceeded, waiting 15 minutes before a restart")
-                            self._wait(TWT_REST_WAIT)
+                            rateLimits.exhausted(twitterMethod)
+                            self.metrics.inc("rate_limited")
+                            rateLimited = True
+                            break
                         else:
                             self._warn("Error message received from Twitter %s" % str(response))
                         continue
                     
+                    self.metrics.inc("tweets_received")
+                    if self.embedded:
+                        for row in self._prepEmbedded(response):
+                            yield row
                     yield self._prepTweet(response)
+                if rateLimited:
+                    # The request is made again with other keys, or once the window resets
+                    self._warn("Rate limit exceeded for %s, waiting %d seconds before a restart" % (twitterMethod, self._credentials.waitTime(twitterMethod)))
+                    continue
                 done = True
             except ChunkedEncodingError as e:
                 # nbAttempts += 1
                 self._warn("ChunkedEncodingError encountered, reconnecting immediately: [%s]" % e)
+                self.metrics.inc("twitter_reconnects")
+                if ticks:
+                    yield None
                 continue
             except Exception as e:
                 nbAttempts += 1
+                self.metrics.inc("twitter_retries")
                 self._warn("unknown exception encountered, waiting %d second: [%s]" % (nbAttempts * 2, str(e)))
                 self._wait(nbAttempts * 2)
                 continue
@@ -427,62 +1423,481 @@ class TwitterMySQL:
         for response in self._apiRequest(twitterMethod, params):
             yield response
 
-    def _tweetsToMySQL(self, tweetsYielder, replace = False, monthlyTables = False):
+    def _popInsertOptions(self, params):
+        """Takes the insertion options (see INSERT_OPTIONS) out of the request parameters"""
+        options = dict((option, params.pop(option, default))
+                       for option, default in INSERT_OPTIONS.iteritems())
+        if self.partitioned:
+            # The months are partitions of the one table
+            options["monthlyTables"] = False
+        return options
+
+    def _pipelinedTweetsToMySQL(self, tweetsYielder, queueSize = INSERT_OPTIONS["queueSize"],
+                                overflow = INSERT_OPTIONS["overflow"], writers = INSERT_OPTIONS["writers"],
+                                bufferBytes = MAX_BUFFER_BYTES, **options):
+        """
+        Reads tweetsYielder in a separate thread into a bounded TweetQueue,
+        while one or more writer threads insert them into MySQL.
+        This way, the stream keeps being read when MySQL is slow
+        (Twitter disconnects slow readers).
+        The queue holds up to queueSize rows and bufferBytes bytes in
+        memory, the overflow policy says what happens beyond that.
+        Each writer thread has its own MySQL connection.
+        """
+        policy = options.pop("flushPolicy", None) or FlushPolicy(TWEET_LIMIT_BEFORE_INSERT)
+        # Empty queues still wake the writers up, for maxAge flushes and stop()
+        tickInterval = min(1.0, policy.maxAge / 2.0) if policy.maxAge else 1.0
+        queue = TweetQueue(queueSize, overflow, tickInterval, bufferBytes)
+        readerErrors = []
+
+        def reader():
+            try:
+                for tweet in self._untilStopped(tweetsYielder):
+                    # The queue has ticks of its own
+                    if tweet is not None:
+                        queue.put(tweet)
+            except Exception as e:
+                # Unless it's a put() on the queue a writer closed on stop()
+                if not self._stopped.is_set():
+                    readerErrors.append(sys.exc_info())
+            finally:
+                queue.close()
+
+        def writer():
+            try:
+                self._tweetsToMySQL(queue, flushPolicy = policy.copy(), bufferBytes = bufferBytes, **options)
+            finally:
+                self._disconnect()
+
+        readerThread = threading.Thread(target = reader, name = "TwitterMySQL-reader")
+        readerThread.daemon = True
+        readerThread.start()
+
+        writerThreads = [threading.Thread(target = writer, name = "TwitterMySQL-writer-%d" % i)
+                         for i in xrange(1, writers)]
+        for t in writerThreads:
+            t.daemon = True
+            t.start()
+
+        # The current thread is a writer too
+        self._tweetsToMySQL(queue, flushPolicy = policy, bufferBytes = bufferBytes, **options)
+
+        for t in writerThreads:
+            t.join()
+        # After stop(), the reader may be waiting on a quiet stream
+        while readerThread.is_alive() and not self._stopped.is_set():
+            readerThread.join(1)
+
+        stats = queue.stats()
+        self._log(("Queue: %(put)d tweets read, peak occupancy %(peakSize)d/%(maxSize)d (%(peakBytes)d bytes), "
+               + "%(dropped)d dropped, %(spilled)d spilled to disk") % stats)
+        if readerErrors:
+            raise readerErrors[0][0], readerErrors[0][1], readerErrors[0][2]
+        return stats
+
+    def _tweetsToMySQL(self, tweetsYielder, replace = False, monthlyTables = False, bulk = False,
+                       flushPolicy = None, parallelTables = 1, spool = None, dedup = False,
+                       updateColumns = DEDUP_UPDATE_COLUMNS, deferIndexes = False, bufferBytes = MAX_BUFFER_BYTES,
+                       pipelined = False, **pipelineOptions):
         """
         Tool function to insert tweets into MySQL tables in chunks,
         while outputting counts.
+        The chunks are written according to flushPolicy
+        [Default: FlushPolicy(maxRows = TWEET_LIMIT_BEFORE_INSERT)],
+        None values coming out of tweetsYielder are only used to check
+        the policy's maxAge. Whatever the policy, the tweets are written
+        once they take bufferBytes (see batching.rowSize).
+        With monthlyTables, up to parallelTables tables are written at the same
+        time, each on its own connection.
+        With pipelined = True, reading and writing happen in separate threads
+        (see _pipelinedTweetsToMySQL for the queueSize, overflow and writers options).
+        With a spool (a directory or a Spool), tweets are appended to it
+        before being buffered (see _flushSpooled).
+        With dedup (True or a dedup.RecentIdFilter), tweets whose ID was seen
+        lately are dropped, the others are written with INSERT ... ON
+        DUPLICATE KEY UPDATE of updateColumns (which replace is then, see
+        upsertRows).
+        With deferIndexes, the tables are created without their secondary
+        indices, which are built at the end (see _withDeferredIndexes).
+        After stop(), the tweets buffered are written and this returns.
         """
+        if deferIndexes and not self._deferIndexes:
+            return self._withDeferredIndexes(self._tweetsToMySQL, tweetsYielder, replace = replace,
+                                             monthlyTables = monthlyTables, bulk = bulk, flushPolicy = flushPolicy,
+                                             parallelTables = parallelTables, spool = spool, dedup = dedup,
+                                             updateColumns = updateColumns, bufferBytes = bufferBytes,
+                                             pipelined = pipelined, **pipelineOptions)
+        if spool is not None and not isinstance(spool, Spool):
+            spool = Spool(spool)
+        if self.partitioned:
+            monthlyTables = False
+        if dedup:
+            if "message_id" not in self.columns:
+                raise ValueError("dedup needs a message_id column")
+            if dedup is True:
+                dedup = RecentIdFilter()
+            if not dedup.seeded:
+                self.seedIdFilter(dedup, monthlyTables)
+            replace = tuple(c for c in updateColumns if c in self.columns)
+        elif self.embedded and replace is False:
+            # Originals come again and again in retweets
+            replace = ()
+        writers = pipelineOptions.get("writers", INSERT_OPTIONS["writers"]) if pipelined else 1
+        if self.mysql and writers * parallelTables > self._pool.size:
+            # Each writer holds a connection, and its tables take one each
+            clamped = (min(writers, self._pool.size), max(1, self._pool.size // writers))
+            self._warn("%d writers writing %d tables each need %d MySQL connections, the pool has %d: using %d writers and %d tables"
+                       % (writers, parallelTables, writers * parallelTables, self._pool.size, clamped[0], clamped[1]))
+            writers, parallelTables = clamped
+            if pipelined:
+                pipelineOptions["writers"] = writers
+        if pipelined:
+            return self._pipelinedTweetsToMySQL(tweetsYielder, replace = replace, monthlyTables = monthlyTables,
+                                                bulk = bulk, flushPolicy = flushPolicy,
+                                                parallelTables = parallelTables, spool = spool,
+                                                dedup = dedup, updateColumns = updateColumns,
+                                                bufferBytes = bufferBytes, **pipelineOptions)
+        policy = flushPolicy or FlushPolicy(TWEET_LIMIT_BEFORE_INSERT)
         tweetsDict = {}
         i = 0
-        
-        # TWEET_LIMIT_BEFORE_INSERT = 100
+        nbBytes = 0
+        messageIdIndex = self.columns.index("message_id") if dedup else None
+
+        if spool and spool.pending():
+            # Left over by a crash or an outage
+            self._log("Replaying %d spooled segments" % spool.pending())
+            self._flushSpooled({}, spool, replace, monthlyTables, bulk, policy, parallelTables, True)
+
+        queue = tweetsYielder if isinstance(tweetsYielder, TweetQueue) else None
+        if queue is None:
+            tweetsYielder = self._untilStopped(tweetsYielder)
+        stoppedAt = None
 
         for tweet in tweetsYielder:
+            if queue is not None and self._stopped.is_set():
+                # The reader closes the queue once its current tweet is in,
+                # unless it's waiting on a quiet stream.
+                # What the reader queued still gets written
+                stoppedAt = stoppedAt or time.time()
+                if time.time() - stoppedAt >= STOP_READER_WAIT:
+                    queue.close()
+            if tweet is None:
+                if policy.shouldFlush():
+                    self._flushTweets(tweetsDict, replace, monthlyTables, bulk, policy, parallelTables, spool)
+                    i, nbBytes, tweetsDict = (0, 0, {})
+                continue
+            if (dedup and tweet[messageIdIndex] is not None and not isinstance(tweet, EmbeddedRow)
+                and not dedup.add(tweet[messageIdIndex])):
+                self.metrics.inc("duplicates_skipped")
+                continue
             i += 1
+            policy.add(tweet)
+            if bufferBytes:
+                nbBytes += rowSize(tweet)
+            if spool:
+                spool.append(tweet)
             
+            yearMonth = self._yearMonth(tweet[self._createdTimeIndex])
             try:
-                tweetsDict[self._yearMonth(tweet[3])].append(tweet)
+                tweetsDict[yearMonth].append(tweet)
             except KeyError:
-                tweetsDict[self._yearMonth(tweet[3])] = [tweet]
+                tweetsDict[yearMonth] = [tweet]
             
-            if i % 10 == 0:
+            if i % 10 == 0 and not self.quiet:
                 print "\rNumber of tweets grabbed: %d" % i,
                 sys.stdout.flush()
             
-            if i % TWEET_LIMIT_BEFORE_INSERT == 0:
-                print
-                if monthlyTables:
-                    for yearMonth, twts in tweetsDict.iteritems():
-                        table = self.table+"_"+yearMonth
-                        if replace:
-                            print "Sucessfully replaced %4d tweets into '%s' (%4d rows affected) [%s]" % (i, table, self.replaceRows(twts, table = table, verbose = False), time.strftime("%c"))
-                        else:
-                            print "Sucessfully inserted %4d tweets into '%s' [%s]" % (self.insertRows(twts, table = table, verbose = False), table, time.strftime("%c"))
+            if policy.shouldFlush() or (bufferBytes and nbBytes >= bufferBytes):
+                self._flushTweets(tweetsDict, replace, monthlyTables, bulk, policy, parallelTables, spool)
+                i, nbBytes, tweetsDict = (0, 0, {})
+
+        if spool:
+            # Once more, even if MySQL looks down
+            self._flushSpooled(tweetsDict, spool, replace, monthlyTables, bulk, policy, parallelTables, True)
+            if spool.pending():
+                self._warn("%d spooled segments couldn't be written to MySQL, they will be on the next start" % spool.pending())
+        # If there are remaining tweets
+        elif any(tweetsDict.values()):
+            self._flushTweets(tweetsDict, replace, monthlyTables, bulk, policy, parallelTables)
+        # Finishes the files, so that they can be read
+        for sink in self.sinks:
+            sink.flush()
+
+    def _untilStopped(self, tweetsYielder):
+        """tweetsYielder until stop() is called"""
+        for tweet in tweetsYielder:
+            yield tweet
+            if self._stopped.is_set():
+                return
+
+    def _flushSpooled(self, tweetsDict, spool, replace = False, monthlyTables = False, bulk = False,
+                      policy = None, parallelTables = 1, force = False):
+        """
+        _flushTweets for spooled tweets: the current thread's segment is
+        sealed, the segments MySQL didn't take before are replayed, then
+        tweetsDict is written and its segment acknowledged.
+        If MySQL is unavailable, nothing is lost (it's all in the spool),
+        MySQL is left alone for a while (unless force) and the tweets keep
+        coming in meanwhile, going only to the spool.
+        Segments are only acknowledged once their rows are in MySQL, the
+        ones with rows MySQL gives up on (see QueryFailed) are rejected.
+        """
+        if spool.waiting() and not force:
+            # The rows of the current segment aren't all in memory anymore
+            self._local.spoolBehind = True
+            if policy:
+                # Next try on the policy's next trigger, not on every tweet
+                policy.reset()
+            return
+        segment = spool.seal()
+        behind = getattr(self._local, "spoolBehind", False)
+        self._local.spoolBehind = False
+        self._local.raiseErrors = True
+        try:
+            while True:
+                older = spool.claim()
+                if older is None:
+                    break
+                self._replaySegment(spool, older, replace, monthlyTables, parallelTables)
+            if segment is not None:
+                if behind:
+                    self._replaySegment(spool, segment, replace, monthlyTables, parallelTables)
                 else:
-                    tweets = [twt for twts in tweetsDict.values() for twt in twts]
-                    if replace:
-                        print "Sucessfully replaced %4d tweets into '%s' (%4d rows affected) [%s]" % (i, self.table, self.replaceRows(tweets, verbose = False), time.strftime("%c"))
+                    try:
+                        if any(tweetsDict.values()):
+                            self._flushTweets(tweetsDict, replace, monthlyTables, bulk, policy, parallelTables)
+                    except QueryFailed as e:
+                        self._rejectSegment(spool, segment, e)
                     else:
-                        print "Sucessfully inserted %4d tweets into '%s' [%s]" % (self.insertRows(tweets, verbose = False), self.table, time.strftime("%c"))
-                i, tweetsDict = (0, {})
+                        spool.ack(segment)
+            spool.recovered()
+        except tuple(MYSQL_OPERATIONAL_ERRORS) as e:
+            # Sealed segments are on disk, whoever flushes next replays them
+            if segment is not None:
+                spool.release(segment)
+            if older is not None:
+                spool.release(older)
+            self._warn("MySQL unavailable, %d spooled segments will be written once it's back, next try in %ds [%s]" % (
+                spool.pending(), spool.backoff(), str(e)))
+        finally:
+            self._local.raiseErrors = False
+            if policy:
+                # Also when MySQL didn't take them (or the segment was replayed
+                # instead), the next try waits for the policy's next trigger
+                policy.reset()
+
+    def _replaySegment(self, spool, segment, replace = False, monthlyTables = False, parallelTables = 1):
+        """
+        Writes the rows of a claimed spool segment to MySQL and acknowledges it
+        (or rejects it, see Spool.reject, if MySQL doesn't take them).
+        Some of them might be in MySQL already, so they're bulk loaded,
+        which ignores (or replaces) duplicates.
+        """
+        tweetsDict = {}
+        for tweet in spool.read(segment):
+            yearMonth = self._yearMonth(tweet[self._createdTimeIndex])
+            try:
+                tweetsDict[yearMonth].append(tweet)
+            except KeyError:
+                tweetsDict[yearMonth] = [tweet]
+        try:
+            if tweetsDict:
+                self._flushTweets(tweetsDict, replace, monthlyTables, True, None, parallelTables)
+        except QueryFailed as e:
+            self._rejectSegment(spool, segment, e)
+        else:
+            spool.ack(segment)
 
-        # If there are remaining tweets
-        if any(tweetsDict.values()):
+    def _rejectSegment(self, spool, segment, e):
+        """MySQL gave up on rows of segment (not for being down), they're kept aside instead of being acknowledged"""
+        self.metrics.inc("spool_rejected")
+        self._warn("MySQL didn't take the rows of spooled segment %d, moved to %s [%s]" % (
+            segment, spool.reject(segment), str(e)))
+
+    def _flushTweets(self, tweetsDict, replace = False, monthlyTables = False, bulk = False,
+                     policy = None, parallelTables = 1, spool = None):
+        """
+        Inserts the tweets buffered by _tweetsToMySQL ({yearMonth: [tweets]})
+        and tells the flush policy how long it took
+        """
+        if spool:
+            return self._flushSpooled(tweetsDict, spool, replace, monthlyTables, bulk, policy, parallelTables)
+        start = time.time()
+        if not self.quiet:
             print
-            if monthlyTables:
-                for yearMonth, twts in tweetsDict.iteritems():
-                    table = self.table+"_"+yearMonth
-                    if replace:
-                        print "Sucessfully replaced %4d tweets into '%s' (%4d rows affected) [%s]" % (i, table, self.replaceRows(twts, table = table, verbose = False), time.strftime("%c"))
-                    else:
-                        print "Sucessfully inserted %4d tweets into '%s' [%s]" % (self.insertRows(twts, table = table, verbose = False), table, time.strftime("%c"))
+        if monthlyTables:
+            batches = [(self.table+"_"+yearMonth, twts) for yearMonth, twts in sorted(tweetsDict.iteritems())]
+        else:
+            batches = [(self.table, [twt for twts in tweetsDict.values() for twt in twts])]
+        if self.embedded:
+            batches = self._splitEmbedded(batches)
+
+        if self._deferIndexes:
+            self._deferredTables.update(table for table, tweets in batches)
+        if self.mysql and self.partitioned:
+            for table, tweets in batches:
+                self._ensureTable(table)
+                self._ensurePartitions(table, tweetsDict.keys())
+
+        if self.mysql:
+            if parallelTables > 1 and len(batches) > 1:
+                self._writeBatchesInParallel(batches, replace, bulk, parallelTables)
             else:
-                tweets = [twt for twts in tweetsDict.values() for twt in twts]
-                if replace:
-                    print "Sucessfully replaced %4d tweets into '%s' (%4d rows affected) [%s]" % (i, self.table, self.replaceRows(tweets, verbose = False), time.strftime("%c"))
-                else:
-                    print "Sucessfully inserted %4d tweets into '%s' [%s]" % (self.insertRows(tweets, verbose = False), self.table, time.strftime("%c"))
-            i, tweetsDict = (0, {})
+                for table, tweets in batches:
+                    self._writeBatch(table, tweets, replace, bulk)
+
+        for sink in self.sinks:
+            sinkStart = time.time()
+            for table, tweets in batches:
+                sink.write(tweets)
+            self.metrics.observe("sink_seconds", time.time() - sinkStart)
+
+        elapsed = time.time() - start
+        if policy:
+            policy.flushed(elapsed)
+        if len(batches) > 1 and self.mysql and not self.quiet:
+            nbTweets = sum(len(tweets) for table, tweets in batches)
+            print "Wrote %d tweets into %d tables in %.2fs (%.0f tweets/sec)" % (nbTweets, len(batches), elapsed, nbTweets / max(elapsed, 1e-6))
+
+        if monthlyTables and self.mysql:
+            self._precreateNextMonth(max(tweetsDict))
+
+    def _splitEmbedded(self, batches):
+        """
+        Takes the embedded statuses out of batches [(table, tweets)] that
+        are tweets of the batch too or came more than once (keeping the
+        last one, it has the newest counts), and moves them to their
+        embeddedTable batch if there is one
+        """
+        messageIdIndex = self.columns.index("message_id")
+        split = []
+        for table, tweets in batches:
+            main = [tweet for tweet in tweets if not isinstance(tweet, EmbeddedRow)]
+            mainIds = set(tweet[messageIdIndex] for tweet in main)
+            embedded = {}
+            for tweet in tweets:
+                if isinstance(tweet, EmbeddedRow) and tweet[messageIdIndex] not in mainIds:
+                    embedded[tweet[messageIdIndex]] = tweet
+            if self.embeddedTable:
+                split.append((table, main))
+                if embedded:
+                    split.append((self.embeddedTable + table[len(self.table):], embedded.values()))
+            else:
+                split.append((table, main + embedded.values()))
+        return [(table, tweets) for table, tweets in split if tweets]
+
+    def _writeBatch(self, table, tweets, replace = False, bulk = False):
+        start = time.time()
+        if bulk:
+            affected = self.bulkLoadRows(tweets, table = table, replace = replace, verbose = False)
+            message = "Sucessfully loaded %4d tweets into '%s' (%4d rows affected) [%s]" % (len(tweets), table, affected, time.strftime("%c"))
+        elif isinstance(replace, tuple):
+            affected = self.upsertRows(tweets, table = table, updateColumns = replace, verbose = False)
+            message = "Sucessfully upserted %4d tweets into '%s' (%4d rows affected) [%s]" % (len(tweets), table, affected, time.strftime("%c"))
+        elif replace:
+            affected = self.replaceRows(tweets, table = table, verbose = False)
+            message = "Sucessfully replaced %4d tweets into '%s' (%4d rows affected) [%s]" % (len(tweets), table, affected, time.strftime("%c"))
+        else:
+            affected = self.insertRows(tweets, table = table, verbose = False)
+            message = "Sucessfully inserted %4d tweets into '%s' [%s]" % (affected, table, time.strftime("%c"))
+        self.metrics.observe("insert_seconds", time.time() - start)
+        self.metrics.inc("batches_written")
+        self.metrics.inc("tweets_written", len(tweets))
+        self.metrics.inc("rows_affected", affected or 0)
+        self._log(message)
+
+    def _writeBatchesInParallel(self, batches, replace = False, bulk = False, nbThreads = 2):
+        """
+        Writes [(table, tweets)] using up to nbThreads threads: the current
+        one, on its own connection, and helpers with a pooled connection
+        each. Helpers only start if the pool has a connection to spare,
+        waiting for one while holding this thread's could deadlock.
+        """
+        batches = list(batches)
+        errors = []
+        raiseErrors = getattr(self._local, "raiseErrors", False)
+
+        def write():
+            try:
+                while True:
+                    try:
+                        table, tweets = batches.pop()
+                    except IndexError:
+                        return
+                    self._writeBatch(table, tweets, replace, bulk)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        def helper(connection):
+            self._local.raiseErrors = raiseErrors
+            try:
+                self._local.connection, self._local.cur = (connection, connection.cursor())
+                write()
+            finally:
+                self._disconnect()
+
+        try:
+            # Before the helpers take theirs: waiting for a connection
+            # while holding the DDL lock would deadlock too
+            self._connection
+        except Exception:
+            # MySQL is unreachable, write() retries on its own
+            nbThreads = 1
+        threads = []
+        for i in xrange(1, min(nbThreads, len(batches))):
+            try:
+                connection = self._pool.acquire(False)
+            except Exception:
+                # MySQL is unreachable, the current thread finds out when writing
+                connection = None
+            if connection is None:
+                break
+            threads.append(threading.Thread(target = helper, args = (connection, ),
+                                            name = "TwitterMySQL-table-writer-%d" % i))
+        for t in threads:
+            t.start()
+        write()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _precreateNextMonth(self, yearMonth):
+        """
+        While inserting into the current month's table, creates next month's
+        ahead of time, so that the first insert of the month doesn't wait for DDL.
+        Older months (backfills) are left alone.
+        """
+        now = datetime.datetime.utcnow()
+        if yearMonth != now.strftime("%Y_%m"):
+            return
+        nextMonth = (now.replace(day = 28) + datetime.timedelta(days = 4)).strftime("%Y_%m")
+        self._ensureTable(self.table+"_"+nextMonth)
+
+    def forTable(self, table):
+        """
+        TwitterMySQL writing into table, sharing this one's MySQL
+        connections, Twitter credentials (and their rate limits), metrics,
+        sinks, checkpoint table and stop(). Several streams and harvesters
+        can that way run in one process (see daemon.Supervisor).
+        """
+        twtSQL = copy.copy(self)
+        twtSQL.table = table
+        twtSQL._deferIndexes = False
+        twtSQL._deferredTables = set()
+        return twtSQL
+
+    def stop(self):
+        """
+        Makes the *ToMySQL methods running (in any thread, and those of the
+        forTable copies) write the tweets they hold and return. Checkpoints
+        aren't moved by the stopped runs, the next ones pick up from there.
+        """
+        self._stopped.set()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
 
     def tweetsToMySQL(self, twitterMethod, **params):
         """
@@ -495,35 +1910,88 @@ class TwitterMySQL:
 
             For hydrating (getting all available details) for a tweet
             twtSQL.tweetsToMySQL('statuses/lookup', id="504710715954188288")
+            (see hydrateToMySQL for lists of IDs)
+
+        Insertion options (the rest is passed on to Twitter):
+          - replace         use REPLACE instead of INSERT [Default: False]
+          - dedup           drop the tweets whose ID was seen lately (True
+                            or a dedup.RecentIdFilter/BloomFilter, seeded
+                            with the newest IDs in the table), and write
+                            the others with INSERT ... ON DUPLICATE KEY
+                            UPDATE of updateColumns instead of REPLACE
+                            [Default: False]
+          - updateColumns   columns updated when a tweet that's in the
+                            table already comes again, with dedup
+                            (INSERT IGNORE if there are none)
+                            [Default: DEDUP_UPDATE_COLUMNS]
+          - monthlyTables   insert into [tableName_20YY_MM] tables
+                            (ignored if the tables are partitioned, see
+                            TwitterMySQL(partitioned = True))
+                            [Default: False]
+          - pipelined       read the stream in a separate thread, so
+                            that slow MySQL writes don't slow it down
+                            [Default: False]
+          - queueSize       maximum number of tweets waiting to be written
+                            when pipelined [Default: 10000]
+          - overflow        what to do when the queue is full: "block",
+                            "dropOldest" or "spill" (to compressed
+                            temporary files, read back in order once
+                            the writers catch up) [Default: "spill"]
+          - bufferBytes     high-water mark of the tweets held in memory,
+                            in bytes: the pipelined queue overflows
+                            beyond it, and buffered tweets are written
+                            once they take that much, whatever the
+                            flushPolicy [Default: MAX_BUFFER_BYTES]
+          - writers         number of writer threads (and MySQL
+                            connections) when pipelined [Default: 1]
+          - bulk            insert using LOAD DATA LOCAL INFILE (or
+                            multi-row inserts if the server doesn't allow
+                            it, or if TwitterMySQL wasn't made with
+                            local_infile = 1), duplicates are ignored
+                            unless replace is set [Default: False]
+          - flushPolicy     FlushPolicy deciding when buffered tweets are
+                            written: on maxRows, maxBytes or maxAge,
+                            optionally auto tuning maxRows. Unless
+                            pipelined, maxAge is only checked when
+                            something comes from Twitter (tweets, deletes,
+                            reconnects), a quiet stream can hold tweets
+                            longer: use pipelined = True for maxAge to be
+                            kept to [Default: FlushPolicy(maxRows = 100)]
+          - parallelTables  with monthlyTables, number of tables written
+                            at the same time, on separate connections
+                            (writers * parallelTables are cut down to the
+                            poolSize) [Default: 1]
+          - deferIndexes    for backfills: the tables are created without
+                            their secondary indices, which are added in
+                            one ALTER TABLE per table once all the tweets
+                            are in. An interrupted backfill builds them
+                            when it's run again (or see buildIndexes)
+                            [Default: False]
+          - spool           directory of a write-ahead spool (or a Spool):
+                            tweets are kept on disk until MySQL has them,
+                            they're replayed after a crash, and while
+                            MySQL is down the stream keeps going into the
+                            spool (with lazyConnect, also if it's down when
+                            starting) [Default: None]
 
         For more twitterMethods and info on how to use them, see:
         http://dev.twitter.com/rest/public
         http://dev.twitter.com/streaming/overview
         """
 
-        # Replace SQL command instead of insert
-        if "replace" in params:
-            replace = params["replace"]
-            del params["replace"]
-        else:
-            replace = False
+        options = self._popInsertOptions(params)
+        self._tweetsToMySQL(self._apiRequest(twitterMethod, params, ticks = True), **options)
 
-        if "monthlyTables" in params:
-            monthlyTables = params["monthlyTables"]
-            del params["monthlyTables"]
-        else:
-            monthlyTables = False
-        
-        self._tweetsToMySQL(self._apiRequest(twitterMethod, params), replace = replace, monthlyTables = monthlyTables)
-
-    def randomSampleToMySQL(self, replace = False, monthlyTables = True):
+    def randomSampleToMySQL(self, replace = False, monthlyTables = True, **params):
         """
         Takes the random sample of all tweets (~ 1%) and
         inserts it into monthly table [tableName_20YY_MM].
+        Any other tweetsToMySQL option (i.e. pipelined = True) can be passed too,
+        dedup = True is a lot cheaper than replace = True to get rid of duplicates.
         For more info, see:
         http://dev.twitter.com/streaming/reference/get/statuses/sample
         """
-        self.tweetsToMySQL('statuses/sample', replace = replace, monthlyTables = monthlyTables)
+        self.tweetsToMySQL('statuses/sample', replace = replace, monthlyTables = monthlyTables, **params)
 
     def filterStreamToMySQL(self, **params):
         """
@@ -539,118 +2007,472 @@ class TwitterMySQL:
         """
         self.tweetsToMySQL('statuses/filter', **params)
 
-    def userTimeline(self, **params):
+    def readTweetFiles(self, paths, processes = None, ordered = True):
         """
-        For a given user, returns all the accessible tweets from that user,
-        starting with the most recent ones (Twitter imposes a 3200 tweet limit).
+        Reads archived tweets (one JSON tweet per line, files can be
+        gzip or bz2 compressed) and yields them as rows.
+        JSON decoding and row preparation are spread over processes
+        worker processes [Default: number of cores]; with ordered = False
+        rows come out in whichever order the workers finish.
 
         Here's an example of how to use it:
-        for tweet in userTimeline(screen_name = "taylorswift13"):
+        for tweet in twtSQL.readTweetFiles(["sample_2014_03.json.gz"]):
             print tweet
+        """
+        if isinstance(paths, basestring):
+            paths = [paths]
+        return archive.readTweetFiles(self, paths, processes, ordered)
 
-        See http://dev.twitter.com/rest/reference/get/statuses/user_timeline for details        
+    def fileToMySQL(self, paths, processes = None, ordered = True, **options):
         """
-        ok = True
-        print "Finding tweets for %s" % ', '.join(str(k)+': '+str(v) for k,v in params.iteritems())
+        Inserts archived tweets (see readTweetFiles) into MySQL,
+        takes the same insertion options as tweetsToMySQL.
+
+        Here's an example of how to use it:
+        twtSQL.fileToMySQL(glob.glob("dumps/*.json.bz2"), monthlyTables = True, bulk = True)
+        """
+        options = self._popInsertOptions(options)
+        self._tweetsToMySQL(self.readTweetFiles(paths, processes, ordered), **options)
+
+    def _pageBack(self, twitterMethod, params, known = None, newest = None):
+        """
+        Pages back through the results of twitterMethod (newest first).
+        With known ({query: since_id}, see loadCheckpoints), only the tweets
+        newer than the query's checkpoint are requested, and once all of
+        them have been read, the newest tweet ID is put in newest[query].
+        """
+        self._log("Finding tweets for %s" % ', '.join(str(k)+': '+str(v) for k,v in params.iteritems()))
         params["count"] = 200 # Twitter limits to 200 returns
-        
+
+        query = checkpointQuery(params)
+        sinceId = known.get(query) if known else None
+        if sinceId and "since_id" not in params:
+            params["since_id"] = str(sinceId)
+        top = sinceId
+
         i = 0
+        ok = True
 
         while ok:
-            
-            tweets = [tweet for tweet in self._apiRequest('statuses/user_timeline', params)]
+
+            tweets = [tweet for tweet in self._apiRequest(twitterMethod, params)]
+            # Embedded statuses are older, they don't count for paging
+            embedded = [tweet for tweet in tweets if isinstance(tweet, EmbeddedRow)]
+            if embedded:
+                tweets = [tweet for tweet in tweets if not isinstance(tweet, EmbeddedRow)]
+            if sinceId:
+                # Reaching known tweets means the rest is known too
+                fresh = [tweet for tweet in tweets if long(tweet[1]) > sinceId]
+                ok = len(fresh) == len(tweets)
+                tweets = fresh
             if not tweets:
                 # Warn about no tweets?
                 ok = False
-                if i != 0: print 
+                if i != 0 and not self.quiet: print
             else:
                 i += len(tweets)
-                
-                print "\rNumber of tweets grabbed: %d" % i,
-                sys.stdout.flush()
 
+                if not self.quiet:
+                    print "\rNumber of tweets grabbed: %d" % i,
+                    sys.stdout.flush()
+
+                top = max(top, long(tweets[0][1]))
                 params["max_id"] = str(long(tweets[-1][1])-1)
-                for tweet in tweets:
+                for tweet in embedded + tweets:
                     yield tweet
+
+        if newest is not None and top:
+            newest[query] = top
+
+    def _checkpointedToMySQL(self, twitterMethod, params):
+        """
+        Inserts the results of twitterMethod (see _pageBack) into MySQL.
+        With checkpoint = True, the checkpoint only moves forward
+        once the tweets are in MySQL.
+        """
+        options = self._popInsertOptions(params)
+        if not params.pop("checkpoint", False):
+            self._tweetsToMySQL(self._pageBack(twitterMethod, params), **options)
+            return
+        known = self.loadCheckpoints(twitterMethod, [checkpointQuery(params)])
+        newest = {}
+        self._tweetsToMySQL(self._pageBack(twitterMethod, params, known, newest), **options)
+        if not self._stopped.is_set():
+            self.saveCheckpoints(twitterMethod, newest)
+
+    def userTimeline(self, **params):
+        """
+        For a given user, returns all the accessible tweets from that user,
+        starting with the most recent ones (Twitter imposes a 3200 tweet limit).
+        With checkpoint = True, only the tweets newer than the ones of the
+        last checkpoint = True run are returned (see checkpointTable).
+
+        Here's an example of how to use it:
+        for tweet in userTimeline(screen_name = "taylorswift13"):
+            print tweet
+
+        See http://dev.twitter.com/rest/reference/get/statuses/user_timeline for details        
+        """
+        if not params.pop("checkpoint", False):
+            for tweet in self._pageBack('statuses/user_timeline', params):
+                yield tweet
+            return
+        known = self.loadCheckpoints('statuses/user_timeline', [checkpointQuery(params)])
+        newest = {}
+        for tweet in self._pageBack('statuses/user_timeline', params, known, newest):
+            yield tweet
+        self.saveCheckpoints('statuses/user_timeline', newest)
     
     def userTimelineToMySQL(self, **params):
         """
         For a given user, inserts all the accessible tweets from that user into,
         the current table. (Twitter imposes a 3200 tweet limit).
+        With checkpoint = True, only the tweets newer than the ones inserted
+        by the last checkpoint = True run are requested, which usually takes
+        a single request (see checkpointTable).
 
         Here's an example of how to use it:
-        userTimelineToMySQL(screen_name = "taylorswift13")
+        userTimelineToMySQL(screen_name = "taylorswift13", checkpoint = True)
 
         For details on keywords to use, see
         http://dev.twitter.com/rest/reference/get/statuses/user_timeline
         """
-        print "Grabbing users tweets and inserting into MySQL"
-        
-        # Replace SQL command instead of insert
-        if "replace" in params:
-            replace = params["replace"]
-            del params["replace"]
-        else:
-            replace = False
+        self._log("Grabbing users tweets and inserting into MySQL")
+        self._checkpointedToMySQL('statuses/user_timeline', params)
+
+    def _userTimelines(self, users, threads, userKey, params, known = None, newest = None):
+        """Harvests the timelines of users concurrently, see userTimelines"""
+        users = iter(users)
+        usersLock = threading.Lock()
+        queue = TweetQueue(threads * 3200, "block", maxBytes = MAX_BUFFER_BYTES)
+        # Counted by all the harvesters, under usersLock
+        stats = {"users": 0, "failed": 0}
+
+        def harvester():
+            try:
+                while True:
+                    with usersLock:
+                        user = next(users, None)
+                    if user is None:
+                        return
+                    user = str(user).strip()
+                    if not user:
+                        continue
+                    try:
+                        for tweet in self._pageBack('statuses/user_timeline', dict(params, **{userKey: user}), known, newest):
+                            queue.put(tweet)
+                        with usersLock:
+                            stats["users"] += 1
+                    except Exception as e:
+                        with usersLock:
+                            stats["failed"] += 1
+                        self._warn("Couldn't get the timeline of %s: [%s]" % (user, str(e)))
+            finally:
+                done.release()
+
+        done = threading.Semaphore(0)
+        harvesters = [threading.Thread(target = harvester, name = "TwitterMySQL-timelines-%d" % i)
+                      for i in xrange(threads)]
+        for t in harvesters:
+            t.daemon = True
+            t.start()
+
+        def closer():
+            for t in harvesters:
+                done.acquire()
+            queue.close()
+        closerThread = threading.Thread(target = closer, name = "TwitterMySQL-timelines-closer")
+        closerThread.daemon = True
+        closerThread.start()
+
+        for tweet in queue:
+            yield tweet
+        self._log("Harvested the timelines of %d users (%d failed), waited %d times for rate limits" % (
+            stats["users"], stats["failed"], self._credentials.nbWaits))
+
+    def userTimelines(self, users, threads = TIMELINE_THREADS, userKey = "screen_name", **params):
+        """
+        Yields the tweets of the timelines of all users (an iterable of
+        screen names, or user IDs with userKey = "user_id"), harvested by
+        threads concurrent threads. Requests share the statuses/user_timeline
+        rate limit, threads only sleep until the exact reset time when it's
+        used up. Other parameters are passed on to userTimeline, including
+        checkpoint (the checkpoints are saved once all timelines are read).
 
-        if "monthlyTables" in params:
-            monthlyTables = params["monthlyTables"]
-            del params["monthlyTables"]
-        else:
-            monthlyTables = False
+        Here's an example of how to use it:
+        for tweet in twtSQL.userTimelines(["taylorswift13", "maarten1709"]):
+            print tweet
+        """
+        if not params.pop("checkpoint", False):
+            for tweet in self._userTimelines(users, threads, userKey, params):
+                yield tweet
+            return
+        known = self.loadCheckpoints('statuses/user_timeline')
+        newest = {}
+        for tweet in self._userTimelines(users, threads, userKey, params, known, newest):
+            yield tweet
+        self.saveCheckpoints('statuses/user_timeline', newest)
 
-        self._tweetsToMySQL(self.userTimeline(**params), replace = replace, monthlyTables = monthlyTables)
+    def userTimelinesToMySQL(self, users, threads = TIMELINE_THREADS, userKey = "screen_name", **params):
+        """
+        Inserts the timelines of many users (see userTimelines) into MySQL,
+        all going through the same writer. Takes the same insertion options
+        as tweetsToMySQL. With checkpoint = True, a nightly refresh only
+        costs a request or two per user.
 
-    def search(self, **params):
+        Here's an example of how to use it:
+        twtSQL.userTimelinesToMySQL(open("users.txt"), threads = 8, monthlyTables = True)
         """
-        Search API
+        options = self._popInsertOptions(params)
+        if not params.pop("checkpoint", False):
+            self._tweetsToMySQL(self._userTimelines(users, threads, userKey, params), **options)
+            return
+        known = self.loadCheckpoints('statuses/user_timeline')
+        newest = {}
+        self._tweetsToMySQL(self._userTimelines(users, threads, userKey, params, known, newest), **options)
+        # Only once the tweets are in MySQL, all of them (stop() leaves some behind)
+        if not self._stopped.is_set():
+            self.saveCheckpoints('statuses/user_timeline', newest)
+
+    def _hydrate(self, ids, threads = TIMELINE_THREADS, stats = None, **params):
         """
-        ok = True
-        print "Finding tweets for %s" % ', '.join(str(k)+': '+str(v) for k,v in params.iteritems())
-        params["count"] = 200 # Twitter limits to 200 returns
-        
-        i = 0
+        Yields the tweets of ids (LOOKUP_BATCH per request), looked up by
+        threads concurrent threads, counting them in stats["tweets"]
+        """
+        stats = stats if stats is not None else {}
+        stats.setdefault("tweets", 0)
+        batches = [ids[i:i+LOOKUP_BATCH] for i in xrange(0, len(ids), LOOKUP_BATCH)]
+        batchesLock = threading.Lock()
+        queue = TweetQueue(threads * LOOKUP_BATCH * 2, "block", maxBytes = MAX_BUFFER_BYTES)
 
-        while ok:
-            
-            tweets = [tweet for tweet in self._apiRequest('search/tweets', params)]
-            if not tweets:
-                # Warn about no tweets?
-                ok = False
-                if i != 0: print 
-            else:
-                i += len(tweets)
-                
-                print "\rNumber of tweets grabbed: %d" % i,
-                sys.stdout.flush()
+        def worker():
+            try:
+                while True:
+                    with batchesLock:
+                        if not batches:
+                            return
+                        batch = batches.pop()
+                    nbTweets = 0
+                    try:
+                        for tweet in self._apiRequest('statuses/lookup', dict(params, id = ",".join(str(i) for i in batch))):
+                            queue.put(tweet)
+                            if not isinstance(tweet, EmbeddedRow):
+                                nbTweets += 1
+                    except Exception as e:
+                        self._warn("Couldn't look up %d tweets starting with %s: [%s]" % (len(batch), batch[0], str(e)))
+                    finally:
+                        # stats is shared by the workers
+                        with batchesLock:
+                            stats["tweets"] += nbTweets
+            finally:
+                done.release()
+
+        done = threading.Semaphore(0)
+        workers = [threading.Thread(target = worker, name = "TwitterMySQL-lookup-%d" % i)
+                   for i in xrange(min(threads, len(batches)))]
+        for t in workers:
+            t.daemon = True
+            t.start()
+
+        def closer():
+            for t in workers:
+                done.acquire()
+            queue.close()
+        closerThread = threading.Thread(target = closer, name = "TwitterMySQL-lookup-closer")
+        closerThread.daemon = True
+        closerThread.start()
+
+        for tweet in queue:
+            yield tweet
+
+    def hydrateToMySQL(self, ids, threads = TIMELINE_THREADS, progressFile = None, **params):
+        """
+        Looks up (hydrates) tweet IDs and inserts the tweets into MySQL.
+        ids is a file with one tweet ID per line (.gz and .bz2 too,
+        "-" for stdin) or an iterable of IDs.
+        IDs are taken HYDRATE_ROUND at a time: the ones already in MySQL
+        are skipped (checked in bulk), the others are looked up
+        LOOKUP_BATCH per statuses/lookup request by threads concurrent
+        threads, within the rate limits of all the credentials.
+        Takes the same insertion options as tweetsToMySQL, other parameters
+        are passed on to Twitter (i.e. include_entities).
+
+        With progressFile, the number of IDs done (looked up and in MySQL)
+        is saved after every round, and a restarted job picks up from there.
 
-                params["max_id"] = str(long(tweets[-1][1])-1)
-                for tweet in tweets:
-                    yield tweet
+        Here's an example of how to use it:
+        twtSQL.hydrateToMySQL("ids.txt.gz", threads = 8, progressFile = "ids.progress", monthlyTables = True)
+        """
+        options = self._popInsertOptions(params)
+        if options["deferIndexes"] and not self._deferIndexes:
+            # The indices are built once, after the last round
+            return self._withDeferredIndexes(self.hydrateToMySQL, ids, threads, progressFile, **dict(params, **options))
+        # Made once for all the rounds: the filter is seeded from MySQL,
+        # the spool replays what's left over
+        if options["dedup"] is True:
+            options["dedup"] = RecentIdFilter()
+        if options["spool"] is not None and not isinstance(options["spool"], Spool):
+            options["spool"] = Spool(options["spool"])
+        f = archive.openTweetFile(ids) if isinstance(ids, basestring) else iter(ids)
+
+        done = 0
+        if progressFile and os.path.exists(progressFile):
+            with open(progressFile) as p:
+                done = int(p.read().strip() or 0)
+            self._log("Resuming after %d IDs" % done)
+            for line in islice(f, done):
+                pass
+
+        stats = {"tweets": 0}
+        nbSkipped = 0
+        try:
+            while True:
+                lines = list(islice(f, HYDRATE_ROUND))
+                if not lines:
+                    break
+                roundIds = []
+                for line in lines:
+                    line = str(line).strip().split(",")[0]
+                    if line.isdigit():
+                        roundIds.append(long(line))
+                existing = self.existingIds(roundIds, options["monthlyTables"])
+                todo = [tweetId for tweetId in roundIds if tweetId not in existing]
+                nbSkipped += len(roundIds) - len(todo)
+
+                if todo:
+                    self._tweetsToMySQL(self._hydrate(todo, threads, stats, **params), **options)
+                if self._stopped.is_set():
+                    # The round wasn't done, it's redone on the next run
+                    break
+
+                done += len(lines)
+                if progressFile:
+                    with open(progressFile + ".tmp", "w") as p:
+                        p.write("%d\n" % done)
+                    os.rename(progressFile + ".tmp", progressFile)
+                self._log("\rHydrated %d tweets, skipped %d already in MySQL, %d IDs done" % (stats["tweets"], nbSkipped, done))
+        finally:
+            if f is not sys.stdin and hasattr(f, "close"):
+                f.close()
+        return stats["tweets"]
+
+    def _slicedSearch(self, params, threads, window = SEARCH_WINDOW, known = None, newest = None):
+        """
+        Cuts the IDs the search can return (since_id, or the checkpoint in
+        known, or SEARCH_DAYS ago, to max_id or now) into windows of window
+        seconds of (snowflake) IDs, and pages back through them with
+        threads concurrent threads, newest windows first.
+        Windows go from their since_id (excluded) to their max_id
+        (included), so a tweet on the edge of two windows comes once.
+        The newest tweet ID is only put in newest if all windows were done.
+        """
+        query = checkpointQuery(params)
+        now = time.time()
+        lower = (long(params.pop("since_id", 0)) or (known or {}).get(query)
+                 or timeToSnowflake(now - SEARCH_DAYS * 86400))
+        # A minute ahead, in case clocks differ
+        upper = long(params.pop("max_id", 0)) or timeToSnowflake(now + 60)
+        step = max(1L, long(window * 1000)) << 22
+        windows = []
+        while upper > lower:
+            windows.append((max(lower, upper - step), upper))
+            upper -= step
+        windows = iter(windows)
+        windowsLock = threading.Lock()
+        queue = TweetQueue(threads * 3200, "block", maxBytes = MAX_BUFFER_BYTES)
+        # Updated by all the pagers, under windowsLock
+        stats = {"windows": 0, "failed": 0}
+        tops = []
+
+        def pager():
+            try:
+                while True:
+                    with windowsLock:
+                        bounds = next(windows, None)
+                    if bounds is None:
+                        return
+                    windowNewest = {}
+                    try:
+                        for tweet in self._pageBack('search/tweets', dict(params, since_id = str(bounds[0]), max_id = str(bounds[1])),
+                                                    None, windowNewest):
+                            queue.put(tweet)
+                        with windowsLock:
+                            stats["windows"] += 1
+                            tops.extend(windowNewest.values())
+                    except Exception as e:
+                        with windowsLock:
+                            stats["failed"] += 1
+                        self._warn("Couldn't search tweets %d to %d: [%s]" % (bounds[0], bounds[1], str(e)))
+            finally:
+                done.release()
+
+        done = threading.Semaphore(0)
+        pagers = [threading.Thread(target = pager, name = "TwitterMySQL-search-%d" % i)
+                  for i in xrange(threads)]
+        for t in pagers:
+            t.daemon = True
+            t.start()
+
+        def closer():
+            for t in pagers:
+                done.acquire()
+            queue.close()
+        closerThread = threading.Thread(target = closer, name = "TwitterMySQL-search-closer")
+        closerThread.daemon = True
+        closerThread.start()
+
+        for tweet in queue:
+            yield tweet
+        self._log("Searched %d windows (%d failed), waited %d times for rate limits" % (
+            stats["windows"], stats["failed"], self._credentials.nbWaits))
+        if newest is not None and tops and not stats["failed"]:
+            newest[query] = max(tops)
+
+    def search(self, threads = 1, window = SEARCH_WINDOW, **params):
+        """
+        Search API
+        With checkpoint = True, only the results newer than the ones of the
+        last checkpoint = True run of the same query are returned.
+        With threads > 1, the week the Search API covers (or since_id to
+        max_id) is cut into windows of window seconds (see _slicedSearch),
+        paged back at the same time instead of one page after the other.
+        """
+        checkpoint = params.pop("checkpoint", False)
+        known = self.loadCheckpoints('search/tweets', [checkpointQuery(params)]) if checkpoint else None
+        newest = {} if checkpoint else None
+        if threads > 1:
+            tweets = self._slicedSearch(params, threads, window, known, newest)
+        else:
+            tweets = self._pageBack('search/tweets', params, known, newest)
+        for tweet in tweets:
+            yield tweet
+        if checkpoint:
+            self.saveCheckpoints('search/tweets', newest)
 
-    def searchToMySQL(self, **params):
+    def searchToMySQL(self, threads = 1, window = SEARCH_WINDOW, **params):
         """
         Queries the Search API and pulls as many results as possible
+        With checkpoint = True, only the results newer than the ones
+        inserted by the last checkpoint = True run are requested.
+        With threads > 1, windows of window seconds are searched
+        concurrently (see search).
 
         Here's an example of how to use it:
-        userTimelineToMySQL(screen_name = "taylorswift13")
+        searchToMySQL(q = "#TwitterAPI", checkpoint = True)
+        searchToMySQL(q = "#TwitterAPI", threads = 8, window = 3600)
 
         For details on keywords to use, see
-        http://dev.twitter.com/rest/reference/get/statuses/user_timeline
+        http://dev.twitter.com/rest/reference/get/search/tweets
         """
-        print "Grabbing users tweets and inserting into MySQL"
-        
-        # Replace SQL command instead of insert
-        if "replace" in params:
-            replace = params["replace"]
-            del params["replace"]
-        else:
-            replace = False
-
-        if "monthlyTables" in params:
-            monthlyTables = params["monthlyTables"]
-            del params["monthlyTables"]
-        else:
-            monthlyTables = False
-
-        self._tweetsToMySQL(self.search(**params), replace = replace, monthlyTables = monthlyTables)
+        self._log("Grabbing users tweets and inserting into MySQL")
+        if threads <= 1:
+            self._checkpointedToMySQL('search/tweets', params)
+            return
+        options = self._popInsertOptions(params)
+        checkpoint = params.pop("checkpoint", False)
+        known = self.loadCheckpoints('search/tweets', [checkpointQuery(params)]) if checkpoint else None
+        newest = {}
+        self._tweetsToMySQL(self._slicedSearch(params, threads, window, known, newest), **options)
+        # Only once the tweets are in MySQL, all of them (stop() leaves some behind)
+        if checkpoint and not self._stopped.is_set():
+            self.saveCheckpoints('search/tweets', newest)
@@ -4,9 +4,40 @@ __email__ = "maartensap93@gmail.com"
 __version__ = "0.3"
 __copyright__ = "Copyright 2014 Maarten Sap"
 
-try:
-    from .TwitterMySQL import TwitterMySQL
-except:
-    pass
+import sys, types, importlib
 
-__all__ = ["TwitterMySQL"]
+# Module of each class of the package, imported the first time the class
+# is used: the command line (cli.py) doesn't wait for MySQLdb, requests
+# and the rest before it needs them
+_EXPORTS = {"TwitterMySQL": ".TwitterMySQL",
+            "FlushPolicy": ".batching",
+            "CachedGeoLocator": ".geoCache",
+            "Spool": ".spool",
+            "Metrics": ".metrics",
+            "RecentIdFilter": ".dedup",
+            "BloomFilter": ".dedup"}
+
+__all__ = ["TwitterMySQL", "FlushPolicy", "CachedGeoLocator", "Spool", "Metrics", "RecentIdFilter", "BloomFilter"]
+
+
+class _Package(types.ModuleType):
+    """The TwitterMySQL package, whose classes are imported lazily (see _EXPORTS)"""
+
+    def __getattr__(self, name):
+        if name not in _EXPORTS:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+        if name != "TwitterMySQL":
+            self.__dict__[name] = value
+        return value
+
+    # Importing the TwitterMySQL submodule makes it an attribute of the
+    # package, the class has to win over it
+    TwitterMySQL = property(lambda self: self.__getattr__("TwitterMySQL"))
+
+
+_package = _Package(__name__, __doc__)
+_package.__dict__.update((k, v) for k, v in globals().iteritems() if k != "TwitterMySQL")
+# Python 2 clears the globals of a module once it's gone, _Package's methods use them
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
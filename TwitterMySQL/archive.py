@@ -0,0 +1,130 @@
+"""
+Reading archived tweets (newline delimited JSON, plain, gzip or bz2)
+and turning them into rows using a pool of processes
+(see TwitterMySQL.readTweetFiles and TwitterMySQL.fileToMySQL)
+"""
+
+import sys, json, threading
+import gzip, bz2
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+LINES_PER_CHUNK = 2000
+# Chunks read but not yielded yet, per worker process: when the rows are
+# written slower than they're prepared, reading waits instead of piling
+# prepared chunks up in memory
+CHUNKS_PER_PROCESS = 2
+
+# The TwitterMySQL object used by the worker processes (see _initWorker)
+_twtSQL = None
+
+
+def openTweetFile(path):
+    """Opens a (possibly compressed) dump, "-" is stdin"""
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.BZ2File(path, "rb")
+    return open(path, "rb")
+
+
+def _chunks(paths, size):
+    for path in paths:
+        f = openTweetFile(path)
+        try:
+            while True:
+                lines = list(islice(f, size))
+                if not lines:
+                    break
+                yield lines
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def _boundedChunks(chunks, slots, stopped):
+    """chunks, each one waiting for a free slot (released once its rows were yielded)"""
+    for chunk in chunks:
+        slots.acquire()
+        if stopped.is_set():
+            return
+        yield chunk
+
+
+def _initWorker(twtSQL):
+    global _twtSQL
+    _twtSQL = twtSQL
+
+
+def _prepTweetLines(lines):
+    """
+    Decodes and prepares a chunk of lines, skipping everything that isn't
+    a tweet (deletes, limit notices, ...).
+    Returns (rows, number of lines that couldn't be read)
+    """
+    rows = []
+    nbBad = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            jTweet = json.loads(line)
+        except ValueError:
+            nbBad += 1
+            continue
+        if not isinstance(jTweet, dict) or "id_str" not in jTweet:
+            continue
+        try:
+            if _twtSQL.embedded:
+                rows.extend(_twtSQL._prepEmbedded(jTweet))
+            rows.append(_twtSQL._prepTweet(jTweet))
+        except Exception:
+            nbBad += 1
+    return (rows, nbBad)
+
+
+def readTweetFiles(twtSQL, paths, processes = None, ordered = True, chunkSize = LINES_PER_CHUNK):
+    """
+    Yields the rows of all the tweets in paths, prepared by twtSQL._prepTweet.
+    JSON decoding and preparing is spread over processes worker processes
+    [Default: number of cores], chunkSize lines at a time.
+    With ordered = False, chunks are yielded as soon as they're done.
+    """
+    processes = processes or cpu_count()
+    nbBad = 0
+
+    if processes <= 1:
+        _initWorker(twtSQL)
+        results = (_prepTweetLines(lines) for lines in _chunks(paths, chunkSize))
+        pool = None
+    else:
+        pool = Pool(processes, _initWorker, (twtSQL, ))
+        imap = pool.imap if ordered else pool.imap_unordered
+        slots = threading.Semaphore(processes * CHUNKS_PER_PROCESS)
+        stopped = threading.Event()
+        results = imap(_prepTweetLines, _boundedChunks(_chunks(paths, chunkSize), slots, stopped))
+
+    done = False
+    try:
+        for rows, bad in results:
+            nbBad += bad
+            for row in rows:
+                yield row
+            if pool:
+                slots.release()
+        done = True
+    finally:
+        if pool:
+            if done:
+                pool.close()
+            else:
+                # The pool's feeding thread may be waiting for a slot
+                stopped.set()
+                slots.release()
+                pool.terminate()
+            pool.join()
+        if nbBad:
+            twtSQL._warn("%d lines couldn't be turned into tweets" % nbBad)
@@ -0,0 +1,99 @@
+"""
+Deciding when the tweets buffered by TwitterMySQL._tweetsToMySQL
+get written to MySQL
+"""
+
+import time
+
+ROW_OVERHEAD = 8 # rough number of bytes counted for non string values
+
+
+def rowSize(row):
+    """Approximate size of a prepared row, in bytes"""
+    return sum(len(v) if isinstance(v, basestring) else ROW_OVERHEAD for v in row)
+
+
+class FlushPolicy(object):
+    """
+    Flushes the buffered tweets on whichever comes first:
+      - maxRows     number of buffered rows
+      - maxBytes    approximate size of the buffered rows (see rowSize)
+      - maxAge      seconds since the oldest buffered row came in (checked
+                    when something comes in, see the flushPolicy option of
+                    TwitterMySQL.tweetsToMySQL for quiet streams)
+    None disables a limit.
+
+    With autoTune = True, maxRows is doubled (up to maxRowsLimit) as long
+    as the insert time per row keeps going down, and halved (down to the
+    original maxRows) when it goes up by more than tolerance.
+
+    The policy keeps track of the current buffer, so each writer needs
+    its own (see copy()).
+    """
+
+    def __init__(self, maxRows = 100, maxBytes = None, maxAge = None,
+                 autoTune = False, maxRowsLimit = 50000, tolerance = 0.1):
+        if not (maxRows or maxBytes or maxAge):
+            raise ValueError("FlushPolicy needs at least one of maxRows, maxBytes or maxAge")
+        self.maxRows = maxRows
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.autoTune = autoTune
+        self.maxRowsLimit = maxRowsLimit
+        self.tolerance = tolerance
+
+        self._minRows = maxRows
+        self._lastRowLatency = None
+        self.reset()
+
+    def copy(self):
+        """Same settings, empty buffer"""
+        policy = FlushPolicy(self.maxRows, self.maxBytes, self.maxAge,
+                             self.autoTune, self.maxRowsLimit, self.tolerance)
+        policy._minRows = self._minRows
+        return policy
+
+    def reset(self):
+        self.nbRows = 0
+        self.nbBytes = 0
+        self.oldest = None
+
+    def add(self, row):
+        """Accounts for a row going into the buffer"""
+        if not self.nbRows:
+            self.oldest = time.time()
+        self.nbRows += 1
+        if self.maxBytes:
+            self.nbBytes += rowSize(row)
+
+    def shouldFlush(self):
+        if not self.nbRows:
+            return False
+        if self.maxRows and self.nbRows >= self.maxRows:
+            return True
+        if self.maxBytes and self.nbBytes >= self.maxBytes:
+            return True
+        if self.maxAge and time.time() - self.oldest >= self.maxAge:
+            return True
+        return False
+
+    def flushed(self, seconds):
+        """
+        To be called once the buffer was written (in that many seconds),
+        resets the buffer and, if autoTune is on, adjusts maxRows
+        """
+        nbRows = self.nbRows
+        self.reset()
+        if not (self.autoTune and self.maxRows and nbRows >= self.maxRows):
+            # Only full batches say something about the batch size
+            return
+        rowLatency = seconds / nbRows
+        if self._lastRowLatency is None or rowLatency < self._lastRowLatency * (1 - self.tolerance):
+            self.maxRows = min(self.maxRows * 2, self.maxRowsLimit)
+        elif rowLatency > self._lastRowLatency * (1 + self.tolerance):
+            self.maxRows = max(self.maxRows / 2, self._minRows)
+        self._lastRowLatency = rowLatency
+
+    def __repr__(self):
+        return "FlushPolicy(maxRows = %s, maxBytes = %s, maxAge = %s, autoTune = %s)" % (
+            self.maxRows, self.maxBytes, self.maxAge, self.autoTune)
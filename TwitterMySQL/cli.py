@@ -1,5 +1,7 @@
 #!/bin/usr/env python
+import sys
 import argparse
+from pprint import pprint
 
 parser = argparse.ArgumentParser(description = "Command line interface for the TwitterMySQL package")
 
@@ -25,11 +27,88 @@ twt.add_argument("--accessToken", dest="ACCESS_TOKEN",
 twt.add_argument("--accessSecret", dest="ACCESS_SECRET",
                  help="Twitter App Access token secret")
 twt.add_argument("-k", "--apiKeysFile", dest="keysFile",
-                 help="You can store your keys in a file. Put the 4 keys on separate lines, preceded by their label followed by a space.")
+                 help="You can store your keys in a file. Put the 4 keys on separate lines, preceded by their label followed by a space. "
+                 + "Several sets of keys can be put in the file, separated by blank lines: requests are spread over them to get more rate limit quota.")
 
 mysql_opt = parser.add_argument_group("Optional MySQL parameters", "Setting optional parameters for the MySQL connection [not an exhaustive list though]")
 mysql_opt.add_argument("-H", "--host", dest="host", default="localhost",
                    help="Host that the MySQL server is on")
+
+insert_opt = parser.add_argument_group("Insertion options", "How tweets are written to MySQL")
+insert_opt.add_argument("--replace", dest="replace", action="store_true",
+                        help="Use REPLACE instead of INSERT (overwrites existing tweets)")
+insert_opt.add_argument("--dedup", dest="dedup", action="store_true",
+                        help="Drop the tweets seen lately (the filter starts with the newest IDs in the table) and only update the follower counts of the ones already in the table, a lot cheaper than --replace")
+insert_opt.add_argument("--monthlyTables", dest="monthlyTables", action="store_true",
+                        help="Insert into monthly tables [table_20YY_MM]")
+insert_opt.add_argument("--partitioned", dest="partitioned", action="store_true",
+                        help="Create the table partitioned by month on created_time instead of using monthly tables (partitions are added ahead of time)")
+insert_opt.add_argument("--bulk", dest="bulk", action="store_true",
+                        help="Bulk load using LOAD DATA LOCAL INFILE (falls back to multi-row INSERTs if the server doesn't allow it)")
+insert_opt.add_argument("--embedded", dest="embedded", action="store_true",
+                        help="Also insert the retweeted and quoted statuses that come in the tweets (no lookups needed for them later)")
+insert_opt.add_argument("--embeddedTable", dest="embeddedTable", default=None,
+                        help="Table (or monthly tables prefix) the retweeted and quoted statuses go to [Default: the table]")
+insert_opt.add_argument("--deferIndexes", dest="deferIndexes", action="store_true",
+                        help="For backfills: create the tables without their secondary indices and add them once all the tweets are in (running an interrupted backfill again builds them)")
+insert_opt.add_argument("--filesDir", dest="filesDir", default=None,
+                        help="Also write the tweets to files partitioned by day in this directory (Parquet if pyarrow is installed, gzip'd TSV otherwise)")
+insert_opt.add_argument("--noMySQL", dest="mysql", action="store_false",
+                        help="Only write the tweets to --filesDir, not to MySQL")
+insert_opt.add_argument("--spool", dest="spool", default=None,
+                        help="Directory of a write-ahead spool: tweets survive crashes and MySQL outages, and are replayed on the next start")
+
+monitoring = parser.add_argument_group("Monitoring", "Console output and metrics")
+monitoring.add_argument("-q", "--quiet", dest="quiet", action="store_true",
+                        help="No output per tweet, query or batch")
+monitoring.add_argument("--metricsFile", dest="metricsFile", default=None,
+                        help="Append the metrics (tweets received, insert times, retries, ...) to this file as JSON lines every 15 seconds")
+monitoring.add_argument("--prometheusFile", dest="prometheusFile", default=None,
+                        help="Write the metrics to this file for node_exporter's textfile collector")
+monitoring.add_argument("--prometheusPort", dest="prometheusPort", type=int, default=None,
+                        help="Serve the metrics on http://localhost:PORT/metrics for Prometheus")
+
+commands = parser.add_subparsers(dest="command", title="Commands")
+
+fileCmd = commands.add_parser("file", help="Insert archived tweets (one JSON tweet per line, .gz and .bz2 too) into MySQL, no Twitter keys needed")
+fileCmd.add_argument("files", nargs="+",
+                     help="Files to read, - for stdin")
+fileCmd.add_argument("-p", "--processes", dest="processes", type=int, default=None,
+                     help="Number of processes decoding tweets [Default: number of cores]")
+fileCmd.add_argument("--unordered", dest="ordered", action="store_false",
+                     help="Insert tweets in whichever order they're decoded (faster)")
+
+timelinesCmd = commands.add_parser("timelines", help="Insert the timelines of many users into MySQL, harvested concurrently within the rate limits")
+timelinesCmd.add_argument("users",
+                          help="File with one screen name (or user ID, see --userIds) per line, - for stdin")
+timelinesCmd.add_argument("--threads", dest="threads", type=int, default=4,
+                          help="Number of timelines harvested at the same time [Default: 4]")
+timelinesCmd.add_argument("--userIds", dest="userKey", action="store_const", const="user_id", default="screen_name",
+                          help="The file has user IDs instead of screen names")
+timelinesCmd.add_argument("--checkpoint", dest="checkpoint", action="store_true",
+                          help="Only get the tweets newer than the ones of the last --checkpoint run (kept in the table_checkpoints table)")
+searchCmd = commands.add_parser("search", help="Insert the results of a Search API query (the past week) into MySQL")
+searchCmd.add_argument("q",
+                       help="Search query, i.e. '#TwitterAPI OR @twitterapi'")
+searchCmd.add_argument("--threads", dest="threads", type=int, default=1,
+                       help="Search windows of --window seconds at the same time instead of paging back one page after the other [Default: 1]")
+searchCmd.add_argument("--window", dest="window", type=int, default=3600,
+                       help="Seconds of tweets per window with --threads [Default: 3600]")
+searchCmd.add_argument("--checkpoint", dest="checkpoint", action="store_true",
+                       help="Only get the tweets newer than the ones of the last --checkpoint run of the query")
+hydrateCmd = commands.add_parser("hydrate", help="Look up a file of tweet IDs (one per line) and insert the tweets into MySQL, skipping the ones already there")
+hydrateCmd.add_argument("ids",
+                        help="File with one tweet ID per line (.gz and .bz2 too), - for stdin")
+hydrateCmd.add_argument("--threads", dest="threads", type=int, default=4,
+                        help="Number of lookups made at the same time [Default: 4]")
+hydrateCmd.add_argument("--progressFile", dest="progressFile", default=None,
+                        help="File keeping track of the IDs done, so that the job can be restarted [Default: the IDs file + .progress]")
+daemonCmd = commands.add_parser("daemon", help="Run the jobs of a JSON config (streams, periodic timelines and searches) in one process, "
+                                + "restarting the ones that fail, until SIGTERM (see TwitterMySQL.daemon for the config)")
+daemonCmd.add_argument("config",
+                       help="JSON config file, its twitterMySQL parameters take the place of the MySQL and Twitter ones above")
+daemonCmd.add_argument("--drainTimeout", dest="drainTimeout", type=int, default=60,
+                       help="Seconds the jobs get to write what they hold on SIGTERM [Default: 60]")
 """
         Optional parameters:
           - noWarnings      disable MySQL warnings [Default: False]
@@ -51,19 +130,115 @@ mysql_opt.add_argument("-H", "--host", dest="host", default="localhost",
 """
 
 
-args = parser.parse_args()
-params = vars(args)
+INSERT_ARGS = ["replace", "monthlyTables", "bulk", "spool", "dedup", "deferIndexes"]
+# Parameters that aren't printed
+SECRET_PARAMS = ["API_KEY", "API_SECRET", "ACCESS_TOKEN", "ACCESS_SECRET", "passwd", "password"]
 
-if args.API_KEY and args.API_SECRET and args.ACCESS_TOKEN and args.ACCESS_SECRET:
-    if args.keysFile:
-        print "Found both a keyFile and the 4 TwitterAPI keys in command line, using the command line keys over the file"
-elif args.keysFile and not (args.API_KEY or args.API_SECRET or args.ACCESS_TOKEN or args.ACCESS_SECRET):
-    with open(args.keysFile) as a:
-        params.update({line.split(" ")[0]: line.split(" ")[1] for line in [l.strip() for l in a]})
-    print "Read keyfile, should be okay"
-else:
-    raise ValueError("Missing twitter API keys, please include them either as arguments or in a file, or use -h for help")
 
-del params["keysFile"]
-from pprint import pprint
-pprint(params)
+def twitterKeys(args):
+    """Twitter API keys from the command line or the keys file"""
+    keys = dict((k, getattr(args, k)) for k in ("API_KEY", "API_SECRET", "ACCESS_TOKEN", "ACCESS_SECRET"))
+    if all(keys.values()):
+        if args.keysFile:
+            print "Found both a keyFile and the 4 TwitterAPI keys in command line, using the command line keys over the file"
+    elif args.keysFile and not any(keys.values()):
+        from .credentials import readKeysFile
+        keys = {"credentials": readKeysFile(args.keysFile)}
+        print "Read keyfile, found %d set(s) of keys" % len(keys["credentials"])
+    else:
+        raise ValueError("Missing twitter API keys, please include them either as arguments or in a file, or use -h for help")
+    return keys
+
+
+def redacted(params):
+    """params without the Twitter keys and the MySQL password, to be printed"""
+    shown = dict((k, "<hidden>" if k in SECRET_PARAMS and v else v) for k, v in params.iteritems())
+    if "credentials" in shown:
+        shown["credentials"] = "<%d set(s) of keys>" % len(shown["credentials"])
+    return shown
+
+
+def reporters(args):
+    """Metrics reporters asked for on the command line"""
+    from .metrics import JSONLinesReporter, PrometheusTextfileReporter, PrometheusHTTPReporter
+    reporters = []
+    if args.metricsFile:
+        reporters.append(JSONLinesReporter(args.metricsFile))
+    if args.prometheusFile:
+        reporters.append(PrometheusTextfileReporter(args.prometheusFile))
+    if args.prometheusPort:
+        reporters.append(PrometheusHTTPReporter(args.prometheusPort))
+    return reporters
+
+
+def sinks(args):
+    """File sinks asked for on the command line"""
+    if not args.filesDir:
+        if not args.mysql:
+            raise ValueError("--noMySQL needs --filesDir, the tweets have to go somewhere")
+        return []
+    from .sinks import ParquetSink, TSVSink
+    try:
+        return [ParquetSink(args.filesDir)]
+    except ImportError:
+        print "pyarrow isn't installed, writing gzip'd TSV files instead of Parquet"
+        return [TSVSink(args.filesDir)]
+
+
+def daemon(args):
+    """Runs the jobs of args.config until SIGTERM, with the monitoring options of the command line"""
+    from .daemon import Supervisor
+    overrides = {}
+    if args.quiet:
+        overrides["quiet"] = True
+    if args.metricsFile or args.prometheusFile or args.prometheusPort:
+        overrides["reporters"] = reporters(args)
+    supervisor = Supervisor.fromConfig(args.config, **overrides)
+    supervisor.drainTimeout = args.drainTimeout
+    if not supervisor.run():
+        sys.exit(1)
+
+
+def main(argv = None):
+    args = parser.parse_args(argv)
+    if args.command == "daemon":
+        return daemon(args)
+    params = {"db": args.database, "table": args.table, "host": args.host,
+              "quiet": args.quiet, "reporters": reporters(args),
+              "sinks": sinks(args), "mysql": args.mysql,
+              "embedded": args.embedded or bool(args.embeddedTable), "embeddedTable": args.embeddedTable,
+              "partitioned": args.partitioned,
+              # Spooled tweets can come in before MySQL is up
+              "lazyConnect": bool(args.spool)}
+    if args.bulk:
+        # LOAD DATA LOCAL INFILE has to be allowed by every connection
+        params["local_infile"] = 1
+    options = dict((k, getattr(args, k)) for k in INSERT_ARGS)
+
+    if args.command == "file":
+        # Archived tweets don't need Twitter
+        params["api"] = None
+    else:
+        params.update(twitterKeys(args))
+    if not args.quiet:
+        pprint(redacted(params))
+
+    from .TwitterMySQL import TwitterMySQL
+    twtSQL = TwitterMySQL(**params)
+
+    if args.command == "file":
+        twtSQL.fileToMySQL(args.files, processes = args.processes, ordered = args.ordered, **options)
+    elif args.command == "timelines":
+        users = sys.stdin if args.users == "-" else open(args.users)
+        twtSQL.userTimelinesToMySQL((line.strip() for line in users), threads = args.threads,
+                                    userKey = args.userKey, checkpoint = args.checkpoint, **options)
+    elif args.command == "search":
+        twtSQL.searchToMySQL(q = args.q, threads = args.threads, window = args.window,
+                             checkpoint = args.checkpoint, **options)
+    elif args.command == "hydrate":
+        progressFile = args.progressFile or (args.ids + ".progress" if args.ids != "-" else None)
+        twtSQL.hydrateToMySQL(args.ids, threads = args.threads, progressFile = progressFile, **options)
+
+
+if __name__ == "__main__":
+    main()
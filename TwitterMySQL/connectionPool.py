@@ -0,0 +1,114 @@
+"""
+Small pool of MySQL connections shared by the threads of a TwitterMySQL object
+"""
+
+import threading, time
+
+MYSQL_ERR_CONNECTION_LOST = (2006, 2013, 2055) # server has gone away, lost connection
+
+
+class ConnectionPool(object):
+    """
+    Hands out at most size connections (made with connect(**kwargs)),
+    acquire() blocks when they're all in use.
+    Connections that sat idle for more than pingInterval seconds are
+    pinged before being handed out, and replaced if they're dead.
+    """
+
+    def __init__(self, connect, kwargs, size = 4, pingInterval = 30):
+        self._connect = connect
+        self.kwargs = kwargs
+        self.size = size
+        self.pingInterval = pingInterval
+
+        self._idle = [] # (connection, time it was released)
+        self._nbOpen = 0
+        self._lock = threading.Condition(threading.Lock())
+
+        # Counters
+        self.nbConnects = 0
+        self.nbReconnects = 0
+
+    def _newConnection(self):
+        self.nbConnects += 1
+        return self._connect(**self.kwargs)
+
+    def isAlive(self, connection):
+        """Health check: pings the server"""
+        try:
+            connection.ping()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, blocking = True):
+        """A connection, or None if they're all in use and not blocking"""
+        with self._lock:
+            while not self._idle and self._nbOpen >= self.size:
+                if not blocking:
+                    return None
+                self._lock.wait()
+            if self._idle:
+                connection, released = self._idle.pop()
+            else:
+                connection, released = (None, None)
+                self._nbOpen += 1
+
+        if connection is not None and time.time() - released > self.pingInterval and not self.isAlive(connection):
+            self.nbReconnects += 1
+            self._close(connection)
+            connection = None
+        if connection is None:
+            try:
+                connection = self._newConnection()
+            except Exception:
+                with self._lock:
+                    self._nbOpen -= 1
+                    self._lock.notify()
+                raise
+        return connection
+
+    def resize(self, size):
+        """Allows size connections from now on (open ones are kept when shrinking)"""
+        with self._lock:
+            self.size = size
+            self._lock.notify_all()
+
+    def release(self, connection, broken = False):
+        """Gives a connection back, broken ones get closed"""
+        with self._lock:
+            if broken:
+                self._nbOpen -= 1
+            else:
+                self._idle.append((connection, time.time()))
+            self._lock.notify()
+        if broken:
+            self._close(connection)
+
+    def replace(self, connection):
+        """
+        Swaps a dead connection for a new one. If the new one can't be
+        made, the dead one is still dropped from the pool (acquire() it again)
+        """
+        self.nbReconnects += 1
+        self._close(connection)
+        try:
+            return self._newConnection()
+        except Exception:
+            with self._lock:
+                self._nbOpen -= 1
+                self._lock.notify()
+            raise
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def closeAll(self):
+        with self._lock:
+            idle, self._idle = (self._idle, [])
+            self._nbOpen -= len(idle)
+        for connection, released in idle:
+            self._close(connection)
@@ -0,0 +1,86 @@
+"""
+Cooperative flavour of TwitterMySQL, running on gevent greenlets with the
+pure python PyMySQL driver: Twitter requests, MySQL queries and waits
+all yield to the other greenlets instead of blocking a thread, so that
+one process can drive several streams, REST harvesters and writers.
+
+gevent has to patch the standard library before anything else is
+imported, so programs using it start with:
+
+    from gevent import monkey; monkey.patch_all()
+    from TwitterMySQL.cooperative import AsyncTwitterMySQL
+
+Needs gevent and PyMySQL (pip install gevent PyMySQL).
+"""
+
+import sys, datetime
+from warnings import filterwarnings
+
+try:
+    import gevent
+    from gevent import monkey
+    from gevent.pool import Group
+    import pymysql
+except ImportError:
+    gevent = None
+
+from .TwitterMySQL import TwitterMySQL
+
+# The module, "from . import TwitterMySQL" gives the class of the same name
+core = sys.modules[TwitterMySQL.__module__]
+
+# Greenlets are cheap, connections are what's limited
+ASYNC_POOL_SIZE = 16
+
+if gevent:
+    core.MYSQL_ERRORS.append(pymysql.err.MySQLError)
+    core.MYSQL_OPERATIONAL_ERRORS.append(pymysql.err.OperationalError)
+
+
+class AsyncTwitterMySQL(TwitterMySQL):
+    """
+    TwitterMySQL whose requests, queries and waits are cooperative
+    (gevent), with the same column mapping, monthly routing and insertion
+    options. The threads of userTimelines, hydrateToMySQL, pipelined
+    writes, etc. are greenlets once gevent patched threading.
+
+    Any method can run concurrently with the others with spawn(), i.e.:
+
+        twtSQL = AsyncTwitterMySQL(db = "twitter", table = "tweets", keysFile = "keys.txt")
+        twtSQL.spawn(twtSQL.filterStreamToMySQL, track = "Taylor Swift", monthlyTables = True)
+        twtSQL.spawn(twtSQL.userTimelinesToMySQL, open("users.txt"), threads = 32)
+        twtSQL.joinAll()
+
+    Takes the same parameters as TwitterMySQL, connectFunction defaults
+    to pymysql.connect and poolSize to ASYNC_POOL_SIZE.
+    """
+
+    def __init__(self, **kwargs):
+        if gevent is None:
+            raise ImportError("AsyncTwitterMySQL needs gevent and PyMySQL (pip install gevent PyMySQL)")
+        if not (monkey.is_module_patched("socket") and monkey.is_module_patched("threading")):
+            raise RuntimeError("gevent didn't patch the standard library, call gevent.monkey.patch_all() "
+                               + "before importing TwitterMySQL")
+        if kwargs.get("noWarnings"):
+            filterwarnings('ignore', category = pymysql.Warning)
+        if "connectFunction" not in kwargs:
+            kwargs["connectFunction"] = pymysql.connect
+        if "poolSize" not in kwargs:
+            kwargs["poolSize"] = ASYNC_POOL_SIZE
+
+        self._greenlets = Group()
+        super(AsyncTwitterMySQL, self).__init__(**kwargs)
+
+    def _wait(self, t, verbose = True):
+        """A single cooperative sleep, countdowns of several greenlets would garble each other"""
+        if verbose:
+            self._log("\rWaiting %s" % datetime.timedelta(seconds = t))
+        gevent.sleep(t)
+
+    def spawn(self, method, *args, **kwargs):
+        """Runs method(*args, **kwargs) in a new greenlet, returns the greenlet"""
+        return self._greenlets.spawn(method, *args, **kwargs)
+
+    def joinAll(self, timeout = None, raiseError = True):
+        """Waits for the spawned greenlets, raising the first exception of one of them"""
+        self._greenlets.join(timeout, raise_error = raiseError)
@@ -0,0 +1,100 @@
+"""
+Several sets of Twitter app keys used together, so that REST requests
+aren't all limited by a single rate limit window
+"""
+
+import time, threading
+from itertools import count
+
+from .rateLimits import RateLimiter, STREAMING_METHODS, DEFAULT_WINDOW
+
+KEY_NAMES = ("API_KEY", "API_SECRET", "ACCESS_TOKEN", "ACCESS_SECRET")
+
+
+def readKeysFile(path):
+    """
+    Reads Twitter keys from a file: the 4 keys on separate lines, each
+    preceded by its label and a space (i.e. "API_KEY abc123").
+    Several sets of keys can be put in the same file, separated by a blank
+    line. Returns a list of {label: key} dictionaries.
+    """
+    credentials = []
+    current = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                if current:
+                    credentials.append(current)
+                    current = {}
+                continue
+            label, key = line.split(" ", 1)
+            if label in current:
+                # No blank line between the two sets
+                credentials.append(current)
+                current = {}
+            current[label] = key.strip()
+    if current:
+        credentials.append(current)
+
+    for i, keys in enumerate(credentials):
+        missing = [k for k in KEY_NAMES if k not in keys]
+        if missing:
+            raise ValueError("Set of keys #%d in %s is missing %s" % (i+1, path, ", ".join(missing)))
+    return credentials
+
+
+class CredentialPool(object):
+    """
+    Routes each request to one of several TwitterAPI objects (one per set
+    of keys), each with its own RateLimiter.
+    REST requests go to the credential with the most quota left for the
+    endpoint; if none has any, acquire() sleeps until the first window resets.
+    Streaming requests go round robin (Twitter allows one stream per app).
+    """
+
+    def __init__(self, apis, sleep = time.sleep, window = DEFAULT_WINDOW):
+        if not apis:
+            raise ValueError("CredentialPool needs at least one TwitterAPI object")
+        self.apis = list(apis)
+        self.limiters = [RateLimiter(sleep, window) for api in self.apis]
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._streamTurn = count()
+
+        self.nbWaits = 0
+        self.waited = 0.0
+
+    def __len__(self):
+        return len(self.apis)
+
+    def acquire(self, endpoint):
+        """Returns the (api, limiter) the request should use, waiting for quota if needed"""
+        if endpoint in STREAMING_METHODS:
+            i = next(self._streamTurn) % len(self.apis)
+            return (self.apis[i], self.limiters[i])
+
+        while True:
+            with self._lock:
+                # Most quota left first (unknown quota counts as plenty)
+                remaining = [limiter.remaining(endpoint) for limiter in self.limiters]
+                order = sorted(xrange(len(self.apis)),
+                               key = lambda i: -remaining[i] if remaining[i] is not None else -float("inf"))
+                waits = []
+                for i in order:
+                    wait = self.limiters[i].tryAcquire(endpoint)
+                    if not wait:
+                        return (self.apis[i], self.limiters[i])
+                    waits.append(wait)
+            wait = min(waits)
+            self.nbWaits += 1
+            self.waited += wait
+            self._sleep(wait + 1)
+
+    def waitTime(self, endpoint):
+        """Seconds until any of the credentials can make a request to endpoint"""
+        return min(limiter.waitTime(endpoint) for limiter in self.limiters)
+
+    def remaining(self, endpoint):
+        """Total known quota left for endpoint"""
+        return sum(limiter.remaining(endpoint) or 0 for limiter in self.limiters)
@@ -0,0 +1,210 @@
+"""
+Runs several jobs in one supervised process: streams (sample, filter)
+and periodic timeline or search refreshes, sharing the MySQL connection
+pool, the Twitter credentials and the metrics of one TwitterMySQL
+(see python -m TwitterMySQL.cli daemon config.json). The config is JSON:
+
+    {"twitterMySQL": {"db": "twitter", "table": "tweets", "keysFile": "keys.txt"},
+     "jobs": [{"name": "sample", "type": "sample", "monthlyTables": true},
+              {"name": "election", "type": "filter", "table": "election",
+               "track": "vote,election", "dedup": true},
+              {"name": "accounts", "type": "timelines", "users": "users.txt",
+               "every": 86400, "threads": 8, "checkpoint": true},
+              {"name": "api", "type": "search", "q": "#TwitterAPI",
+               "every": 3600, "threads": 4, "checkpoint": true}]}
+
+twitterMySQL holds the TwitterMySQL parameters. Each job has a type
+(see JOB_TYPES), optionally a name, a table [Default: the twitterMySQL
+one] and, for timelines and searches, every (seconds between the starts
+of two runs). Everything else is passed to the *ToMySQL method.
+"""
+
+import sys, time, json, signal, threading, traceback
+
+JOB_TYPES = ("sample", "filter", "timelines", "search")
+STREAM_TYPES = ("sample", "filter")
+# Seconds before a job that ended or failed is restarted, doubled on each
+# restart up to MAX_RESTART_WAIT, back to RESTART_WAIT after a STABLE_RUN
+RESTART_WAIT = 5
+MAX_RESTART_WAIT = 300
+STABLE_RUN = 600
+# Seconds the jobs get to write what they hold on SIGTERM
+DRAIN_TIMEOUT = 60
+
+
+class Job(object):
+    """One entry of the jobs of the config"""
+
+    def __init__(self, config):
+        params = dict(config)
+        self.type = params.pop("type", None)
+        if self.type not in JOB_TYPES:
+            raise ValueError("Unknown job type '%s', use one of: %s" % (self.type, ", ".join(JOB_TYPES)))
+        self.name = params.pop("name", None) or self.type
+        self.table = params.pop("table", None)
+        self.every = params.pop("every", None)
+        if self.type in STREAM_TYPES:
+            if self.every:
+                raise ValueError("Job %s: streams run all the time, every is for timelines and searches" % self.name)
+            # The stream keeps being read while MySQL is slow, and stops promptly
+            params.setdefault("pipelined", True)
+        elif self.type == "timelines" and "users" not in params:
+            raise ValueError("Job %s: timelines jobs need users (a file of screen names or user IDs)" % self.name)
+        self.params = params
+
+        self.nbRuns = 0
+        self.nbFailures = 0
+
+    @property
+    def isStream(self):
+        return self.type in STREAM_TYPES
+
+    @property
+    def nbConnections(self):
+        """MySQL connections the job holds while it runs (its writers, times the tables written in parallel)"""
+        writers = self.params.get("writers", 1) if self.params.get("pipelined") else 1
+        return max(1, writers) * max(1, self.params.get("parallelTables", 1))
+
+    def run(self, twtSQL):
+        params = dict(self.params)
+        if self.type == "sample":
+            twtSQL.randomSampleToMySQL(**params)
+        elif self.type == "filter":
+            twtSQL.filterStreamToMySQL(**params)
+        elif self.type == "timelines":
+            # Read again on each run, users can be added in between
+            with open(params.pop("users")) as users:
+                twtSQL.userTimelinesToMySQL((line.strip() for line in users), **params)
+        else:
+            twtSQL.searchToMySQL(**params)
+
+
+class Supervisor(object):
+    """
+    Runs each job in its own thread, on twtSQL (or twtSQL.forTable(table)
+    for the jobs writing elsewhere). Streams that end or fail, and
+    periodic jobs that fail, are restarted after RESTART_WAIT seconds,
+    doubling up to MAX_RESTART_WAIT. stop() (SIGTERM or SIGINT with run())
+    makes the jobs write the tweets they hold and waits for them up to
+    drainTimeout seconds.
+    """
+
+    def __init__(self, twtSQL, jobs, drainTimeout = DRAIN_TIMEOUT):
+        self.twtSQL = twtSQL
+        self.jobs = [job if isinstance(job, Job) else Job(job) for job in jobs]
+        self.drainTimeout = drainTimeout
+        self._stopped = threading.Event()
+        self._threads = []
+
+        names = [job.name for job in self.jobs]
+        if len(set(names)) != len(names):
+            raise ValueError("Job names have to be unique: %s" % ", ".join(names))
+        # Stream writers keep their connection for as long as the stream
+        # runs, a pool smaller than that leaves some jobs waiting forever
+        nbConnections = sum(job.nbConnections for job in self.jobs) + 1
+        if twtSQL._pool.size < nbConnections:
+            twtSQL._log("Growing the MySQL connection pool from %d to %d connections for the jobs" % (
+                twtSQL._pool.size, nbConnections))
+            twtSQL.poolSize = nbConnections
+            twtSQL._pool.resize(nbConnections)
+
+        nbStreams = sum(1 for job in self.jobs if job.isStream)
+        if nbStreams > len(twtSQL._credentials):
+            # Twitter disconnects the older stream of a set of keys
+            twtSQL._warn("%d streams for %d set(s) of keys, Twitter allows one stream per set"
+                         % (nbStreams, len(twtSQL._credentials)))
+
+    @classmethod
+    def fromConfig(cls, path, **twtSQLParams):
+        """Supervisor of the jobs of the config file, twtSQLParams override its twitterMySQL"""
+        with open(path) as f:
+            config = json.load(f)
+        # JSON strings are unicode, MySQLdb wants str keywords
+        params = dict((str(k), v) for k, v in config.get("twitterMySQL", {}).iteritems())
+        params.update(twtSQLParams)
+        jobs = [dict((str(k), v) for k, v in job.iteritems()) for job in config.get("jobs", [])]
+        if not jobs:
+            raise ValueError("No jobs in %s" % path)
+        if any(job.get("spool") for job in jobs):
+            # Spooled tweets can come in before MySQL is up
+            params.setdefault("lazyConnect", True)
+        if any(job.get("bulk") for job in jobs):
+            # LOAD DATA LOCAL INFILE has to be allowed by every connection
+            params.setdefault("local_infile", 1)
+        from .TwitterMySQL import TwitterMySQL
+        return cls(TwitterMySQL(**params), jobs)
+
+    def _supervise(self, job):
+        twtSQL = self.twtSQL.forTable(job.table) if job.table else self.twtSQL
+        wait = RESTART_WAIT
+        while not self._stopped.is_set():
+            start = time.time()
+            job.nbRuns += 1
+            failed = False
+            try:
+                job.run(twtSQL)
+            except Exception as e:
+                failed = True
+                job.nbFailures += 1
+                twtSQL.metrics.inc("job_failures")
+                twtSQL._warn("Job %s failed: [%s]\n%s" % (job.name, e, traceback.format_exc()))
+            finally:
+                # Back to the pool while waiting
+                twtSQL._disconnect()
+            if self._stopped.is_set():
+                break
+
+            if time.time() - start > STABLE_RUN:
+                wait = RESTART_WAIT
+            if job.every and not failed:
+                pause = max(0, job.every - (time.time() - start))
+            else:
+                pause = wait
+                wait = min(MAX_RESTART_WAIT, wait * 2)
+                twtSQL.metrics.inc("job_restarts")
+                twtSQL._warn("Job %s %s, restarting it in %d seconds" % (job.name, "failed" if failed else "ended", pause))
+            self._stopped.wait(pause)
+
+    def start(self):
+        """Starts the jobs, each in its own thread"""
+        # The jobs have their own connections, the one made by TwitterMySQL() goes back to the pool
+        self.twtSQL._disconnect()
+        for job in self.jobs:
+            thread = threading.Thread(target = self._supervise, args = (job, ), name = "TwitterMySQL-job-%s" % job.name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """The jobs write what they hold and don't restart"""
+        self._stopped.set()
+        self.twtSQL.stop()
+
+    def join(self, timeout = None):
+        """Waits for the jobs, returns the names of those still running after timeout seconds"""
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            while thread.is_alive() and (deadline is None or time.time() < deadline):
+                # Short joins, so that signals get handled
+                thread.join(1)
+        return [thread.name for thread in self._threads if thread.is_alive()]
+
+    def run(self):
+        """Runs the jobs until SIGTERM or SIGINT, then drains them"""
+        def handler(signum, frame):
+            self.twtSQL._log("\nSignal %d received, writing what's left and stopping" % signum)
+            self.stop()
+        signal.signal(signal.SIGTERM, handler)
+        signal.signal(signal.SIGINT, handler)
+
+        self.start()
+        while not self._stopped.is_set():
+            # Event.wait without a timeout would hold off the signals
+            self._stopped.wait(1)
+
+        running = self.join(self.drainTimeout)
+        if running:
+            self.twtSQL._warn("Still running after %d seconds, left behind: %s" % (self.drainTimeout, ", ".join(running)))
+        for job in self.jobs:
+            self.twtSQL._log("Job %s: %d run(s), %d failure(s)" % (job.name, job.nbRuns, job.nbFailures))
+        return not running
@@ -0,0 +1,124 @@
+"""
+Filters of the tweet IDs seen lately, so that duplicates (reconnects,
+overlapping searches and timelines, replays) are dropped before they
+get to MySQL (see tweetsToMySQL(dedup = ...))
+  - RecentIdFilter  exact, the last maxSize IDs
+  - BloomFilter     a lot less memory, but a few new tweets are taken
+                    for duplicates (errorRate)
+"""
+
+import math, threading
+from collections import deque
+from array import array
+
+RECENT_IDS = 1000000
+BLOOM_CAPACITY = 10000000
+BLOOM_ERROR_RATE = 0.0001
+
+
+class RecentIdFilter(object):
+    """
+    Remembers the last maxSize IDs (oldest forgotten first). Thread safe.
+    seeded is set once the filter was given the newest IDs of the table.
+    """
+
+    def __init__(self, maxSize = RECENT_IDS):
+        self.maxSize = maxSize
+        self.seeded = False
+        self._ids = set()
+        self._order = deque()
+        self._lock = threading.Lock()
+
+        self.nbSeen = 0
+        self.nbDuplicates = 0
+
+    def add(self, tweetId):
+        """Remembers tweetId, returns False if it was seen already (a duplicate)"""
+        tweetId = long(tweetId)
+        with self._lock:
+            self.nbSeen += 1
+            if tweetId in self._ids:
+                self.nbDuplicates += 1
+                return False
+            self._ids.add(tweetId)
+            self._order.append(tweetId)
+            if len(self._order) > self.maxSize:
+                self._ids.discard(self._order.popleft())
+            return True
+
+    def seed(self, ids):
+        """Remembers ids (i.e. the newest ones in MySQL) without counting them"""
+        for tweetId in ids:
+            self.add(tweetId)
+        with self._lock:
+            self.nbSeen = 0
+            self.nbDuplicates = 0
+        self.seeded = True
+
+    def __contains__(self, tweetId):
+        return long(tweetId) in self._ids
+
+    def size(self):
+        """Number of IDs remembered"""
+        return len(self._ids)
+
+    def stats(self):
+        return {"seen": self.nbSeen, "duplicates": self.nbDuplicates, "size": self.size()}
+
+
+class BloomFilter(RecentIdFilter):
+    """
+    Bloom filters of capacity IDs each, for an error rate of errorRate
+    (~19 bits per ID at 0.01%). Two generations are kept: once the
+    current one holds capacity IDs, it becomes the previous one and the
+    oldest is forgotten, so that memory stays bounded.
+    A false positive drops a tweet that isn't in MySQL, use a
+    RecentIdFilter if that's not acceptable.
+    """
+
+    def __init__(self, capacity = BLOOM_CAPACITY, errorRate = BLOOM_ERROR_RATE):
+        super(BloomFilter, self).__init__(capacity)
+        # Optimal number of bits and of hashes
+        self.nbBits = int(math.ceil(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        self.nbHashes = max(1, int(round(self.nbBits / float(capacity) * math.log(2))))
+        self._current = self._newBits()
+        self._previous = None
+        self._nbCurrent = 0
+
+    def _newBits(self):
+        return array("B", [0]) * ((self.nbBits + 7) // 8)
+
+    def _positions(self, tweetId):
+        # Double hashing, the IDs are random enough in their low bits
+        h1 = hash(tweetId) & 0xffffffffffffffff
+        h2 = (hash((tweetId, 0x9e3779b9)) & 0xffffffffffffffff) | 1
+        return [(h1 + i * h2) % self.nbBits for i in xrange(self.nbHashes)]
+
+    def _isIn(self, bits, positions):
+        for p in positions:
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add(self, tweetId):
+        positions = self._positions(long(tweetId))
+        with self._lock:
+            self.nbSeen += 1
+            if self._isIn(self._current, positions) or (self._previous and self._isIn(self._previous, positions)):
+                self.nbDuplicates += 1
+                return False
+            bits = self._current
+            for p in positions:
+                bits[p >> 3] |= 1 << (p & 7)
+            self._nbCurrent += 1
+            if self._nbCurrent >= self.maxSize:
+                self._previous, self._current = (self._current, self._newBits())
+                self._nbCurrent = 0
+            return True
+
+    def __contains__(self, tweetId):
+        positions = self._positions(long(tweetId))
+        return self._isIn(self._current, positions) or bool(self._previous and self._isIn(self._previous, positions))
+
+    def size(self):
+        return self._nbCurrent + (self.maxSize if self._previous else 0)
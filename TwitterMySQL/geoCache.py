@@ -0,0 +1,154 @@
+"""
+Caching in front of the (slow) geoLocate callback of TwitterMySQL
+"""
+
+import os, math, atexit, threading
+import cPickle as pickle
+from collections import OrderedDict
+
+# Largest grid cell (degrees, about 11 km): probes can't tell much about bigger ones
+MAX_GRID_SIZE = 0.1
+
+
+class CachedGeoLocator(object):
+    """
+    Wraps a geoLocate function ((state, address) = geoLocate(lat, lon))
+    with an LRU cache keyed on the coordinates rounded to precision decimals
+    (3 decimals is about 100 meters).
+
+    Optional parameters:
+      - maxSize     number of cached coordinates [Default: 100000]
+      - gridSize    size (in degrees, up to MAX_GRID_SIZE) of the cells of a
+                    grid index for state(): the corners and center of a cell
+                    and of its 8 neighbours are geolocated (once), if they're
+                    all in the same state, the cell resolves to it without
+                    calling geoLocate anymore. Cells on or next to a border
+                    go through the LRU cache. Addresses (__call__) always
+                    do, so TwitterMySQL only uses the grid for tables
+                    without a coordinates_address column
+                    [Default: None, no grid]
+      - cacheFile   file the cache is loaded from and saved to (on exit and
+                    with save()), so that restarts are warm [Default: None]
+    """
+
+    def __init__(self, geoLocate, precision = 3, maxSize = 100000, gridSize = None, cacheFile = None):
+        if gridSize and gridSize > MAX_GRID_SIZE:
+            raise ValueError("gridSize can't be more than %s degrees, bigger cells are too likely to cross a border" % MAX_GRID_SIZE)
+        self.geoLocate = geoLocate
+        self.precision = precision
+        self.maxSize = maxSize
+        self.gridSize = gridSize
+        self.cacheFile = cacheFile
+
+        self._cache = OrderedDict()
+        self._cells = {} # cell: state of its probes, or False if they're in several states
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.gridHits = 0
+
+        if cacheFile:
+            if os.path.exists(cacheFile):
+                self.load()
+            atexit.register(self.save)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.gridSize)), int(math.floor(lon / self.gridSize)))
+
+    def _probeCell(self, cell):
+        """Probes the corners and center of a cell, returns the state if it's the same everywhere"""
+        with self._lock:
+            if cell in self._cells:
+                return self._cells[cell]
+        south, west = (cell[0] * self.gridSize, cell[1] * self.gridSize)
+        north, east = (south + self.gridSize, west + self.gridSize)
+        points = [(south, west), (south, east), (north, west), (north, east),
+                  (south + self.gridSize / 2.0, west + self.gridSize / 2.0)]
+        states = set(self.geoLocate(lat, lon)[0] for lat, lon in points)
+        state = states.pop() if len(states) == 1 and None not in states else False
+        with self._lock:
+            self._cells[cell] = state
+        return state
+
+    def _cellState(self, cell):
+        """State of the cell if it and its neighbours are all in it (far enough from borders), else False"""
+        state = self._probeCell(cell)
+        if not state:
+            return False
+        for dLat in (-1, 0, 1):
+            for dLon in (-1, 0, 1):
+                if (dLat or dLon) and self._probeCell((cell[0] + dLat, cell[1] + dLon)) != state:
+                    return False
+        return state
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                value = self._cache.pop(key)
+                self._cache[key] = value
+                return value
+        return None
+
+    def _lookup(self, key, lat, lon):
+        """geoLocate, outside of the lock: it's slow and the writer threads share the cache"""
+        value = self.geoLocate(lat, lon)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = value
+            if len(self._cache) > self.maxSize:
+                self._cache.popitem(last = False)
+        return value
+
+    def __call__(self, lat, lon):
+        """(state, address), like geoLocate"""
+        key = (round(lat, self.precision), round(lon, self.precision))
+        value = self._cached(key)
+        if value is None:
+            value = self._lookup(key, lat, lon)
+        return value
+
+    def state(self, lat, lon):
+        """Only the state, which the grid (see gridSize) can answer for whole cells"""
+        key = (round(lat, self.precision), round(lon, self.precision))
+        value = self._cached(key)
+        if value is not None:
+            return value[0]
+        if self.gridSize:
+            state = self._cellState(self._cell(lat, lon))
+            if state:
+                with self._lock:
+                    self.gridHits += 1
+                return state
+        return self._lookup(key, lat, lon)[0]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.gridHits + self.misses
+            return {"hits": self.hits, "gridHits": self.gridHits, "misses": self.misses,
+                    "hitRate": float(self.hits + self.gridHits) / total if total else 0.0,
+                    "size": len(self._cache), "cells": len(self._cells)}
+
+    def save(self, cacheFile = None):
+        cacheFile = cacheFile or self.cacheFile
+        if not cacheFile:
+            raise ValueError("No cacheFile to save the geolocation cache to")
+        with self._lock:
+            state = {"precision": self.precision, "gridSize": self.gridSize,
+                     "cache": self._cache.items(), "cells": self._cells}
+        tmp = cacheFile + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, cacheFile)
+
+    def load(self, cacheFile = None):
+        """Loads a saved cache, unless it was made with a different precision or grid"""
+        cacheFile = cacheFile or self.cacheFile
+        with open(cacheFile, "rb") as f:
+            state = pickle.load(f)
+        with self._lock:
+            if state["precision"] == self.precision:
+                self._cache = OrderedDict(state["cache"][-self.maxSize:])
+            if state["gridSize"] == self.gridSize:
+                self._cells = state["cells"]
@@ -0,0 +1,203 @@
+"""
+Counters and histograms on what TwitterMySQL is doing (tweets received,
+parse and insert times, retries, rate limit waits, ...) and reporters
+exposing them: Prometheus (textfile collector or HTTP endpoint) and
+periodic JSON lines (see TwitterMySQL(metrics = ..., reporters = [...]))
+"""
+
+import sys, os, time, json, atexit, threading
+from bisect import bisect_left
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds (seconds) of the latency buckets
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+REPORT_INTERVAL = 15
+
+
+class Histogram(object):
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative, total = ([], 0)
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {"buckets": cumulative, "sum": self.sum, "count": self.count}
+
+
+class Metrics(object):
+    """
+    Thread safe registry of counters (inc), histograms (observe) and
+    gauges (functions called when a snapshot is taken, i.e. to read
+    counters kept elsewhere).
+    """
+
+    def __init__(self, prefix = "twittermysql"):
+        self.prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, n = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, value, buckets = DEFAULT_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, function):
+        with self._lock:
+            self._gauges[name] = function
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((name, h.snapshot()) for name, h in self._histograms.iteritems())
+            gauges = self._gauges.items()
+        values = {}
+        for name, function in gauges:
+            try:
+                values[name] = function()
+            except Exception:
+                pass
+        return {"time": time.time(), "counters": counters, "histograms": histograms, "gauges": values}
+
+
+class NullMetrics(Metrics):
+    """Metrics turned off (TwitterMySQL(metrics = False)), nothing is recorded"""
+
+    def inc(self, name, n = 1):
+        pass
+
+    def observe(self, name, value, buckets = DEFAULT_BUCKETS):
+        pass
+
+
+def prometheusText(snapshot, prefix = "twittermysql"):
+    """Snapshot in the Prometheus text exposition format"""
+    lines = []
+    for name, value in sorted(snapshot["counters"].iteritems()):
+        lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+        lines.append("%s_%s_total %s" % (prefix, name, value))
+    for name, value in sorted(snapshot["gauges"].iteritems()):
+        lines.append("# TYPE %s_%s gauge" % (prefix, name))
+        lines.append("%s_%s %s" % (prefix, name, value))
+    for name, histogram in sorted(snapshot["histograms"].iteritems()):
+        lines.append("# TYPE %s_%s histogram" % (prefix, name))
+        for bound, count in histogram["buckets"]:
+            lines.append('%s_%s_bucket{le="%s"} %d' % (prefix, name, "+Inf" if bound == float("inf") else repr(bound), count))
+        lines.append("%s_%s_sum %r" % (prefix, name, histogram["sum"]))
+        lines.append("%s_%s_count %d" % (prefix, name, histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+
+class Reporter(object):
+    """
+    Reports the metrics every interval seconds from a background thread,
+    and once more on exit. Subclasses implement report(snapshot).
+    """
+
+    def __init__(self, interval = REPORT_INTERVAL):
+        self.interval = interval
+        self._metrics = None
+        self._stopped = threading.Event()
+
+    def start(self, metrics):
+        self._metrics = metrics
+        thread = threading.Thread(target = self._run, name = "TwitterMySQL-%s" % self.__class__.__name__)
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.report(self._metrics.snapshot())
+
+    def stop(self):
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self.report(self._metrics.snapshot())
+
+    def report(self, snapshot):
+        raise NotImplementedError
+
+
+class JSONLinesReporter(Reporter):
+    """Appends a JSON snapshot to path (or a file object, i.e. sys.stderr) every interval seconds"""
+
+    def __init__(self, path = None, interval = REPORT_INTERVAL):
+        super(JSONLinesReporter, self).__init__(interval)
+        self.stream = open(path, "a") if isinstance(path, basestring) else (path or sys.stderr)
+
+    def report(self, snapshot):
+        snapshot = dict(snapshot, histograms = dict(
+            (name, dict(h, buckets = [(repr(bound), count) for bound, count in h["buckets"]]))
+            for name, h in snapshot["histograms"].iteritems()))
+        self.stream.write(json.dumps(snapshot) + "\n")
+        self.stream.flush()
+
+
+class PrometheusTextfileReporter(Reporter):
+    """Rewrites path (for node_exporter's textfile collector) every interval seconds"""
+
+    def __init__(self, path, interval = REPORT_INTERVAL):
+        super(PrometheusTextfileReporter, self).__init__(interval)
+        self.path = path
+
+    def report(self, snapshot):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(prometheusText(snapshot, self._metrics.prefix))
+        os.rename(tmp, self.path)
+
+
+class PrometheusHTTPReporter(object):
+    """Serves the metrics on http://host:port/metrics for Prometheus to scrape"""
+
+    def __init__(self, port = 9108, host = ""):
+        self.port = port
+        self.host = host
+        self.server = None
+
+    def start(self, metrics):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] not in ("/", "/metrics"):
+                    handler.send_error(404)
+                    return
+                body = prometheusText(metrics.snapshot(), metrics.prefix)
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = HTTPServer((self.host, self.port), Handler)
+        thread = threading.Thread(target = self.server.serve_forever, name = "TwitterMySQL-PrometheusHTTPReporter")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
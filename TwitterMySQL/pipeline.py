@@ -0,0 +1,241 @@
+"""
+Bounded producer/consumer queue used to decouple reading a Twitter
+stream from writing to MySQL (see TwitterMySQL.tweetsToMySQL(pipelined = True))
+"""
+
+import threading, tempfile, struct, zlib
+import cPickle as pickle
+from collections import deque
+
+from .batching import rowSize
+
+OVERFLOW_POLICIES = ("block", "dropOldest", "spill")
+# Rows pickled (and compressed) together when spilled
+SPILL_CHUNK_ROWS = 1000
+# Size of the spill files, each one is deleted once read back
+SPILL_SEGMENT_BYTES = 16 * 2**20
+
+
+class Spill(object):
+    """
+    Rows written to disk and read back in the same order (not thread
+    safe, TweetQueue holds its lock). Rows are pickled and compressed
+    chunkRows at a time, into temporary segment files of about
+    segmentBytes, so that the disk space of what was read back is given
+    back during a long catch up instead of at the end.
+    """
+
+    def __init__(self, chunkRows = SPILL_CHUNK_ROWS, segmentBytes = SPILL_SEGMENT_BYTES):
+        self.chunkRows = chunkRows
+        self.segmentBytes = segmentBytes
+
+        self._segments = deque() # [file, read position, size], written to the last one
+        self._writing = [] # rows of the chunk being filled
+        self._reading = deque() # rows of the chunk read back
+
+        self.nbRows = 0
+        self.nbBytes = 0 # on disk
+
+    def __len__(self):
+        return self.nbRows
+
+    def append(self, row):
+        self._writing.append(row)
+        self.nbRows += 1
+        if len(self._writing) >= self.chunkRows:
+            self._writeChunk()
+
+    def popleft(self):
+        if not self._reading:
+            self._readChunk()
+        self.nbRows -= 1
+        return self._reading.popleft()
+
+    def _writeChunk(self):
+        data = zlib.compress(pickle.dumps(self._writing, pickle.HIGHEST_PROTOCOL), 1)
+        if not self._segments or self._segments[-1][2] >= self.segmentBytes:
+            self._segments.append([tempfile.TemporaryFile(prefix = "TwitterMySQL_spill_"), 0, 0])
+        segment = self._segments[-1]
+        segment[0].seek(0, 2)
+        segment[0].write(struct.pack("<I", len(data)))
+        segment[0].write(data)
+        segment[2] += 4 + len(data)
+        self.nbBytes += 4 + len(data)
+        self._writing = []
+
+    def _readChunk(self):
+        while self._segments:
+            segment = self._segments[0]
+            if segment[1] < segment[2]:
+                segment[0].seek(segment[1])
+                size = struct.unpack("<I", segment[0].read(4))[0]
+                self._reading = deque(pickle.loads(zlib.decompress(segment[0].read(size))))
+                segment[1] += 4 + size
+                return
+            # Read back entirely
+            segment[0].close()
+            self.nbBytes -= segment[2]
+            self._segments.popleft()
+        # Everything on disk was read back, the chunk being filled is next
+        self._reading = deque(self._writing)
+        self._writing = []
+
+    def close(self):
+        for segment in self._segments:
+            segment[0].close()
+        self._segments.clear()
+        self.nbBytes = 0
+
+
+class TweetQueue(object):
+    """
+    Thread safe FIFO of prepared tweet rows with a bounded depth:
+    maxSize rows and, if set, maxBytes (high-water mark of the rows in
+    memory, see batching.rowSize).
+    What happens when the queue is full depends on the overflow policy:
+      - block       put() waits until a writer makes room
+      - dropOldest  the oldest row in memory is discarded
+      - spill       rows are written to disk (see Spill) and read back
+                    (in order) once the writers catch up
+    Iterating over the queue yields rows until close() was called and
+    the queue is empty. If tickInterval is set, None is yielded every
+    tickInterval seconds without rows, so that consumers can do
+    time based work (i.e. flushing old rows) on quiet streams.
+    """
+
+    def __init__(self, maxSize = 10000, overflow = "block", tickInterval = None, maxBytes = None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '%s', use one of: %s" % (overflow, ", ".join(OVERFLOW_POLICIES)))
+        self.maxSize = maxSize
+        self.maxBytes = maxBytes
+        self.overflow = overflow
+        self.tickInterval = tickInterval
+
+        self._rows = deque()
+        self._sizes = deque()
+        self._bytes = 0
+        self._lock = threading.Condition(threading.Lock())
+        self._closed = False
+
+        self._spill = None
+
+        # Counters
+        self.nbPut = 0
+        self.nbGot = 0
+        self.nbDropped = 0
+        self.nbSpilled = 0
+        self.peakSize = 0
+        self.peakBytes = 0
+
+    @property
+    def _spilled(self):
+        return len(self._spill) if self._spill else 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rows) + self._spilled
+
+    def _full(self):
+        return len(self._rows) >= self.maxSize or (self.maxBytes and self._bytes >= self.maxBytes)
+
+    def _append(self, row, size):
+        self._rows.append(row)
+        self._sizes.append(size)
+        self._bytes += size
+
+    def _popleft(self):
+        self._bytes -= self._sizes.popleft()
+        return self._rows.popleft()
+
+    def put(self, row):
+        size = rowSize(row) if self.maxBytes else 0
+        with self._lock:
+            if self._closed:
+                raise ValueError("put() on a closed TweetQueue")
+            self.nbPut += 1
+            if self._spilled or self._full():
+                if self.overflow == "block":
+                    while self._rows and self._full():
+                        self._lock.wait()
+                elif self.overflow == "dropOldest":
+                    if self._rows:
+                        self._popleft()
+                        self.nbDropped += 1
+                else:
+                    # Everything goes to disk until the spill has been read back,
+                    # otherwise the order of the rows would get mixed up
+                    if self._spill is None:
+                        self._spill = Spill()
+                    self._spill.append(row)
+                    self.nbSpilled += 1
+                    self.peakSize = max(self.peakSize, len(self._rows) + self._spilled)
+                    self._lock.notify_all()
+                    return
+            self._append(row, size)
+            self.peakSize = max(self.peakSize, len(self._rows) + self._spilled)
+            self.peakBytes = max(self.peakBytes, self._bytes)
+            self._lock.notify_all()
+
+    def _unspill(self):
+        """Moves spilled rows back in memory, as many as there's room for"""
+        while self._spilled and (not self._rows or not self._full()):
+            row = self._spill.popleft()
+            self._append(row, rowSize(row) if self.maxBytes else 0)
+
+    def get(self, timeout = None):
+        """
+        Returns the next row, waiting for one if needed.
+        Returns None if the queue is closed and empty or if timeout
+        seconds went by without a row coming in.
+        """
+        with self._lock:
+            while not self._rows and not self._spilled:
+                if self._closed:
+                    return None
+                self._lock.wait(timeout)
+                if timeout is not None and not self._rows and not self._spilled:
+                    return None
+            if not self._rows:
+                self._unspill()
+            self.nbGot += 1
+            row = self._popleft()
+            self._lock.notify_all()
+            return row
+
+    def close(self):
+        """No more rows will come in, consumers stop once the queue is empty"""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    @property
+    def closed(self):
+        with self._lock:
+            return self._closed and not self._rows and not self._spilled
+
+    def __iter__(self):
+        while True:
+            row = self.get(self.tickInterval)
+            if row is not None:
+                yield row
+            elif self.closed:
+                return
+            else:
+                yield None
+
+    def stats(self):
+        """Counters on the occupancy of the queue"""
+        with self._lock:
+            return {"size": len(self._rows) + self._spilled,
+                    "inMemory": len(self._rows),
+                    "onDisk": self._spilled,
+                    "bytes": self._bytes,
+                    "maxBytes": self.maxBytes,
+                    "peakBytes": self.peakBytes,
+                    "bytesOnDisk": self._spill.nbBytes if self._spill else 0,
+                    "maxSize": self.maxSize,
+                    "peakSize": self.peakSize,
+                    "put": self.nbPut,
+                    "got": self.nbGot,
+                    "dropped": self.nbDropped,
+                    "spilled": self.nbSpilled}
@@ -0,0 +1,102 @@
+"""
+Keeping track of Twitter's REST rate limits
+(x-rate-limit-remaining and x-rate-limit-reset response headers)
+"""
+
+import time, threading
+
+STREAMING_METHODS = frozenset(("statuses/sample", "statuses/filter", "statuses/firehose"))
+DEFAULT_WINDOW = 15*60
+
+
+class RateLimiter(object):
+    """
+    Per endpoint quota accounting, shared by all the threads making requests.
+    acquire() takes one request out of the endpoint's quota, waiting for the
+    window to reset if it's used up; update() corrects the quota with what
+    Twitter says in its response headers.
+    Endpoints that were never seen are not limited until Twitter says so.
+    When Twitter says the quota is used up without saying when it resets,
+    window seconds are waited.
+    """
+
+    def __init__(self, sleep = time.sleep, window = DEFAULT_WINDOW):
+        self._limits = {} # endpoint: [remaining, reset (epoch seconds)]
+        self._lock = threading.Lock()
+        self._sleep = sleep
+        self.window = window
+
+        self.nbWaits = 0
+        self.waited = 0.0
+
+    def update(self, endpoint, headers):
+        try:
+            remaining = int(headers["x-rate-limit-remaining"])
+            reset = float(headers["x-rate-limit-reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            current = self._limits.get(endpoint)
+            if current and current[1] == reset:
+                # Other requests might be in flight, only ever lower the quota of a window
+                current[0] = min(current[0], remaining)
+            else:
+                self._limits[endpoint] = [remaining, reset]
+
+    def exhausted(self, endpoint, reset = None):
+        """Twitter said the quota is used up (error code 88)"""
+        with self._lock:
+            current = self._limits.get(endpoint)
+            if reset is None:
+                reset = current[1] if current and current[1] > time.time() else time.time() + self.window
+            self._limits[endpoint] = [0, reset]
+
+    def waitTime(self, endpoint):
+        """Seconds until a request to endpoint can be made (0 if now)"""
+        with self._lock:
+            return self._waitTime(endpoint, time.time())
+
+    def _waitTime(self, endpoint, now):
+        current = self._limits.get(endpoint)
+        if not current or current[0] > 0 or current[1] <= now:
+            return 0
+        return current[1] - now
+
+    def remaining(self, endpoint):
+        """Requests left in the current window, None if unknown"""
+        with self._lock:
+            current = self._limits.get(endpoint)
+            if not current or current[1] <= time.time():
+                return None
+            return current[0]
+
+    def tryAcquire(self, endpoint):
+        """
+        Takes one request out of endpoint's quota if there's some left and
+        returns 0, otherwise returns the number of seconds until the reset
+        """
+        if endpoint in STREAMING_METHODS:
+            return 0
+        with self._lock:
+            now = time.time()
+            wait = self._waitTime(endpoint, now)
+            if not wait:
+                current = self._limits.get(endpoint)
+                if current:
+                    if current[1] <= now:
+                        # New window, the real quota comes with the next response
+                        del self._limits[endpoint]
+                    else:
+                        current[0] -= 1
+            return wait
+
+    def acquire(self, endpoint):
+        """Waits until endpoint has quota left, and takes one request out of it"""
+        while True:
+            wait = self.tryAcquire(endpoint)
+            if not wait:
+                return
+            self.nbWaits += 1
+            self.waited += wait
+            # Sleep only until the exact reset (plus a second of slack for clock skew)
+            self._sleep(wait + 1)
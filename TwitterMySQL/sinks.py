@@ -0,0 +1,209 @@
+"""
+Sinks: where prepared tweet rows go besides (or instead of) MySQL, as
+files partitioned by day (directory/year=YYYY/month=MM/day=DD/), which
+analytics tools can read directly (see TwitterMySQL(sinks = [...]))
+  - ParquetSink  columnar Parquet files (needs pyarrow)
+  - TSVSink      gzip compressed TSV files, in LOAD DATA INFILE format
+"""
+
+import os, re, time, gzip, datetime, threading
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .TwitterMySQL import _tsvField
+
+ROW_GROUP_SIZE = 50000
+ROWS_PER_FILE = 1000000
+# Entries of a SQLfieldsExp that aren't columns
+NOT_COLUMNS = re.compile(r"^\s*(index|key|primary|unique|constraint|partition)\b", re.I)
+
+
+class Sink(object):
+    """
+    Rows are buffered per day partition (from their created_time) and
+    written rowGroupSize at a time. A file is finished (renamed from
+    .tmp to its name) once it holds rowsPerFile rows, and on flush().
+    Thread safe. Subclasses implement _open, _writeRows and _close.
+    """
+
+    extension = None
+
+    def __init__(self, directory, rowGroupSize = ROW_GROUP_SIZE, rowsPerFile = ROWS_PER_FILE):
+        self.directory = directory
+        self.rowGroupSize = rowGroupSize
+        self.rowsPerFile = rowsPerFile
+
+        self.columns = None
+        self._createdIndex = None
+        self._buffers = {} # partition: [rows]
+        self._files = {} # partition: [handle, temporary path, rows written]
+        self._lock = threading.Lock()
+        self._nbOpened = 0
+
+        self.nbRows = 0
+        self.nbFiles = 0
+
+    def bind(self, columns, columnsDescription):
+        """Called by TwitterMySQL with its columns and their MySQL description"""
+        self.columns = list(columns)
+        self._createdIndex = self.columns.index("created_time") if "created_time" in self.columns else None
+        self.columnTypes = [d.split()[1].lower() if len(d.split()) > 1 else "text"
+                            for d in columnsDescription if not NOT_COLUMNS.match(d)]
+
+    def _partition(self, row):
+        created = row[self._createdIndex] if self._createdIndex is not None else None
+        if not created or len(created) < 10:
+            return ("unknown", )
+        return (created[:4], created[5:7], created[8:10])
+
+    def _path(self, partition):
+        if len(partition) == 1:
+            directory = os.path.join(self.directory, "day=%s" % partition[0])
+        else:
+            directory = os.path.join(self.directory, "year=%s" % partition[0],
+                                     "month=%s" % partition[1], "day=%s" % partition[2])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._nbOpened += 1
+        return os.path.join(directory, "part-%s-%d-%05d%s" % (time.strftime("%Y%m%d%H%M%S"), os.getpid(),
+                                                               self._nbOpened, self.extension))
+
+    def write(self, rows):
+        with self._lock:
+            for row in rows:
+                partition = self._partition(row)
+                try:
+                    self._buffers[partition].append(row)
+                except KeyError:
+                    self._buffers[partition] = [row]
+            for partition, buffered in self._buffers.items():
+                if len(buffered) >= self.rowGroupSize:
+                    self._writeGroup(partition)
+
+    def _writeGroup(self, partition):
+        rows = self._buffers.pop(partition, None)
+        if not rows:
+            return
+        current = self._files.get(partition)
+        if not current:
+            path = self._path(partition)
+            current = self._files[partition] = [self._open(path + ".tmp"), path, 0]
+        self._writeRows(current[0], rows)
+        current[2] += len(rows)
+        self.nbRows += len(rows)
+        if current[2] >= self.rowsPerFile:
+            self._finish(partition)
+
+    def _finish(self, partition):
+        handle, path, nbRows = self._files.pop(partition)
+        self._close(handle)
+        os.rename(path + ".tmp", path)
+        self.nbFiles += 1
+
+    def flush(self):
+        """Writes everything buffered and finishes the files, later rows go to new files"""
+        with self._lock:
+            for partition in self._buffers.keys():
+                self._writeGroup(partition)
+            for partition in self._files.keys():
+                self._finish(partition)
+
+    close = flush
+
+    def _open(self, path):
+        raise NotImplementedError
+
+    def _writeRows(self, handle, rows):
+        raise NotImplementedError
+
+    def _close(self, handle):
+        raise NotImplementedError
+
+
+class TSVSink(Sink):
+    """
+    Gzip compressed TSV files (one gzip member per row group), in the
+    format LOAD DATA INFILE reads, so that they can go into MySQL later too
+    """
+
+    extension = ".tsv.gz"
+
+    def __init__(self, directory, rowGroupSize = ROW_GROUP_SIZE, rowsPerFile = ROWS_PER_FILE, compressLevel = 6):
+        super(TSVSink, self).__init__(directory, rowGroupSize, rowsPerFile)
+        self.compressLevel = compressLevel
+
+    def _open(self, path):
+        return open(path, "wb")
+
+    def _writeRows(self, handle, rows):
+        member = gzip.GzipFile(fileobj = handle, mode = "wb", compresslevel = self.compressLevel)
+        for row in rows:
+            member.write("\t".join(_tsvField(v) for v in row))
+            member.write("\n")
+        member.close()
+
+    def _close(self, handle):
+        handle.close()
+
+
+class ParquetSink(Sink):
+    """
+    Columnar Parquet files, with one row group per rowGroupSize rows and
+    a schema following the MySQL column types (integers, datetimes as
+    timestamps, floats, everything else as strings). Needs pyarrow.
+    """
+
+    extension = ".parquet"
+
+    def __init__(self, directory, rowGroupSize = ROW_GROUP_SIZE, rowsPerFile = ROWS_PER_FILE, compression = "snappy"):
+        if pyarrow is None:
+            raise ImportError("ParquetSink needs pyarrow (pip install pyarrow), TSVSink doesn't need anything")
+        super(ParquetSink, self).__init__(directory, rowGroupSize, rowsPerFile)
+        self.compression = compression
+        self.schema = None
+
+    def bind(self, columns, columnsDescription):
+        super(ParquetSink, self).bind(columns, columnsDescription)
+        self._converters = []
+        fields = []
+        for column, mysqlType in zip(self.columns, self.columnTypes):
+            if "int" in mysqlType:
+                arrowType, convert = (pyarrow.int64(), long)
+            elif mysqlType.startswith(("datetime", "timestamp")):
+                arrowType, convert = (pyarrow.timestamp("s"),
+                                      lambda v: datetime.datetime.strptime(v, "%Y-%m-%d %H:%M:%S"))
+            elif mysqlType.startswith(("float", "double", "decimal", "real")):
+                arrowType, convert = (pyarrow.float64(), float)
+            else:
+                arrowType, convert = (pyarrow.string(),
+                                      lambda v: v.decode("utf-8", "replace") if isinstance(v, str) else unicode(v))
+            fields.append(pyarrow.field(column, arrowType))
+            self._converters.append(convert)
+        self.schema = pyarrow.schema(fields)
+
+    def _open(self, path):
+        return pyarrow.parquet.ParquetWriter(path, self.schema, compression = self.compression)
+
+    def _column(self, rows, i):
+        convert = self._converters[i]
+        values = []
+        for row in rows:
+            value = row[i]
+            if value is not None:
+                try:
+                    value = convert(value)
+                except (ValueError, TypeError):
+                    value = None
+            values.append(value)
+        return pyarrow.array(values, type = self.schema[i].type)
+
+    def _writeRows(self, handle, rows):
+        arrays = [self._column(rows, i) for i in xrange(len(self.columns))]
+        handle.write_table(pyarrow.Table.from_arrays(arrays, schema = self.schema))
+
+    def _close(self, handle):
+        handle.close()
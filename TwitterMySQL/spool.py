@@ -0,0 +1,207 @@
+"""
+Write-ahead spool of prepared tweet rows, so that buffered tweets survive
+crashes and MySQL outages (see TwitterMySQL.tweetsToMySQL(spool = ...))
+"""
+
+import os, time, struct, zlib, threading
+import cPickle as pickle
+
+SEGMENT_ROWS = 10000
+SYNC_EVERY = 1000
+SYNC_INTERVAL = 1.0
+RETRY_WAIT = 2
+MAX_RETRY_WAIT = 60
+
+# Every record is its length and crc32 followed by the pickled row
+RECORD_HEADER = struct.Struct("<II")
+
+
+class Spool(object):
+    """
+    Append-only segmented files of rows in directory (one process per
+    directory). Rows are appended to the current segment of the writing
+    thread, segments are sealed before their rows are written to MySQL
+    and deleted (acknowledged) once MySQL has them, or renamed .failed
+    (rejected) if MySQL gives up on them, to be looked at (see read()).
+    Segments that are still there when a Spool is made (the process was
+    killed or MySQL was down) are pending, to be claimed and replayed.
+
+    Appends are fsync'ed every syncEvery rows or syncInterval seconds,
+    whichever comes first, that's what a crash can lose at most.
+    A segment is sealed on its own once it holds segmentRows rows.
+
+    The spool also keeps track of MySQL being down (backoff()), so that
+    writers don't keep trying while it's not back (waiting()).
+    """
+
+    def __init__(self, directory, segmentRows = SEGMENT_ROWS, syncEvery = SYNC_EVERY, syncInterval = SYNC_INTERVAL):
+        self.directory = directory
+        self.segmentRows = segmentRows
+        self.syncEvery = syncEvery
+        self.syncInterval = syncInterval
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._open = {} # thread ident: [segment, file, rows, rows since the last sync, last sync time]
+        self._claimed = set()
+        self._sealed = []
+        for name in os.listdir(directory):
+            number, ext = os.path.splitext(name)
+            if ext in (".open", ".seg") and number.isdigit():
+                if ext == ".open":
+                    # Left over by a crash
+                    os.rename(os.path.join(directory, name), self._path(int(number)))
+                self._sealed.append(int(number))
+        self._sealed.sort()
+        self._next = self._sealed[-1] + 1 if self._sealed else 1
+
+        self._retryAt = 0
+        self._retryWait = 0
+
+        # Counters
+        self.nbAppended = 0
+        self.nbAcked = 0
+        self.nbRejected = 0
+        self.nbReplayed = 0
+        self.nbSyncs = 0
+
+    def _path(self, segment, ext = ".seg"):
+        return os.path.join(self.directory, "%012d%s" % (segment, ext))
+
+    def append(self, row):
+        data = pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+        ident = threading.current_thread().ident
+        current = self._open.get(ident)
+        if not current:
+            with self._lock:
+                segment = self._next
+                self._next += 1
+            current = [segment, open(self._path(segment, ".open"), "ab"), 0, 0, time.time()]
+            self._open[ident] = current
+        current[1].write(RECORD_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        current[1].write(data)
+        current[2] += 1
+        current[3] += 1
+        self.nbAppended += 1
+        if current[3] >= self.syncEvery or time.time() - current[4] >= self.syncInterval:
+            self._sync(current)
+        if current[2] >= self.segmentRows:
+            self._seal(ident, False)
+
+    def _sync(self, current):
+        current[1].flush()
+        os.fsync(current[1].fileno())
+        current[3] = 0
+        current[4] = time.time()
+        self.nbSyncs += 1
+
+    def _seal(self, ident, claim):
+        current = self._open.pop(ident, None)
+        if not current:
+            return None
+        segment, f = current[:2]
+        self._sync(current)
+        f.close()
+        os.rename(self._path(segment, ".open"), self._path(segment))
+        with self._lock:
+            self._sealed.append(segment)
+            self._sealed.sort()
+            if claim:
+                self._claimed.add(segment)
+        return segment
+
+    def seal(self):
+        """
+        Seals the current thread's segment and claims it (see claim()),
+        returns its number or None if the thread had nothing spooled
+        """
+        return self._seal(threading.current_thread().ident, True)
+
+    def claim(self):
+        """Oldest sealed segment nobody is replaying, or None"""
+        with self._lock:
+            for segment in self._sealed:
+                if segment not in self._claimed:
+                    self._claimed.add(segment)
+                    return segment
+        return None
+
+    def release(self, segment):
+        """Gives up on a claimed segment (MySQL didn't take it), it'll be claimed again"""
+        with self._lock:
+            self._claimed.discard(segment)
+
+    def ack(self, segment):
+        """MySQL has the rows of segment, it can go"""
+        os.remove(self._path(segment))
+        with self._lock:
+            self._claimed.discard(segment)
+            self._sealed.remove(segment)
+        self.nbAcked += 1
+
+    def reject(self, segment):
+        """
+        MySQL won't take the rows of segment (i.e. they break a constraint):
+        it's renamed .failed, out of the replays, and its path returned
+        """
+        path = self._path(segment, ".failed")
+        os.rename(self._path(segment), path)
+        with self._lock:
+            self._claimed.discard(segment)
+            self._sealed.remove(segment)
+        self.nbRejected += 1
+        return path
+
+    def read(self, segment, ext = ".seg"):
+        """
+        Yields the rows of a sealed segment (or of a rejected one, with
+        ext = ".failed"), up to the first torn or corrupt record
+        """
+        with open(self._path(segment, ext), "rb") as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                size, crc = RECORD_HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) < size or zlib.crc32(data) & 0xffffffff != crc:
+                    return
+                self.nbReplayed += 1
+                yield pickle.loads(data)
+
+    def pending(self):
+        """Number of sealed segments waiting to go into MySQL"""
+        with self._lock:
+            return len(self._sealed)
+
+    def backoff(self):
+        """MySQL is down, don't try again for a while (doubling up to MAX_RETRY_WAIT)"""
+        with self._lock:
+            self._retryWait = min(MAX_RETRY_WAIT, self._retryWait * 2 or RETRY_WAIT)
+            self._retryAt = time.time() + self._retryWait
+            return self._retryWait
+
+    def recovered(self):
+        with self._lock:
+            self._retryAt = 0
+            self._retryWait = 0
+
+    def waiting(self):
+        """True while MySQL is considered down"""
+        return time.time() < self._retryAt
+
+    def close(self):
+        """Seals the segments of all threads, they'll be replayed by the next Spool"""
+        for ident in list(self._open):
+            self._seal(ident, False)
+
+    def stats(self):
+        with self._lock:
+            return {"appended": self.nbAppended,
+                    "acked": self.nbAcked,
+                    "rejected": self.nbRejected,
+                    "replayed": self.nbReplayed,
+                    "syncs": self.nbSyncs,
+                    "pending": len(self._sealed)}
@@ -0,0 +1,4 @@
+"""
+Benchmarks for TwitterMySQL, runnable without Twitter or MySQL:
+  python -m benchmarks.run --help
+"""
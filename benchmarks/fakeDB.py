@@ -0,0 +1,183 @@
+"""
+Database backends for benchmarking TwitterMySQL without a MySQL server.
+Use them through TwitterMySQL(connectFunction = ...):
+  - RecordingConnection  accepts everything, records the queries and can
+                         simulate insert latency
+  - SQLiteConnection     translates TwitterMySQL's MySQL dialect to SQLite,
+                         so that the inserted rows can actually be checked
+For a local mysqld, just leave connectFunction out.
+"""
+
+import re, time, threading
+import sqlite3
+
+import MySQLdb
+
+
+class RecordingCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows = ()
+
+    def execute(self, query, args = None):
+        self.connection._record(query, 1)
+        m = re.match(r"\s*show tables like '(.*)'", query, re.I)
+        if m:
+            self._rows = ((m.group(1), ), ) if m.group(1) in self.connection.tables else ()
+            return len(self._rows)
+        m = re.match(r"\s*create table (\S+)", query, re.I)
+        if m:
+            self.connection.tables.add(m.group(1))
+        m = re.match(r"\s*drop table (\S+)", query, re.I)
+        if m:
+            self.connection.tables.discard(m.group(1))
+        self._rows = ()
+        return 1
+
+    def executemany(self, query, values):
+        values = list(values)
+        self.connection._record(query, len(values))
+        if self.connection.latencyPerQuery or self.connection.latencyPerRow:
+            time.sleep(self.connection.latencyPerQuery + self.connection.latencyPerRow * len(values))
+        return len(values)
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class RecordingConnection(object):
+    """
+    Connection that only records what's sent to it: self.queries holds
+    (query, number of rows), shared by all the connections made with the
+    same RecordingDB.
+    """
+
+    def __init__(self, db, latencyPerQuery = 0.0, latencyPerRow = 0.0):
+        self.db = db
+        self.tables = db.tables
+        self.latencyPerQuery = latencyPerQuery
+        self.latencyPerRow = latencyPerRow
+
+    def _record(self, query, nbRows):
+        with self.db.lock:
+            self.db.queries.append((query, nbRows))
+            self.db.nbRows += nbRows
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+class RecordingDB(object):
+    """connectFunction making RecordingConnections that share what they record"""
+
+    def __init__(self, latencyPerQuery = 0.0, latencyPerRow = 0.0):
+        self.latencyPerQuery = latencyPerQuery
+        self.latencyPerRow = latencyPerRow
+        self.queries = []
+        self.nbRows = 0
+        self.tables = set()
+        self.lock = threading.Lock()
+
+    def __call__(self, **kwargs):
+        return RecordingConnection(self, self.latencyPerQuery, self.latencyPerRow)
+
+
+MYSQL_TO_SQLITE = [(re.compile(r"^\s*insert ignore into", re.I), "INSERT OR IGNORE INTO"),
+                   (re.compile(r"on duplicate key update", re.I), "ON CONFLICT DO UPDATE SET"),
+                   (re.compile(r"values\((\w+)\)", re.I), r"excluded.\1"),
+                   (re.compile(r",\s*index \w+ \([^)]*\)", re.I), ""),
+                   (re.compile(r"%s"), "?")]
+
+
+class SQLiteCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self._cur = connection._sqlite.cursor()
+        self._rows = ()
+
+    def _translate(self, query):
+        m = re.match(r"\s*show tables like '(.*)'", query, re.I)
+        if m:
+            return ("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?", (m.group(1), ))
+        if re.match(r"\s*load data", query, re.I):
+            raise MySQLdb.OperationalError(1148, "The used command is not allowed with this MySQL version")
+        for pattern, replacement in MYSQL_TO_SQLITE:
+            query = pattern.sub(replacement, query)
+        return (query, None)
+
+    def execute(self, query, args = None):
+        query, extraArgs = self._translate(query)
+        with self.connection._lock:
+            self._cur.execute(query, extraArgs or args or ())
+            self.connection._sqlite.commit()
+            if self._cur.description is None:
+                self._rows = ()
+                return self._cur.rowcount
+            self._rows = tuple(self._cur.fetchall())
+            return len(self._rows)
+
+    def executemany(self, query, values):
+        query, extraArgs = self._translate(query)
+        with self.connection._lock:
+            self._cur.executemany(query, [tuple(v) for v in values])
+            self.connection._sqlite.commit()
+            return self._cur.rowcount
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class SQLiteConnection(object):
+    """
+    Local MySQL stand-in: TwitterMySQL's queries run against a SQLite
+    database (path, ":memory:" by default, shared by all connections
+    made with the same SQLiteDB). LOAD DATA raises error 1148, so
+    bulk mode uses its multi-row INSERT fallback.
+    """
+
+    def __init__(self, db):
+        self._sqlite = db.sqlite
+        self._lock = db.lock
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+class SQLiteDB(object):
+    """connectFunction making SQLiteConnections to the same database"""
+
+    def __init__(self, path = ":memory:"):
+        self.sqlite = sqlite3.connect(path, check_same_thread = False)
+        self.sqlite.text_factory = str
+        self.lock = threading.RLock()
+
+    def __call__(self, **kwargs):
+        return SQLiteConnection(self)
+
+    def count(self, table):
+        with self.lock:
+            return self.sqlite.execute("SELECT count(*) FROM %s" % table).fetchone()[0]
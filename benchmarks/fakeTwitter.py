@@ -0,0 +1,152 @@
+"""
+Synthetic tweets and a fake TwitterAPI replaying them, so that TwitterMySQL
+can be benchmarked without Twitter credentials.
+"""
+
+import time, random
+
+from requests.exceptions import ChunkedEncodingError
+
+TWITTER_EPOCH_MS = 1288834974657
+TWITTER_TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+DEFAULT_START = 1420070400 # 2015-01-01, so that runs are reproducible
+
+WORDS = ("the", "a", "love", "today", "#TwitterAPI", "coffee", "&amp;", "&lt;3", "philly",
+         "game", "music", "lol", "new", u"\u2764", "http://t.co/abc", "@someone")
+SOURCES = ('<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>',
+           '<a href="http://twitter.com/download/android" rel="nofollow">Twitter for Android</a>',
+           '<a href="http://twitter.com" rel="nofollow">Twitter Web Client</a>')
+PLACES = (u"Philadelphia, PA", u"New York, NY", u"Austin, TX", u"Seattle, WA")
+# Continental US bounding box
+LON_RANGE, LAT_RANGE = ((-124.85, -66.89), (24.40, 49.38))
+
+
+def snowflake(timestamp, sequence = 0):
+    """Tweet ID of a tweet sent at timestamp (seconds)"""
+    return ((int(timestamp * 1000) - TWITTER_EPOCH_MS) << 22) + sequence
+
+
+def tweetGenerator(nbTweets = None, start = None, tweetsPerSecond = 50.0, geoFraction = 0.02,
+                   retweetFraction = 0.3, nbUsers = 100000, seed = 0):
+    """
+    Yields nbTweets (endless if None) random but realistic looking JSON tweets,
+    with increasing IDs and created_at times starting at start (epoch seconds)
+    [Default: DEFAULT_START]
+    """
+    rand = random.Random(seed)
+    t = start if start is not None else DEFAULT_START
+    i = 0
+    while nbTweets is None or i < nbTweets:
+        i += 1
+        t += rand.expovariate(tweetsPerSecond)
+        tweetId = snowflake(t, i % 4096)
+        userId = rand.randint(1, nbUsers)
+        tweet = {"created_at": time.strftime(TWITTER_TIME_FORMAT, time.gmtime(t)),
+                 "id": tweetId, "id_str": str(tweetId),
+                 "text": u" ".join(rand.choice(WORDS) for w in xrange(rand.randint(3, 20))),
+                 "source": rand.choice(SOURCES),
+                 "in_reply_to_status_id_str": None, "in_reply_to_user_id_str": None,
+                 "user": {"id": userId, "id_str": str(userId),
+                          "location": rand.choice(PLACES + (u"", None)),
+                          "friends_count": rand.randint(0, 5000),
+                          "followers_count": rand.randint(0, 50000)},
+                 "place": None, "coordinates": None,
+                 "lang": rand.choice(("en", "en", "en", "es", "fr"))}
+        if rand.random() < geoFraction:
+            lon, lat = (rand.uniform(*LON_RANGE), rand.uniform(*LAT_RANGE))
+            tweet["coordinates"] = {"type": "Point", "coordinates": [lon, lat]}
+            tweet["place"] = {"full_name": rand.choice(PLACES)}
+        if rand.random() < retweetFraction:
+            retweeted = snowflake(t - rand.uniform(0, 3600))
+            tweet["retweeted_status"] = {"id": retweeted, "id_str": str(retweeted)}
+        yield tweet
+
+
+class FakeResponse(object):
+    def __init__(self, items, headers = None, status_code = 200):
+        self._items = items
+        self.headers = headers or {}
+        self.status_code = status_code
+
+    def get_iterator(self):
+        return iter(self._items)
+
+
+class FakeTwitterAPI(object):
+    """
+    Stands in for TwitterAPI.TwitterAPI:
+      - streaming endpoints (statuses/sample, statuses/filter) replay nbTweets
+        tweets, at most tweetsPerSecond of them per second (None: as fast as
+        possible), with a delete notice for every deleteEvery tweets and a
+        ChunkedEncodingError every chunkedErrorEvery tweets (the next request
+        picks up where the stream broke)
+      - REST endpoints (statuses/user_timeline, search/tweets, statuses/lookup)
+        page through nbTweets tweets using count/max_id/since_id and answer
+        with a rate limit error (code 88) every rateLimitEvery requests
+    Every request is recorded in self.requests.
+    """
+
+    STREAMS = ("statuses/sample", "statuses/filter")
+
+    def __init__(self, nbTweets = 10000, tweetsPerSecond = None, deleteEvery = 20,
+                 chunkedErrorEvery = None, rateLimitEvery = None, restQuota = 180, seed = 0):
+        self.nbTweets = nbTweets
+        self.tweetsPerSecond = tweetsPerSecond
+        self.deleteEvery = deleteEvery
+        self.chunkedErrorEvery = chunkedErrorEvery
+        self.rateLimitEvery = rateLimitEvery
+        self.restQuota = restQuota
+        self.seed = seed
+
+        self.requests = []
+        self._streamed = 0
+        self._timeline = None
+
+    def request(self, twitterMethod, params = None):
+        self.requests.append((twitterMethod, dict(params or {})))
+        if twitterMethod in self.STREAMS:
+            return FakeResponse(self._stream())
+        return self._rest(twitterMethod, dict(params or {}))
+
+    def _stream(self):
+        tweets = tweetGenerator(self.nbTweets - self._streamed, seed = self.seed + self._streamed)
+        start = time.time()
+        sent = 0
+        for tweet in tweets:
+            if self.tweetsPerSecond:
+                delay = start + sent / self.tweetsPerSecond - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            sent += 1
+            self._streamed += 1
+            if self.deleteEvery and self._streamed % self.deleteEvery == 0:
+                yield {"delete": {"status": {"id": tweet["id"], "id_str": tweet["id_str"]}}}
+            yield tweet
+            if self.chunkedErrorEvery and self._streamed % self.chunkedErrorEvery == 0:
+                raise ChunkedEncodingError("Connection broken: IncompleteRead(0 bytes read)")
+
+    def _rest(self, twitterMethod, params):
+        nbRequests = len(self.requests)
+        reset = int(time.time()) + 15 * 60
+        headers = {"x-rate-limit-limit": str(self.restQuota),
+                   "x-rate-limit-remaining": str(max(0, self.restQuota - nbRequests % self.restQuota)),
+                   "x-rate-limit-reset": str(reset)}
+        if self.rateLimitEvery and nbRequests % self.rateLimitEvery == 0:
+            headers["x-rate-limit-remaining"] = "0"
+            return FakeResponse([{"message": "Rate limit exceeded", "code": 88}], headers, 429)
+
+        if self._timeline is None:
+            # Newest first, like Twitter
+            self._timeline = list(tweetGenerator(self.nbTweets, seed = self.seed))[::-1]
+
+        if twitterMethod == "statuses/lookup":
+            ids = set(str(params.get("id", "")).split(","))
+            return FakeResponse([t for t in self._timeline if t["id_str"] in ids], headers)
+
+        count = int(params.get("count", 20))
+        maxId = int(params["max_id"]) if "max_id" in params else None
+        sinceId = int(params["since_id"]) if "since_id" in params else None
+        page = [t for t in self._timeline
+                if (maxId is None or t["id"] <= maxId) and (sinceId is None or t["id"] > sinceId)][:count]
+        # (TwitterAPI's iterator already unwraps search/tweets' statuses)
+        return FakeResponse(page, headers)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of TwitterMySQL._prepTweet, comparing the compiled
+jTweetToRow mapping to the old eval() per column per tweet path.
+
+Usage:
+  python benchmarks/prepTweet.py [number of tweets]
+"""
+
+import os, sys, time
+import re
+import xml.etree.ElementTree as ET
+from HTMLParser import HTMLParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from TwitterMySQL.TwitterMySQL import TwitterMySQL, DEFAULT_MYSQL_COL_DESC, DEFAULT_TWEET_JSON_SQL_CORR
+from TwitterMySQL.metrics import NullMetrics
+
+SAMPLE_TWEET = {
+    "created_at": "Mon Jan 25 05:02:27 +0000 2010",
+    "id": 8153208361, "id_str": "8153208361",
+    "text": u"Sample &amp; tweet about the #TwitterAPI &lt;3 \u2764",
+    "source": u'<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>',
+    "in_reply_to_status_id_str": None, "in_reply_to_user_id_str": None,
+    "user": {"id": 474257339, "id_str": "474257339", "location": u"Philadelphia, PA",
+             "friends_count": 210, "followers_count": 301},
+    "place": {"full_name": u"Philadelphia, PA"},
+    "coordinates": {"type": "Point", "coordinates": [-75.1652, 39.9526]},
+    "lang": "en",
+}
+
+
+def legacyPrepTweet(twtSQL, jTweet):
+    """_prepTweet as it was before the jTweetToRow mapping got compiled"""
+    tweet = {}
+    for SQLcol in twtSQL.columns:
+        try:
+            if SQLcol in twtSQL.jTweetToRow:
+                tweet[SQLcol] = eval("jTweet%s" % twtSQL.jTweetToRow[SQLcol])
+                if isinstance(tweet[SQLcol], str) or isinstance(tweet[SQLcol], unicode):
+                    tweet[SQLcol] = HTMLParser().unescape(tweet[SQLcol]).encode("utf-8")
+                if SQLcol == "created_time":
+                    tweet[SQLcol] = str(time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(tweet[SQLcol], '%a %b %d %H:%M:%S +0000 %Y')))
+                if SQLcol == "source":
+                    tweet[SQLcol] = ET.fromstring(re.sub("&", "&amp;", tweet[SQLcol])).text
+            else:
+                tweet[SQLcol] = None
+        except KeyError:
+            tweet[SQLcol] = None
+
+    if "coordinates" in jTweet and jTweet["coordinates"]:
+        lon, lat = map(lambda x: float(x), jTweet["coordinates"]["coordinates"])
+        tweet["coordinates"] = str(jTweet["coordinates"]["coordinates"])
+        tweet["coordinates_state"] = None
+        tweet["coordinates_address"] = str({"lon": lon, "lat": lat})
+    return [tweet[SQLcol] for SQLcol in twtSQL.columns]
+
+
+def mapper():
+    """A TwitterMySQL object with only the row mapping set up (no MySQL connection)"""
+    twtSQL = TwitterMySQL.__new__(TwitterMySQL)
+    twtSQL.errorFile = None
+    twtSQL.geoLocate = None
+    twtSQL.metrics = NullMetrics()
+    twtSQL.jTweetToRow = DEFAULT_TWEET_JSON_SQL_CORR
+    twtSQL.columns_description = DEFAULT_MYSQL_COL_DESC
+    twtSQL.columns = [f.split(' ')[0] for f in DEFAULT_MYSQL_COL_DESC if f.split(' ')[0][:5] != "index"]
+    twtSQL._compileRowMapping()
+    return twtSQL
+
+
+def bench(name, prep, tweets):
+    start = time.time()
+    for jTweet in tweets:
+        prep(jTweet)
+    elapsed = time.time() - start
+    print "%-10s %8d tweets in %6.3fs  (%9.0f tweets/sec)" % (name, len(tweets), elapsed, len(tweets) / elapsed)
+    return elapsed
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    twtSQL = mapper()
+    tweets = [SAMPLE_TWEET] * n
+
+    assert list(twtSQL._prepTweet(SAMPLE_TWEET)) == legacyPrepTweet(twtSQL, SAMPLE_TWEET)
+
+    legacy = bench("eval", lambda t: legacyPrepTweet(twtSQL, t), tweets)
+    compiled = bench("compiled", twtSQL._prepTweet, tweets)
+    print "Speedup: %.1fx" % (legacy / compiled)
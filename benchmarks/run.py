@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Reproducible ingest benchmarks for TwitterMySQL, using synthetic tweets,
+a fake TwitterAPI (benchmarks/fakeTwitter.py) and a fake database
+(benchmarks/fakeDB.py). Reports tweets/sec, time spent per stage and
+peak memory (RSS) for each scenario, which runs in a process of its own.
+
+Usage:
+  python -m benchmarks.run [-n 20000] [--db recording|sqlite|mysql] [scenario ...]
+"""
+
+import os, sys, time
+import argparse, resource, multiprocessing
+from contextlib import contextmanager
+
+from TwitterMySQL import TwitterMySQL
+from benchmarks.fakeTwitter import FakeTwitterAPI, tweetGenerator
+from benchmarks.fakeDB import RecordingDB, SQLiteDB
+
+SCENARIOS = ["prepTweet", "tweetsToMySQL", "sampleStream", "userTimeline"]
+
+
+class StageTimer(object):
+    """Wraps methods of an object to add up the time spent in them"""
+
+    def __init__(self, obj, *methods):
+        self.totals = dict((m, 0.0) for m in methods)
+        self.calls = dict((m, 0) for m in methods)
+        for m in methods:
+            setattr(obj, m, self._wrap(m, getattr(obj, m)))
+
+    def _wrap(self, name, method):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.totals[name] += time.time() - start
+                self.calls[name] += 1
+        return timed
+
+
+@contextmanager
+def silenced():
+    """TwitterMySQL prints a lot, which isn't what's being measured"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def peakMemoryMB():
+    """Peak RSS of the process, ru_maxrss never goes down (see runScenario)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def runScenario(name, args):
+    """Runs a scenario in the current process, which has to be a new one for peakMemoryMB to be the scenario's"""
+    start = time.time()
+    with silenced():
+        nbTweets, timer = globals()[name](args)
+    return (nbTweets, time.time() - start, timer, peakMemoryMB())
+
+
+def makeTwtSQL(args, api = None):
+    if args.db == "recording":
+        connectFunction = RecordingDB(args.latencyPerQuery, args.latencyPerRow)
+    elif args.db == "sqlite":
+        connectFunction = SQLiteDB()
+    else:
+        connectFunction = None
+    kwargs = dict(db = args.mysqlDb, table = "benchmark", api = api or FakeTwitterAPI(args.tweets),
+                  dropIfExists = True, host = args.host)
+    if connectFunction:
+        kwargs["connectFunction"] = connectFunction
+    if args.bulk:
+        kwargs["local_infile"] = 1
+    twtSQL = TwitterMySQL(**kwargs)
+    # Rate limit waits are counted, not waited
+    twtSQL.waits = []
+    twtSQL._wait = lambda t, verbose = True: twtSQL.waits.append(t)
+    return twtSQL
+
+
+def prepTweet(args):
+    twtSQL = makeTwtSQL(args)
+    tweets = list(tweetGenerator(args.tweets))
+    timer = StageTimer(twtSQL, "_prepTweet")
+    for jTweet in tweets:
+        twtSQL._prepTweet(jTweet)
+    return (len(tweets), timer)
+
+
+def tweetsToMySQL(args):
+    twtSQL = makeTwtSQL(args)
+    rows = [twtSQL._prepTweet(t) for t in tweetGenerator(args.tweets)]
+    timer = StageTimer(twtSQL, "_flushTweets")
+    twtSQL._tweetsToMySQL(iter(rows), monthlyTables = True, bulk = args.bulk)
+    return (len(rows), timer)
+
+
+def sampleStream(args):
+    api = FakeTwitterAPI(args.tweets, tweetsPerSecond = args.rate, chunkedErrorEvery = args.tweets // 4 or None)
+    twtSQL = makeTwtSQL(args, api)
+    timer = StageTimer(twtSQL, "_prepTweet", "_flushTweets")
+    twtSQL.randomSampleToMySQL(bulk = args.bulk, pipelined = args.pipelined, dedup = args.dedup)
+    return (args.tweets, timer)
+
+
+def userTimeline(args):
+    api = FakeTwitterAPI(args.tweets, rateLimitEvery = 50)
+    twtSQL = makeTwtSQL(args, api)
+    timer = StageTimer(twtSQL, "_prepTweet", "_flushTweets")
+    twtSQL.userTimelineToMySQL(screen_name = "benchmark", monthlyTables = True, bulk = args.bulk)
+    return (args.tweets, timer)
+
+
+def report(name, nbTweets, elapsed, timer, memory):
+    print "%-14s %8d tweets in %7.3fs  %10.0f tweets/sec  peak RSS %7.1f MB" % (
+        name, nbTweets, elapsed, nbTweets / max(elapsed, 1e-9), memory)
+    for stage in sorted(timer.totals):
+        total, calls = (timer.totals[stage], timer.calls[stage])
+        print "    %-14s %7.3fs over %7d calls (%8.1f us/tweet)" % (stage, total, calls, 1e6 * total / max(nbTweets, 1))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "TwitterMySQL ingest benchmarks")
+    parser.add_argument("scenarios", nargs = "*", metavar = "scenario",
+                        help = "Scenarios to run (%s) [Default: all]" % ", ".join(SCENARIOS))
+    parser.add_argument("-n", "--tweets", type = int, default = 20000)
+    parser.add_argument("--db", choices = ["recording", "sqlite", "mysql"], default = "recording",
+                        help = "Fake database recording the queries, SQLite stand-in, or a real (local) mysqld")
+    parser.add_argument("--mysqlDb", default = "benchmark", help = "MySQL database to use with --db mysql")
+    parser.add_argument("--host", default = "localhost")
+    parser.add_argument("--latencyPerQuery", type = float, default = 0.0,
+                        help = "Simulated seconds per insert query (recording db)")
+    parser.add_argument("--latencyPerRow", type = float, default = 0.0,
+                        help = "Simulated seconds per inserted row (recording db)")
+    parser.add_argument("--rate", type = float, default = None,
+                        help = "Tweets per second replayed by the fake stream [Default: as fast as possible]")
+    parser.add_argument("--bulk", action = "store_true")
+    parser.add_argument("--pipelined", action = "store_true")
+    parser.add_argument("--dedup", action = "store_true", help = "Recent ID filter instead of REPLACE (sampleStream)")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario '%s', use one of: %s" % (name, ", ".join(SCENARIOS)))
+
+    for name in args.scenarios or SCENARIOS:
+        # A new process each time: peak RSS is per process, and it includes
+        # this one's (the interpreter and the modules) as of the fork
+        pool = multiprocessing.Pool(1)
+        try:
+            nbTweets, elapsed, timer, memory = pool.apply(runScenario, (name, args))
+        finally:
+            pool.close()
+            pool.join()
+        report(name, nbTweets, elapsed, timer, memory)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
 from TwitterMySQL import __version__, __author__, __email__
 import io
 
@@ -24,5 +27,6 @@ setup(
     keywords=['twitter','MySQL'],
     description='Wrapper for the Twitter APIs and MySQL',
     long_description=read('README.md'),
-    install_requires = ['requests', 'requests_oauthlib', 'TwitterAPI', 'MySQL-python']
+    install_requires = ['requests', 'requests_oauthlib', 'TwitterAPI', 'MySQL-python'],
+    entry_points = {'console_scripts': ['twittermysql = TwitterMySQL.cli:main']}
 )
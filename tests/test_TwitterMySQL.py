@@ -0,0 +1,245 @@
+"""
+Inserts of fake tweets (benchmarks/fakeTwitter.py) into an in-memory
+SQLite stand-in for MySQL (benchmarks/fakeDB.py).
+
+    python -m unittest discover tests
+"""
+
+import os, sys, time, datetime, threading, unittest
+
+from TwitterMySQL import TwitterMySQL
+from TwitterMySQL.TwitterMySQL import TWITTER_TIME_FORMAT, _tsvField, _parseTweetTime, _addMonths
+from benchmarks.fakeTwitter import tweetGenerator
+from benchmarks.fakeDB import RecordingDB, SQLiteDB
+
+# A tweet every ~4 days, so that they span several monthly tables
+MONTHS_APART = 1 / (4 * 86400.0)
+
+
+class ParallelTablesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLiteDB()
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+    def twtSQL(self, poolSize):
+        twtSQL = TwitterMySQL(db = "x", table = "t", api = None, connectFunction = self.db, poolSize = poolSize,
+                              quiet = True, errorFile = os.devnull)
+        # The inserts run in another thread (see runWithin)
+        twtSQL._disconnect()
+        return twtSQL
+
+    def runWithin(self, seconds, twtSQL, method, *args, **kwargs):
+        """Runs twtSQL.method in a thread, fails if it's still running after seconds"""
+        errors = []
+        def target():
+            try:
+                getattr(twtSQL, method)(*args, **kwargs)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                twtSQL._disconnect()
+        thread = threading.Thread(target = target)
+        thread.daemon = True
+        thread.start()
+        thread.join(seconds)
+        self.assertFalse(thread.is_alive(), "still running after %ds, deadlocked?" % seconds)
+        if errors:
+            raise errors[0]
+
+    def count(self):
+        tables = self.db.sqlite.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 't_%'").fetchall()
+        return sum(self.db.count(table) for (table, ) in tables)
+
+    def test_pool_smaller_than_the_tables(self):
+        """The current thread writes the tables the pool has no connection for"""
+        twtSQL = self.twtSQL(1)
+        rows = [twtSQL._prepTweet(tweet) for tweet in tweetGenerator(200, tweetsPerSecond = MONTHS_APART)]
+        self.runWithin(30, twtSQL, "_tweetsToMySQL", iter(rows), monthlyTables = True, parallelTables = 3)
+        self.assertEqual(self.count(), 200)
+        self.runWithin(30, twtSQL, "_flushTweets", {"2030_01": rows[:50], "2030_02": rows[50:100], "2030_03": rows[100:150]},
+                       monthlyTables = True, parallelTables = 3)
+        self.assertEqual(self.db.count("t_2030_02"), 50)
+
+    def test_pipelined_writers_and_tables_over_the_pool(self):
+        """writers * parallelTables beyond the pool size are cut down"""
+        twtSQL = self.twtSQL(2)
+        rows = [twtSQL._prepTweet(tweet) for tweet in tweetGenerator(500, tweetsPerSecond = MONTHS_APART)]
+        self.runWithin(30, twtSQL, "_tweetsToMySQL", iter(rows), monthlyTables = True, parallelTables = 3,
+                       pipelined = True, writers = 2)
+        self.assertEqual(self.count(), 500)
+
+
+class LoadDataSQLiteDB(SQLiteDB):
+    """SQLiteDB (which refuses LOAD DATA, see benchmarks/fakeDB.py) counting the LOAD DATA attempts"""
+
+    def __init__(self):
+        SQLiteDB.__init__(self)
+        self.nbLoads = 0
+
+    def __call__(self, **kwargs):
+        connection = SQLiteDB.__call__(self, **kwargs)
+        cursor = connection.cursor
+        def countingCursor():
+            cur = cursor()
+            execute = cur.execute
+            def counting(query, args = None):
+                if query.startswith("LOAD DATA"):
+                    self.nbLoads += 1
+                return execute(query, args)
+            cur.execute = counting
+            return cur
+        connection.cursor = countingCursor
+        return connection
+
+
+class BulkLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = LoadDataSQLiteDB()
+
+    def twtSQL(self, **params):
+        return TwitterMySQL(db = "x", table = "t", api = None, connectFunction = self.db,
+                            quiet = True, errorFile = os.devnull, **params)
+
+    def load(self, twtSQL, rows):
+        """Bulk loads rows in another thread, on its own connection"""
+        thread = threading.Thread(target = lambda: (twtSQL.bulkLoadRows(rows), twtSQL._disconnect()))
+        thread.start()
+        thread.join()
+
+    def test_refused_on_one_connection_only(self):
+        """A connection LOAD DATA was refused on uses inserts, the others still try"""
+        twtSQL = self.twtSQL(local_infile = 1)
+        rows = [twtSQL._prepTweet(tweet) for tweet in tweetGenerator(30)]
+        twtSQL.bulkLoadRows(rows[:10])
+        twtSQL.bulkLoadRows(rows[10:20])
+        self.assertEqual(self.db.nbLoads, 1)
+        # Its connection is busy, the thread gets a new one
+        self.load(twtSQL, rows[20:])
+        self.assertEqual(self.db.nbLoads, 2)
+        self.assertEqual(self.db.count("t"), 30)
+
+    def test_without_local_infile(self):
+        twtSQL = self.twtSQL()
+        rows = [twtSQL._prepTweet(tweet) for tweet in tweetGenerator(10)]
+        twtSQL.bulkLoadRows(rows)
+        self.assertEqual(self.db.nbLoads, 0)
+        self.assertEqual(self.db.count("t"), 10)
+
+
+class EmbeddedTest(unittest.TestCase):
+
+    def test_truncated_quoted_status(self):
+        """Statuses that came without their text and user aren't rows"""
+        twtSQL = TwitterMySQL(db = "x", table = "t", api = None, connectFunction = SQLiteDB(), embedded = True,
+                              quiet = True, errorFile = os.devnull)
+        retweeted, tweet = list(tweetGenerator(2))
+        tweet["retweeted_status"] = retweeted
+        # Snowflake IDs have the time in them, not the text and user though
+        quotedId = retweeted["id"] - 1000
+        retweeted["quoted_status"] = {"id": quotedId, "id_str": str(quotedId)}
+        rows = twtSQL._prepEmbedded(tweet)
+        messageIdIndex = twtSQL.columns.index("message_id")
+        self.assertEqual([row[messageIdIndex] for row in rows], [retweeted["id_str"]])
+        self.assertEqual(twtSQL.metrics.counter("embedded_truncated"), 1)
+
+
+class TSVFieldTest(unittest.TestCase):
+    """LOAD DATA INFILE's default escaping (FIELDS ESCAPED BY '\\')"""
+
+    def test_special_characters(self):
+        self.assertEqual(_tsvField("a\tb"), "a\\tb")
+        self.assertEqual(_tsvField("a\nb\r\n"), "a\\nb\\r\\n")
+        self.assertEqual(_tsvField("C:\\temp"), "C:\\\\temp")
+        self.assertEqual(_tsvField("a\0b"), "a\\0b")
+        # The backslash of an escape isn't escaped again
+        self.assertEqual(_tsvField("\\\t"), "\\\\\\t")
+
+    def test_null_and_others(self):
+        self.assertEqual(_tsvField(None), "\\N")
+        # The string "\N" isn't NULL
+        self.assertEqual(_tsvField("\\N"), "\\\\N")
+        self.assertEqual(_tsvField(""), "")
+        self.assertEqual(_tsvField(123456789012345678L), "123456789012345678")
+        self.assertEqual(_tsvField(u"caf\xe9\t"), "caf\xc3\xa9\\t")
+
+    def test_row_stays_one_line(self):
+        row = ("tab\there", "new\nline", None, 3)
+        line = "\t".join(_tsvField(v) for v in row)
+        self.assertEqual(line.count("\t"), 3)
+        self.assertFalse("\n" in line)
+
+
+class ParseTweetTimeTest(unittest.TestCase):
+
+    def test_same_as_strptime(self):
+        for tweet in tweetGenerator(500, tweetsPerSecond = 1 / 86400.0):
+            timestr = tweet["created_at"]
+            expected = time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(timestr, TWITTER_TIME_FORMAT))
+            self.assertEqual(_parseTweetTime(timestr), (expected, expected[:4] + "_" + expected[5:7]))
+
+    def test_month_ends(self):
+        self.assertEqual(_parseTweetTime("Thu Feb 29 23:59:59 +0000 2024")[0], "2024-02-29 23:59:59")
+        self.assertEqual(_parseTweetTime("Wed Feb 29 00:00:00 +0000 2023"), None)
+        self.assertEqual(_parseTweetTime("Sat Apr 31 00:00:00 +0000 2021"), None)
+
+    def test_other_layouts(self):
+        """Left to strptime (see _tweetTimeToMysql)"""
+        for timestr in ("Mon Jan 25 05:02:27 +0100 2010", "Mon Jan 25 5:02:27 +0000 2010",
+                        "Mon Jan 25 24:02:27 +0000 2010", "Mon Foo 25 05:02:27 +0000 2010",
+                        "2010-01-25 05:02:27", ""):
+            self.assertEqual(_parseTweetTime(timestr), None, timestr)
+        twtSQL = TwitterMySQL(db = "x", table = "t", api = None, connectFunction = RecordingDB(), quiet = True)
+        self.assertEqual(twtSQL._tweetTimeToMysql("2010-01-25 05:02:27", "%Y-%m-%d %H:%M:%S"), "2010-01-25 05:02:27")
+        self.assertRaises(ValueError, twtSQL._tweetTimeToMysql, "Mon Jan 25 24:02:27 +0000 2010")
+
+
+class PartitionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = RecordingDB()
+        self.twtSQL = TwitterMySQL(db = "x", table = "t", api = None, connectFunction = self.db, partitioned = True,
+                                   quiet = True, errorFile = os.devnull)
+        self.now = datetime.datetime.utcnow().strftime("%Y_%m")
+
+    def test_create_table(self):
+        SQL = self.twtSQL._createTableSQL("t")
+        self.assertTrue("primary key (message_id, created_time)" in SQL)
+        self.assertFalse("message_id bigint(20) primary key" in SQL)
+        self.assertTrue("partition by range (to_days(created_time))" in SQL)
+        first, last = (self.now, _addMonths(self.now, self.twtSQL.partitionsAhead))
+        self.assertTrue("PARTITION p0 VALUES LESS THAN (TO_DAYS('%s-01'))" % first.replace("_", "-") in SQL)
+        self.assertTrue("PARTITION p%s VALUES LESS THAN (TO_DAYS('%s-01'))" % (
+            last.replace("_", ""), _addMonths(last, 1).replace("_", "-")) in SQL)
+        self.assertTrue(SQL.endswith("PARTITION pmax VALUES LESS THAN MAXVALUE)"))
+
+    def test_add_months(self):
+        """Newer months split pmax, older ones p0, known ones don't touch the table"""
+        self.twtSQL._partitions["t"] = set([self.now, _addMonths(self.now, 1), _addMonths(self.now, 2)])
+        self.twtSQL._ensurePartitions("t", [self.now])
+        self.assertEqual(self.db.queries, [])
+
+        later = _addMonths(self.now, 4)
+        self.twtSQL._ensurePartitions("t", [later])
+        SQL = self.db.queries[-1][0]
+        self.assertTrue(SQL.startswith("ALTER TABLE t REORGANIZE PARTITION pmax INTO (PARTITION p%s " % _addMonths(self.now, 3).replace("_", "")))
+        self.assertTrue("PARTITION p%s " % later.replace("_", "") in SQL)
+
+        earlier = _addMonths(self.now, -2)
+        self.twtSQL._ensurePartitions("t", [earlier])
+        SQL = self.db.queries[-1][0]
+        self.assertTrue(SQL.startswith("ALTER TABLE t REORGANIZE PARTITION p0 INTO (PARTITION p0 VALUES LESS THAN (TO_DAYS('%s-01'))"
+                                       % earlier.replace("_", "-")))
+        self.assertTrue(SQL.endswith("PARTITION p%s VALUES LESS THAN (TO_DAYS('%s-01')))" % (
+            _addMonths(self.now, -1).replace("_", ""), self.now.replace("_", "-"))))
+        self.assertEqual(len(self.db.queries), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Supervisor runs on fake Twitter streams (benchmarks/fakeTwitter.py) and
+an in-memory SQLite stand-in for MySQL (benchmarks/fakeDB.py).
+
+    python -m unittest discover tests
+"""
+
+import os, sys, time, unittest
+
+from TwitterMySQL import TwitterMySQL
+from TwitterMySQL import daemon
+from TwitterMySQL.TwitterMySQL import MYSQL_POOL_SIZE
+from benchmarks.fakeTwitter import FakeTwitterAPI
+from benchmarks.fakeDB import SQLiteDB
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLiteDB()
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+    def twtSQL(self, nbApis = 1):
+        apis = [FakeTwitterAPI(10**6, tweetsPerSecond = 500, deleteEvery = None) for i in xrange(nbApis)]
+        return TwitterMySQL(db = "x", table = "t", apis = apis, connectFunction = self.db,
+                            quiet = True, errorFile = os.devnull)
+
+    def count(self, table):
+        try:
+            return self.db.count(table)
+        except Exception:
+            return 0
+
+    def test_as_many_streams_as_the_default_pool(self):
+        """Every stream gets a writer connection, none waits on the pool"""
+        nbJobs = MYSQL_POOL_SIZE + 1
+        twtSQL = self.twtSQL(nbJobs)
+        supervisor = daemon.Supervisor(twtSQL, [{"name": "s%d" % i, "type": "filter", "table": "t%d" % i, "track": "x"}
+                                                for i in xrange(nbJobs)], drainTimeout = 10)
+        self.assertTrue(twtSQL._pool.size > nbJobs)
+        supervisor.start()
+        try:
+            deadline = time.time() + 20
+            while time.time() < deadline and not all(self.count("t%d" % i) for i in xrange(nbJobs)):
+                time.sleep(0.2)
+        finally:
+            supervisor.stop()
+            running = supervisor.join(10)
+        self.assertEqual(running, [])
+        for i in xrange(nbJobs):
+            self.assertTrue(self.count("t%d" % i) > 0, "nothing written by job s%d" % i)
+
+    def test_stop_drains(self):
+        """What the streams received is in the tables once stop() returns"""
+        twtSQL = self.twtSQL(2)
+        supervisor = daemon.Supervisor(twtSQL, [{"type": "sample", "monthlyTables": False},
+                                                {"name": "f", "type": "filter", "table": "f", "track": "x"}])
+        supervisor.start()
+        time.sleep(1)
+        supervisor.stop()
+        self.assertEqual(supervisor.join(10), [])
+        self.assertEqual(self.count("t") + self.count("f"), twtSQL.metrics.counter("tweets_received"))
+
+    def test_unknown_job_type(self):
+        self.assertRaises(ValueError, daemon.Job, {"type": "firehose"})
+
+
+if __name__ == "__main__":
+    unittest.main()
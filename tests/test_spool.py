@@ -0,0 +1,129 @@
+"""
+Spooled inserts (see TwitterMySQL._flushSpooled) of fake tweets
+(benchmarks/fakeTwitter.py) into an in-memory SQLite stand-in for MySQL
+(benchmarks/fakeDB.py) that can be down or refuse rows.
+
+    python -m unittest discover tests
+"""
+
+import os, sys, shutil, tempfile, unittest
+
+import MySQLdb
+
+from TwitterMySQL import TwitterMySQL, Spool
+from benchmarks.fakeTwitter import tweetGenerator
+from benchmarks.fakeDB import SQLiteDB
+
+
+class FlakySQLiteDB(SQLiteDB):
+    """SQLiteDB that can be down, and refuses the rows of the message IDs in refused"""
+
+    def __init__(self):
+        SQLiteDB.__init__(self)
+        self.down = False
+        self.refused = set()
+
+    def __call__(self, **kwargs):
+        if self.down:
+            raise MySQLdb.OperationalError(2003, "Can't connect to MySQL server")
+        connection = SQLiteDB.__call__(self, **kwargs)
+        cursor = connection.cursor
+        def flakyCursor():
+            cur = cursor()
+            executemany = cur.executemany
+            def refusing(query, values):
+                values = list(values)
+                if self.down:
+                    raise MySQLdb.OperationalError(2006, "MySQL server has gone away")
+                if any(v[1] in self.refused for v in values):
+                    raise MySQLdb.IntegrityError(1062, "Duplicate entry")
+                return executemany(query, values)
+            cur.executemany = refusing
+            return cur
+        connection.cursor = flakyCursor
+        return connection
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FlakySQLiteDB()
+        self.directory = tempfile.mkdtemp(prefix = "TwitterMySQL_spool_test_")
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory, True)
+
+    def twtSQL(self, **params):
+        twtSQL = TwitterMySQL(db = "x", table = "t", api = None, connectFunction = self.db,
+                              quiet = True, errorFile = os.devnull, **params)
+        # No countdowns between attempts
+        twtSQL._wait = lambda *args, **kwargs: None
+        return twtSQL
+
+    def rows(self, twtSQL, n):
+        return [twtSQL._prepTweet(tweet) for tweet in tweetGenerator(n)]
+
+    def count(self):
+        try:
+            return self.db.count("t")
+        except Exception:
+            return 0
+
+    def test_refused_rows_are_not_acknowledged(self):
+        """A segment MySQL gives up on is kept aside as .failed, not deleted"""
+        twtSQL = self.twtSQL()
+        rows = self.rows(twtSQL, 300)
+        spool = Spool(self.directory, segmentRows = 100)
+        for row in rows:
+            spool.append(row)
+        spool.close()
+        self.db.refused.add(rows[150][1])
+
+        twtSQL._tweetsToMySQL(iter([]), spool = Spool(self.directory))
+        self.assertEqual(self.count(), 200)
+        self.assertEqual(os.listdir(self.directory), ["%012d.failed" % 2])
+        failed = Spool(self.directory)
+        self.assertEqual(failed.pending(), 0)
+        self.assertEqual(list(failed.read(2, ".failed")), rows[100:200])
+
+    def test_replay_after_a_crash(self):
+        """A segment left .open by a crash is replayed up to its torn last record"""
+        twtSQL = self.twtSQL()
+        rows = self.rows(twtSQL, 150)
+        spool = Spool(self.directory, segmentRows = 100, syncEvery = 1)
+        for row in rows:
+            spool.append(row)
+        # Killed halfway through an append, never sealed nor closed
+        segments = sorted(os.listdir(self.directory))
+        self.assertEqual(segments, ["%012d.seg" % 1, "%012d.open" % 2])
+        with open(os.path.join(self.directory, segments[1]), "ab") as f:
+            f.write("\x40\x00\x00\x00\x12\x34")
+
+        replay = Spool(self.directory)
+        self.assertEqual(replay.pending(), 2)
+        self.assertEqual(list(replay.read(2)), rows[100:])
+        twtSQL._tweetsToMySQL(iter([]), spool = replay)
+        self.assertEqual(self.count(), 150)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(replay.nbAcked, 2)
+
+    def test_start_while_mysql_is_down(self):
+        """With lazyConnect, tweets go to the spool until MySQL is back"""
+        self.db.down = True
+        twtSQL = self.twtSQL(lazyConnect = True)
+        rows = self.rows(twtSQL, 250)
+        twtSQL._tweetsToMySQL(iter(rows), spool = self.directory)
+        self.assertTrue(Spool(self.directory).pending() > 0)
+
+        self.db.down = False
+        twtSQL._tweetsToMySQL(iter([]), spool = self.directory)
+        self.assertEqual(self.count(), 250)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == "__main__":
+    unittest.main()